@@ -1,5 +1,5 @@
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, Query
 from jose import jwt, JWTError, ExpiredSignatureError
 from starlette import status
 from datetime import datetime, timedelta
@@ -8,6 +8,10 @@ from app.utils.config import settings
 
 #this module automatically parses the request header containing the Bearer token and the jwt token
 http_bearer = HTTPBearer()
+optional_http_bearer = HTTPBearer(auto_error=False)
+
+#tokens for the events stream carry this audience, authenticate_request rejects them because it expects none
+EVENTS_TOKEN_AUDIENCE = "events"
 
 def create_jwt_token(data: str) -> str:
     """
@@ -47,13 +51,30 @@ def create_jwt_refresh_token(data: str) -> str:
         algorithm=settings.JWT_AUTH_ALGORITHM
     )
 
-def authenticate_request(http_credentials: HTTPAuthorizationCredentials = Depends(http_bearer)):
+def create_events_token(data: str) -> str:
+    """
+    Function to create a short-lived token for the events stream. Browsers open the stream with EventSource, which can
+    not send an Authorization header, so the token goes in the url and is only accepted by authenticate_events_request.
+    :param data: The data to be encoded in the JWT token.
+    :return: A JWT token as a string.
+    """
 
-    # retrieve the token by parsing the HTTPAuthorizationCredentials object, it will automatically contain the Bearer prefix and the jwt token
-    jwt_token = http_credentials.credentials
+    jwt_payload = {
+        "sub": data,
+        "aud": EVENTS_TOKEN_AUDIENCE,
+        "exp": datetime.utcnow() + timedelta(seconds=settings.EVENTS_TOKEN_EXPIRATION_SECONDS),
+        "iat": datetime.utcnow()
+    }
 
+    return jwt.encode(
+        claims=jwt_payload,
+        key=settings.JWT_SIGNATURE_SECRET_KEY,
+        algorithm=settings.JWT_AUTH_ALGORITHM
+    )
+
+def _decode_jwt_token(jwt_token: str, audience: str | None = None) -> dict:
     try:
-        jwt_payload = jwt.decode(token=jwt_token, algorithms=settings.JWT_AUTH_ALGORITHM, key=settings.JWT_SIGNATURE_SECRET_KEY, options={"verify_signature": True, "verify_exp": True, "verify_sub": False})
+        return jwt.decode(token=jwt_token, algorithms=settings.JWT_AUTH_ALGORITHM, key=settings.JWT_SIGNATURE_SECRET_KEY, audience=audience, options={"verify_signature": True, "verify_exp": True, "verify_sub": False, "require_aud": audience is not None})
 
     except ExpiredSignatureError:
         raise HTTPException(
@@ -71,5 +92,26 @@ def authenticate_request(http_credentials: HTTPAuthorizationCredentials = Depend
             detail="Authentication failed"
         )
 
-    return jwt_payload
+def authenticate_request(http_credentials: HTTPAuthorizationCredentials = Depends(http_bearer)):
+
+    # retrieve the token by parsing the HTTPAuthorizationCredentials object, it will automatically contain the Bearer prefix and the jwt token
+    jwt_token = http_credentials.credentials
+
+    return _decode_jwt_token(jwt_token)
+
+def authenticate_events_request(token: str | None = Query(None), http_credentials: HTTPAuthorizationCredentials | None = Depends(optional_http_bearer)):
+    """
+    Authenticate the events stream with an events token in the token query parameter (EventSource), or with the usual
+    Bearer header (clients that can send one).
+    """
+
+    if token is not None:
+        return _decode_jwt_token(token, audience=EVENTS_TOKEN_AUDIENCE)
+
+    if http_credentials is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated"
+        )
 
+    return _decode_jwt_token(http_credentials.credentials)
@@ -1,5 +1,7 @@
 from celery import Celery
+from kombu import Queue
 
+from app.services.routing_services import USER_TASK_QUEUES, route_user_task
 from app.utils.config import settings
 
 UPSTASH_REDIS_CONNECTION_URL: str = settings.REDIS_CLOUD_URL + "?ssl_cert_reqs=none"
@@ -7,7 +9,7 @@ UPSTASH_REDIS_CONNECTION_URL: str = settings.REDIS_CLOUD_URL + "?ssl_cert_reqs=n
 celery_app = Celery(
     "fastapi_worker",
     broker = UPSTASH_REDIS_CONNECTION_URL,
-    backend = UPSTASH_REDIS_CONNECTION_URL
+    backend = UPSTASH_REDIS_CONNECTION_URL if settings.CELERY_STORE_RESULTS else None
 )
 
 #for async support
@@ -15,7 +17,36 @@ celery_app.conf.update(
     broker_use_ssl={"ssl_cert_reqs": "CERT_NONE"},
     redis_backend_use_ssl={"ssl_cert_reqs": "CERT_NONE"},
     worker_pool="custom",
-    worker_pool_cls="celery_aio_pool.pool:AsyncIOPool"
+    worker_pool_cls="celery_aio_pool.pool:AsyncIOPool",
+    #progress is tracked in the campaign hashes, the task return values were never read
+    task_ignore_result=not settings.CELERY_STORE_RESULTS,
+    #per-user tasks are routed to USER_TASK_QUEUES by consistent hashing on the user id, everything else uses the default
+    #queue. A worker started without -Q consumes all of them. The aio pool runs one task at a time per worker, so a lane's
+    #concurrency is its number of workers: docker-compose.yml runs exactly one per user queue and a few interactive ones
+    task_default_queue="celery",
+    task_queues=[Queue("celery", routing_key="celery"), Queue(settings.INTERACTIVE_TASK_QUEUE, routing_key=settings.INTERACTIVE_TASK_QUEUE)]
+                + [Queue(queue_name, routing_key=queue_name) for queue_name in USER_TASK_QUEUES],
+    task_routes=(route_user_task,),
+    worker_prefetch_multiplier=1,
+    #deferred chunks and due retries are released by periodic sweeps, run `celery -A app.celery_worker beat` once
+    beat_schedule={
+        "send-deferred-chunks": {
+            "task": "send_deferred_chunks",
+            "schedule": settings.DEFERRED_SWEEP_SECONDS,
+        },
+        "release-due-retries": {
+            "task": "release_due_retries",
+            "schedule": settings.RETRY_SWEEP_SECONDS,
+        },
+        "refresh-google-tokens": {
+            "task": "refresh_google_tokens",
+            "schedule": settings.GOOGLE_TOKEN_SWEEP_SECONDS,
+        },
+        "remove-stale-uploads": {
+            "task": "remove_stale_uploads",
+            "schedule": settings.DIRECT_UPLOAD_SWEEP_SECONDS,
+        },
+    }
 )
 
 celery_app.autodiscover_tasks(['app.tasks.celery_tasks'])
\ No newline at end of file
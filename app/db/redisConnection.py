@@ -1,8 +1,12 @@
+from redis import Redis as SyncRedis
 from redis.asyncio import Redis
 from app.utils.config import settings
 
 redis_client: Redis = Redis.from_url(settings.REDIS_CLOUD_URL, decode_responses=True)
 
+#for the blocking helpers (storage, google calls) that run outside of an event loop or inside a sync call chain
+sync_redis_client: SyncRedis = SyncRedis.from_url(settings.REDIS_CLOUD_URL, decode_responses=True)
+
 async def get_redis_connection() -> Redis:
     """
     Dependency to get a Redis connection.
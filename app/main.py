@@ -3,8 +3,12 @@ from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import text
 import logging
 
+from app.routes.campaign_routes import campaign_router
+from app.routes.dead_letter_routes import dead_letter_router
 from app.routes.email_routes import email_router
+from app.routes.event_routes import event_router
 from app.routes.login_routes import login_router
+from app.routes.metrics_routes import metrics_router
 from app.routes.oauth_routes import oauth_router
 from app.routes.auth_routes import auth_router
 from app.pydantic_schemas.response_pydantic import ResponseSchema
@@ -14,10 +18,13 @@ from app.models.base_model import Base
 import app.models
 from app.routes.queue_routes import queue_router
 from app.routes.storage_routes import storage_router
+from app.routes.sync_routes import sync_router
 from app.routes.template_routes import template_router
 from app.routes.user_routes import user_router
 from app.utils.config import settings
 
+from app.services.event_services import event_broadcaster
+from app.services.oauth_services import load_google_client_config, close_oauth_http_client
 from app.services.ratelimiting_services import RateLimitManager
 app = FastAPI()
 
@@ -30,6 +37,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -57,6 +65,11 @@ app.include_router(template_router)
 app.include_router(email_router)
 app.include_router(queue_router)
 app.include_router(storage_router)
+app.include_router(metrics_router)
+app.include_router(sync_router)
+app.include_router(event_router)
+app.include_router(campaign_router)
+app.include_router(dead_letter_router)
 
 @app.on_event("startup")
 async def db_create_tables():
@@ -69,4 +82,17 @@ async def db_create_tables():
     except Exception as e:
         logger.error(f"Database connection failed: {e}")
     finally:
-        db_session.close()
\ No newline at end of file
+        db_session.close()
+
+@app.on_event("startup")
+async def load_oauth_client_config():
+    #parsed once here instead of on every authorize and callback request
+    try:
+        load_google_client_config()
+    except Exception as e:
+        logger.error(f"Loading the google client config failed: {e}")
+
+@app.on_event("shutdown")
+async def close_event_subscription():
+    await event_broadcaster.close()
+    await close_oauth_http_client()
@@ -1,4 +1,5 @@
 from app.models.user_models import User
 from app.models.user_token_models import UserToken
 from app.models.email_models import Email
-from app.models.template_models import Template
\ No newline at end of file
+from app.models.template_models import Template
+from app.models.attachment_models import Attachment
\ No newline at end of file
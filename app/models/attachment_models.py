@@ -0,0 +1,23 @@
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, UniqueConstraint
+from sqlalchemy.orm import relationship
+
+from app.models.base_model import Base
+
+class Attachment(Base):
+
+    __tablename__ = 'attachments'
+    #a user has one row per file content, the same content uploaded by several users is stored once
+    __table_args__ = (UniqueConstraint('uid', 'sha256'),)
+
+    attachment_id = Column(Integer, primary_key=True, autoincrement=True, unique=True, index=True)
+    uid = Column(Integer, ForeignKey('users.uid'), nullable=False)
+    sha256 = Column(String(64), nullable=False, index=True)
+    filename = Column(String, nullable=False)
+    content_type = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    object_url = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    user = relationship('User', back_populates='attachments')
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, JSON
 from sqlalchemy.orm import relationship
 
 from app.models.base_model import Base
@@ -19,5 +19,6 @@ class Email(Base):
     bcc_email = Column(String, nullable=True)
     send_at = Column(DateTime, nullable=False)
     include_resume = Column(Boolean, default=False)
+    attachment_ids = Column(JSON, nullable=True)   #ids of the user's attachments sent with the email
 
     user = relationship('User', back_populates='emails')
\ No newline at end of file
@@ -17,4 +17,5 @@ class User(Base):
 
     emails = relationship('Email', back_populates='user', cascade='all, delete', lazy='select')
     templates = relationship('Template', back_populates='user', cascade='all, delete', lazy='select')
-    user_tokens = relationship('UserToken', back_populates='user', cascade='all, delete', lazy='select')
\ No newline at end of file
+    user_tokens = relationship('UserToken', back_populates='user', cascade='all, delete', lazy='select')
+    attachments = relationship('Attachment', back_populates='user', cascade='all, delete', lazy='select')
\ No newline at end of file
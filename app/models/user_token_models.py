@@ -13,6 +13,8 @@ class UserToken(Base):
     refresh_token = Column(String, nullable=False, unique=True)
     token_type = Column(String, nullable=False, default='gmail')
     expires_at = Column(DateTime, nullable=False)
+    sender_email = Column(String, nullable=True)    #the gmail address of this token, tokens from before multiple accounts send as the user's email
+    transport = Column(String, nullable=True)       #gmail_api, smtp or sink, EMAIL_TRANSPORT when not set
 
     # Assuming a relationship with User model exists
     user = relationship('User', back_populates='user_tokens')
\ No newline at end of file
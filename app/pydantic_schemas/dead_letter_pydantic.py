@@ -0,0 +1,11 @@
+from typing import Optional, List
+
+from pydantic import BaseModel
+
+class DeadLetterFilterSchema(BaseModel):
+    """
+    Selects dead letters for a bulk operation. Empty fields do not filter, an empty filter selects every dead letter.
+    """
+    error: Optional[str] = None
+    campaign_id: Optional[str] = None
+    eids: Optional[List[int]] = None
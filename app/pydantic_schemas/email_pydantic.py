@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -13,4 +13,5 @@ class EmailSchema(BaseModel):
     cc_email: Optional[str] = None
     bcc_email: Optional[str] = None
     send_at: Optional[datetime] = None
-    include_resume: Optional[bool] = False
\ No newline at end of file
+    include_resume: Optional[bool] = False
+    attachment_ids: Optional[List[int]] = None
\ No newline at end of file
@@ -0,0 +1,16 @@
+from typing import Literal
+
+from pydantic import BaseModel, Field
+
+class DirectUploadSchema(BaseModel):
+    """
+    A file the client uploads straight to storage. sha256 is the hex SHA-256 of the file content.
+    """
+    filename: str
+    content_type: str
+    size: int = Field(gt=0)
+    sha256: str = Field(pattern=r"^[0-9a-f]{64}$")
+    purpose: Literal["attachment", "resume"] = "attachment"
+
+class DirectUploadCompleteSchema(BaseModel):
+    upload_id: str
@@ -0,0 +1,103 @@
+from fastapi import APIRouter, Depends
+from redis.asyncio import Redis
+
+from app.auth.dependency_auth import authenticate_request
+from app.db.redisConnection import get_redis_connection
+from app.pydantic_schemas.response_pydantic import ResponseSchema
+from app.services.campaign_services import get_campaign, set_campaign_status, start_new_run
+from app.tasks.celery_tasks import send_emails_from_user_queue
+
+campaign_router = APIRouter(
+    prefix="/api/campaigns",
+    tags=["Campaigns"]
+)
+
+async def _get_user_campaign(redis_connection: Redis, campaign_id: str, user_id: str) -> dict | None:
+    campaign = await get_campaign(redis_connection, campaign_id)
+
+    #campaigns of other users are reported as missing, so ids cannot be probed
+    if campaign is None or campaign["user_id"] != str(user_id):
+        return None
+
+    return campaign
+
+def _campaign_not_found(campaign_id: str) -> ResponseSchema:
+    return ResponseSchema(
+        success=False,
+        status_code=404,
+        message=f"Campaign {campaign_id} not found.",
+        data={}
+    )
+
+async def _change_campaign_status(redis_connection: Redis, campaign_id: str, user_id: str, new_status: str) -> ResponseSchema:
+    if await _get_user_campaign(redis_connection, campaign_id, user_id) is None:
+        return _campaign_not_found(campaign_id)
+
+    status = await set_campaign_status(redis_connection, campaign_id, new_status)
+
+    if status != new_status:
+        return ResponseSchema(
+            success=False,
+            status_code=409,
+            message=f"Campaign cannot be {new_status} while it is {status}.",
+            data={"campaign_id": campaign_id, "status": status}
+        )
+
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message=f"Campaign {new_status} successfully.",
+        data={"campaign_id": campaign_id, "status": status}
+    )
+
+@campaign_router.get("/{campaign_id}")
+async def get_campaign_status(campaign_id: str, jwt_payload: dict = Depends(authenticate_request), redis_connection: Redis = Depends(get_redis_connection)):
+    """
+    Endpoint to get the status and progress counters (queued, in_flight, sent, failed, dead) of a campaign.
+    """
+    campaign = await _get_user_campaign(redis_connection, campaign_id, jwt_payload.get("sub"))
+
+    if campaign is None:
+        return _campaign_not_found(campaign_id)
+
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message="Campaign retrieved successfully.",
+        data=campaign
+    )
+
+@campaign_router.post("/{campaign_id}/pause")
+async def pause_campaign(campaign_id: str, jwt_payload: dict = Depends(authenticate_request), redis_connection: Redis = Depends(get_redis_connection)):
+    """
+    Endpoint to pause a campaign. The worker stops before its next email and the unsent emails stay in the queue.
+    """
+    return await _change_campaign_status(redis_connection, campaign_id, jwt_payload.get("sub"), "paused")
+
+@campaign_router.post("/{campaign_id}/cancel")
+async def cancel_campaign(campaign_id: str, jwt_payload: dict = Depends(authenticate_request), redis_connection: Redis = Depends(get_redis_connection)):
+    """
+    Endpoint to cancel a campaign. The worker stops before its next email and the unsent emails stay in the queue.
+    """
+    return await _change_campaign_status(redis_connection, campaign_id, jwt_payload.get("sub"), "cancelled")
+
+@campaign_router.post("/{campaign_id}/resume")
+async def resume_campaign(campaign_id: str, jwt_payload: dict = Depends(authenticate_request), redis_connection: Redis = Depends(get_redis_connection)):
+    """
+    Endpoint to resume a paused campaign with a new worker run over the emails that are back in the queue. Chunks of the
+    earlier run that had not stopped yet keep sending their own emails.
+    """
+    user_id = jwt_payload.get("sub")
+
+    campaign_response = await _change_campaign_status(redis_connection, campaign_id, user_id, "queued")
+
+    if not campaign_response.success:
+        return campaign_response
+
+    run = await start_new_run(redis_connection, campaign_id)
+    campaign = await get_campaign(redis_connection, campaign_id)
+
+    send_emails_from_user_queue.delay(user_id, campaign["email_ids"], campaign_id, run)
+
+    campaign_response.message = "Campaign resumed successfully."
+    return campaign_response
@@ -0,0 +1,82 @@
+from collections import Counter
+
+from fastapi import APIRouter, Depends, Query
+from redis.asyncio import Redis
+
+from app.auth.dependency_auth import authenticate_request
+from app.db.redisConnection import get_redis_connection
+from app.pydantic_schemas.dead_letter_pydantic import DeadLetterFilterSchema
+from app.pydantic_schemas.response_pydantic import ResponseSchema
+from app.services.campaign_services import update_campaign_counters
+from app.services.retry_services import list_dead_letters, count_dead_letters_by_error, requeue_dead_letters, \
+    purge_dead_letters
+
+dead_letter_router = APIRouter(
+    prefix="/api/dead-letters",
+    tags=["Dead Letters"]
+)
+
+@dead_letter_router.get("/")
+async def get_dead_letters(offset: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=500), error: str = None,
+                           jwt_payload: dict = Depends(authenticate_request),
+                           redis_connection: Redis = Depends(get_redis_connection)):
+    """
+    Endpoint to page through the emails that ran out of retries, optionally only those that failed with one error.
+    """
+    total, dead_letters = await list_dead_letters(redis_connection, jwt_payload.get("sub"), offset, limit, error)
+
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message="Dead letters retrieved successfully.",
+        data={"total": total, "offset": offset, "limit": limit, "dead_letters": dead_letters}
+    )
+
+@dead_letter_router.get("/errors")
+async def get_dead_letter_errors(jwt_payload: dict = Depends(authenticate_request),
+                                 redis_connection: Redis = Depends(get_redis_connection)):
+    """
+    Endpoint to get the number of dead letters per error, most frequent first.
+    """
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message="Dead letter errors retrieved successfully.",
+        data={"errors": await count_dead_letters_by_error(redis_connection, jwt_payload.get("sub"))}
+    )
+
+@dead_letter_router.post("/requeue")
+async def requeue_dead_letter_emails(dead_letter_filter: DeadLetterFilterSchema,
+                                     jwt_payload: dict = Depends(authenticate_request),
+                                     redis_connection: Redis = Depends(get_redis_connection)):
+    """
+    Endpoint to give all dead letters matching the filter a fresh set of retries, sent by the next retry sweep.
+    """
+    requeued_emails = await requeue_dead_letters(redis_connection, jwt_payload.get("sub"), dead_letter_filter)
+
+    #the requeued emails are failed (waiting for a retry) again in their campaigns
+    for campaign_id, count in Counter(email_data.get("campaign_id") for email_data in requeued_emails).items():
+        await update_campaign_counters(redis_connection, campaign_id, dead=-count, failed=count)
+
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message=f"{len(requeued_emails)} dead letters requeued successfully.",
+        data={"requeued": len(requeued_emails), "eids": [email_data.get("eid") for email_data in requeued_emails]}
+    )
+
+@dead_letter_router.post("/purge")
+async def purge_dead_letter_emails(dead_letter_filter: DeadLetterFilterSchema,
+                                   jwt_payload: dict = Depends(authenticate_request),
+                                   redis_connection: Redis = Depends(get_redis_connection)):
+    """
+    Endpoint to delete all dead letters matching the filter.
+    """
+    purged_emails = await purge_dead_letters(redis_connection, jwt_payload.get("sub"), dead_letter_filter)
+
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message=f"{len(purged_emails)} dead letters purged successfully.",
+        data={"purged": len(purged_emails), "eids": [email_data.get("eid") for email_data in purged_emails]}
+    )
@@ -1,10 +1,16 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+import uuid
+
+from fastapi import APIRouter, Depends, Header
+from redis.asyncio import Redis
 
-from app.routes.service_routes import send_gmail_service
 from app.pydantic_schemas.email_pydantic import EmailSchema
-from app.db.dbConnection import get_db_session
+from app.pydantic_schemas.response_pydantic import ResponseSchema
+from app.db.redisConnection import get_redis_connection
 from app.auth.dependency_auth import authenticate_request
+from app.services.idempotency_services import claim_idempotency_key
+from app.services.interactive_services import create_send_request, wait_for_send_result, get_send_request
+from app.tasks.celery_tasks import send_email_now
+from app.utils.config import settings
 
 email_router = APIRouter(
     prefix="/api/email",
@@ -13,10 +19,75 @@ email_router = APIRouter(
 
 
 @email_router.post("/send-email-now")
-def send_gmail_now_wrapper(email_object: EmailSchema, jwt_payload: dict[str] = Depends(authenticate_request), db_connection: Session = Depends(get_db_session)):
+async def send_gmail_now_wrapper(email_object: EmailSchema, jwt_payload: dict[str] = Depends(authenticate_request), redis_connection: Redis = Depends(get_redis_connection),
+                                 idempotency_key: str | None = Header(default=None, alias="Idempotency-Key")):
     """
     Endpoint to send an email using Gmail API.
+    The email is sent by a worker of the interactive queue, the request waits for its result up to SEND_NOW_WAIT_SECONDS
+    and otherwise answers 202 with a request id that can be polled at /send-status/{request_id}.
+    A client that retries with the same Idempotency-Key gets the outcome of the first request instead of a second email.
+    """
+    user_id = jwt_payload.get("sub")
+    request_id = uuid.uuid4().hex
+
+    if idempotency_key is not None:
+        #the key points to the send request, so it is remembered exactly as long as the send request
+        stored_record = await claim_idempotency_key(redis_connection, user_id, "send_now", idempotency_key, {"request_id": request_id},
+                                                    ttl_seconds=settings.SEND_RESULT_TTL_SECONDS)
+
+        if stored_record is not None:
+            return await _replay_send_request(redis_connection, stored_record["request_id"])
+
+    await create_send_request(redis_connection, request_id, user_id)
+
+    send_email_now.delay(user_id, email_object.model_dump(mode="json"), request_id)
+
+    send_result = await wait_for_send_result(redis_connection, request_id, settings.SEND_NOW_WAIT_SECONDS)
+
+    if send_result is None:
+        return ResponseSchema(
+            success=True,
+            status_code=202,
+            message="Email is being sent.",
+            data={"request_id": request_id, "status_url": f"/api/email/send-status/{request_id}"}
+        )
+
+    return ResponseSchema(**send_result)
+
+
+async def _replay_send_request(redis_connection: Redis, request_id: str) -> ResponseSchema:
+    send_request = await get_send_request(redis_connection, request_id)
+
+    if send_request is not None and send_request["status"] == "done":
+        return ResponseSchema(**send_request["result"])
+
+    #the first request is still waiting on the result, this one does not compete with it for the wake up
+    return ResponseSchema(
+        success=True,
+        status_code=202,
+        message="Email is being sent.",
+        data={"request_id": request_id, "status_url": f"/api/email/send-status/{request_id}"}
+    )
+
+
+@email_router.get("/send-status/{request_id}")
+async def get_send_status(request_id: str, jwt_payload: dict[str] = Depends(authenticate_request), redis_connection: Redis = Depends(get_redis_connection)):
+    """
+    Endpoint to check on a send-email-now request that was still running when the request returned.
     """
+    send_request = await get_send_request(redis_connection, request_id)
 
-    return send_gmail_service(email_object=email_object, user_id=jwt_payload.get("sub"), db_connection=db_connection)
+    if send_request is None or send_request["user_id"] != str(jwt_payload.get("sub")):
+        return ResponseSchema(
+            success=False,
+            status_code=404,
+            message=f"Send request {request_id} not found.",
+            data={}
+        )
 
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message="Send status retrieved successfully.",
+        data={"request_id": request_id, "status": send_request["status"], "result": send_request.get("result")}
+    )
@@ -0,0 +1,56 @@
+import asyncio
+
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
+
+from app.auth.dependency_auth import authenticate_request, authenticate_events_request, create_events_token
+from app.pydantic_schemas.response_pydantic import ResponseSchema
+from app.services.event_services import event_broadcaster
+from app.utils.config import settings
+
+event_router = APIRouter(
+    prefix="/api/events",
+    tags=["Events"]
+)
+
+@event_router.post("/token")
+async def get_events_token(jwt_payload: dict = Depends(authenticate_request)):
+    """
+    Endpoint to get a short-lived token for opening the events stream with EventSource, which can not send the Bearer
+    header: GET /api/events/stream?token=... The token is only checked when the stream is opened.
+    """
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message="Events token created successfully.",
+        data={"token": create_events_token(jwt_payload.get("sub")), "expires_in_seconds": settings.EVENTS_TOKEN_EXPIRATION_SECONDS}
+    )
+
+@event_router.get("/stream")
+async def stream_events(request: Request, jwt_payload: dict = Depends(authenticate_events_request)):
+    """
+    Server-sent events stream of the authenticated user's send progress (sent, failed and dead emails).
+    Replaces polling get-email-queue while a campaign is running. Authenticated with the token query parameter
+    (from /api/events/token) or the Bearer header.
+    """
+    user_id = jwt_payload.get("sub")
+
+    async def event_stream():
+        async with event_broadcaster.subscribe(user_id) as event_queue:
+            #tell the browser how long to wait before reconnecting a dropped stream
+            yield "retry: 3000\n\n"
+
+            while not await request.is_disconnected():
+                try:
+                    event_data = await asyncio.wait_for(event_queue.get(), timeout=settings.EVENTS_HEARTBEAT_SECONDS)
+                    yield f"data: {event_data}\n\n"
+
+                except asyncio.TimeoutError:
+                    #comment line keeps proxies and load balancers from closing an idle stream
+                    yield ": heartbeat\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
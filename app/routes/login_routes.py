@@ -12,6 +12,7 @@ from app.pydantic_schemas.login_pydantic import LoginSchema
 from app.pydantic_schemas.response_pydantic import ResponseSchema
 from app.pydantic_schemas.signup_pydantic import SignUpSchema
 from app.pydantic_schemas.template_pydantic import TemplateSchema
+from app.services.cache_services import write_cache
 from app.utils.utils import verify_string, serialize_for_redis, encrypt_string
 
 login_router = APIRouter(
@@ -39,15 +40,14 @@ async def login(login_data: LoginSchema, db_connection: Session = Depends(get_db
 
     #cache all the user templates as soon as they login to prevent future database queries for templates
     redis_template_key = f"user:{user.uid}:templates"
-    redis_pipeline = redis_connection.pipeline()
 
-    for template in user.templates:
-        template_data = TemplateSchema.model_validate(template).model_dump()
-        await redis_pipeline.hset(redis_template_key, template.template_id, serialize_for_redis(template_data))
+    user_templates = {
+        str(template.template_id): serialize_for_redis(TemplateSchema.model_validate(template).model_dump())
+        for template in user.templates
+    }
 
-    await redis_pipeline.hset("user_name", user.uid, user.name)
-    await redis_pipeline.expire(redis_template_key, 60 * 90)
-    redis_pipeline.execute()
+    await write_cache(redis_connection, redis_template_key, "hash", user_templates)
+    await redis_connection.hset("user_name", user.uid, user.name)
 
     json_response = JSONResponse(
         content= ResponseSchema(
@@ -0,0 +1,26 @@
+from fastapi import APIRouter, Depends
+from redis.asyncio import Redis
+
+from app.auth.dependency_auth import authenticate_request
+from app.db.redisConnection import get_redis_connection
+from app.pydantic_schemas.response_pydantic import ResponseSchema
+from app.services.metrics_services import read_counters
+
+metrics_router = APIRouter(
+    prefix="/api/metrics",
+    tags=["Metrics"]
+)
+
+@metrics_router.get("/counters")
+async def get_counters(jwt_payload: dict = Depends(authenticate_request), redis_connection: Redis = Depends(get_redis_connection)):
+    """
+    Endpoint to read the shared operational counters (cache hits, coalesced misses, ...) grouped by subsystem. Per-user
+    counters are only returned for the user making the request.
+    """
+
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message="Counters retrieved successfully.",
+        data={"counters": await read_counters(redis_connection, jwt_payload.get("sub"))}
+    )
@@ -1,29 +1,123 @@
-import secrets
 from typing import Literal
 from urllib.parse import urlencode, parse_qs
 
-import google.oauth2.credentials
-import google_auth_oauthlib.flow
-import googleapiclient.discovery
-
-from fastapi.responses import RedirectResponse, HTMLResponse
+from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse
 from fastapi import APIRouter, Request, HTTPException, Depends
-from google.auth.transport.requests import AuthorizedSession
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 
-from app.routes.constant_routes import GOOGLE_CLIENT_SECRETS_FILE, SCOPES, REDIRECT_URI
-
-from app.auth.dependency_auth import create_jwt_token, create_jwt_refresh_token
-from app.utils.utils import credentials_to_dict
-from app.db.dbConnection import SessionLocal, get_db_session
+from app.auth.dependency_auth import create_jwt_refresh_token, authenticate_request
+from app.db.dbConnection import get_db_session
 from app.models.user_models import User
 from app.models.user_token_models import UserToken
+from app.pydantic_schemas.response_pydantic import ResponseSchema
+from app.services.oauth_services import build_authorization_url, exchange_authorization_code, fetch_google_userinfo, \
+    OAuthExchangeError
+from app.services.token_services import forget_google_token, create_gmail_connect_request, pop_gmail_connect_request
+from app.utils.config import settings
 
 oauth_router = APIRouter(
     prefix="/api/oauth",
     tags=["OAuth"]
 )
 
+def _build_authorization_url(request: Request, custom_state: str, prompt: str) -> tuple[str, str]:
+    # The URI created here must exactly match one of the authorized redirect URIs
+    # for the OAuth 2.0 client, which you configured in the API Console. If this
+    # value doesn't match an authorized URI, you will get a 'redirect_uri_mismatch'
+    # error.
+    redirect_uri = str(request.base_url) + "api/oauth/oauth2callback"
+
+    return build_authorization_url(redirect_uri, custom_state, prompt), custom_state
+
+
+def _store_user_token(db_connection: Session, user_id: int, sender_email: str, credentials_dict: dict) -> UserToken:
+    """
+    Insert or update the token of one connected gmail account of a user. Tokens stored before accounts had an address
+    are taken over by the first account that is authorized again.
+    """
+    token_record = db_connection.query(UserToken).filter(
+        UserToken.uid == user_id, or_(UserToken.sender_email == sender_email, UserToken.sender_email.is_(None))
+    ).order_by(UserToken.sender_email.is_(None)).first()
+
+    if token_record:
+        token_record.access_token = credentials_dict["token"]
+        token_record.expires_at = credentials_dict["expiry"]
+        token_record.sender_email = sender_email
+
+        if "refresh_token" in credentials_dict and credentials_dict["refresh_token"] is not None:
+            token_record.refresh_token = credentials_dict["refresh_token"]
+
+    else:
+        token_record = UserToken(access_token=credentials_dict['token'],
+                                 refresh_token=credentials_dict['refresh_token'],
+                                 token_type='Google',
+                                 expires_at=credentials_dict['expiry'],
+                                 sender_email=sender_email,
+                                 uid=user_id)
+
+        db_connection.add(token_record)
+
+    return token_record
+
+
+def _complete_oauth_login(db_connection: Session, purpose: str, connect_id: str, userinfo: dict, credentials_dict: dict) -> str | None:
+    """
+    Create the user (signup) or store the gmail tokens of the google account (authorize, connect) once google accepted
+    the authorization code.
+
+    :return: the new jwt refresh token for signup, None otherwise.
+    """
+    existing_user = db_connection.query(User).filter(User.email == userinfo['email']).first()
+
+    if purpose == "signup":
+
+        if existing_user:
+            raise HTTPException(status_code=400, detail="User already exists. Please log in.")
+
+        new_user = User(name=userinfo['name'], email=userinfo['email'], password="oauth_google", resume=None, cover_letter=None)
+
+        db_connection.add(new_user)
+
+        db_connection.flush()
+
+        fresh_jwt_refresh_token = create_jwt_refresh_token(data=new_user.uid)
+
+        db_connection.query(User).filter(User.uid == new_user.uid).update({User.jwt_refresh_token: fresh_jwt_refresh_token})
+
+
+        #store the user tokens in the db
+        _store_user_token(db_connection, new_user.uid, userinfo['email'], credentials_dict)
+
+        db_connection.commit()
+
+        return fresh_jwt_refresh_token
+
+    if purpose == "authorize":
+        if not existing_user:
+            raise HTTPException(status_code=404, detail="User not found. Please sign up first.")
+
+        user_id = existing_user.uid
+
+    else:
+        connect_user_id = pop_gmail_connect_request(connect_id)
+
+        if connect_user_id is None:
+            raise HTTPException(status_code=400, detail="Connect request expired. Please try again.")
+
+        user_id = int(connect_user_id)
+
+    token_record = _store_user_token(db_connection, user_id, userinfo['email'], credentials_dict)
+
+    db_connection.commit()
+
+    #the cached token belongs to the old grant
+    forget_google_token(token_record.token_id)
+
+    return None
+
+
 # this method is used when the frontend requests for sign-in using google or when the user wants to give access to google
 # this method will only create the google oauth consent url, include all the information about the client (app), redirects etc
 # this method will return the google consent url to the frontend, which will redirect the user to the google consent page
@@ -38,27 +132,7 @@ async def gmail_authorize(request: Request, purpose: Literal["signup", "authoriz
     if purpose not in ("signup", "authorize"):
         raise HTTPException(400, "Invalid purpose in state.")
 
-    # Create flow instance to manage the OAuth 2.0 Authorization Grant Flow steps.
-    flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(
-        GOOGLE_CLIENT_SECRETS_FILE, scopes=SCOPES, redirect_uri=REDIRECT_URI)
-
-    # The URI created here must exactly match one of the authorized redirect URIs
-    # for the OAuth 2.0 client, which you configured in the API Console. If this
-    # value doesn't match an authorized URI, you will get a 'redirect_uri_mismatch'
-    # error.
-    flow.redirect_uri = str(request.base_url) + "api/oauth/oauth2callback"
-
-    custom_state = urlencode({"purpose": purpose})
-
-    authorization_url, state = flow.authorization_url(
-        # Enable offline access so that you can refresh an access token without
-        # re-prompting the user for permission. Recommended for web server apps.
-        access_type='offline',
-        state=custom_state,
-        # Enable incremental authorization. Recommended as a best practice.
-        include_granted_scopes='true',
-        prompt='consent' if purpose == "signup" else 'select_account',
-    )
+    authorization_url, state = _build_authorization_url(request, urlencode({"purpose": purpose}), prompt='consent' if purpose == "signup" else 'select_account')
 
     # Store the state so the callback can verify the auth server response.
     response = RedirectResponse(url=authorization_url)
@@ -72,8 +146,39 @@ async def gmail_authorize(request: Request, purpose: Literal["signup", "authoriz
     return response
 
 
+# connecting another gmail account to send from is started by a logged in user, so the user is known from the jwt and
+# not from the google account. The connect id in the state points to the user and only works once.
+@oauth_router.get("/gmail-connect")
+async def gmail_connect(request: Request, jwt_payload: dict = Depends(authenticate_request)):
+    """
+    Endpoint to connect an additional gmail account to send from. Returns the google consent url to redirect the user to.
+    """
+    connect_id = await run_in_threadpool(create_gmail_connect_request, jwt_payload.get("sub"))
+
+    authorization_url, state = _build_authorization_url(request, urlencode({"purpose": "connect", "connect_id": connect_id}), prompt='consent select_account')
+
+    #the callback only accepts the connect id of the browser that started the connect, so a consent url of another
+    #user can not store a victim's gmail token under that user. The frontend has to call this with credentials included
+    response = JSONResponse(content=ResponseSchema(
+        success=True,
+        status_code=200,
+        message="Gmail connect url created successfully.",
+        data={"authorization_url": authorization_url}
+    ).model_dump())
+    response.set_cookie(
+        key="gmail_connect_id",
+        value=connect_id,
+        max_age=settings.GMAIL_CONNECT_TTL_SECONDS,
+        httponly=True,
+        secure=False,  #TODO: Set to True in production
+        samesite="lax"  #sent on the top level redirect back from google, Strict would drop it
+    )
+
+    return response
+
+
 @oauth_router.get('/oauth2callback', name='oauth2callback')
-def oauth2callback(request: Request, db_connection: Session = Depends(get_db_session)):
+async def oauth2callback(request: Request, db_connection: Session = Depends(get_db_session)):
     #mention the state when creating the flow in the callback so that it can
     # verified in the authorization server response.
     returned_state = request.query_params.get('state')
@@ -82,71 +187,44 @@ def oauth2callback(request: Request, db_connection: Session = Depends(get_db_ses
 
     if login_error in ("consent_required", "login_required", "interaction_required"):
         signup_url = str(request.base_url) + "api/oauth/gmail-authorize?purpose=signup"
-        print(signup_url)
         return RedirectResponse(url=signup_url, status_code=302)
 
-    if returned_state != stored_state:
-        raise HTTPException(status_code=400, detail="State mismatch. Possible CSRF attack.")
-
-    parsed_state = parse_qs(returned_state)
+    parsed_state = parse_qs(returned_state or "")
 
     if "purpose" not in parsed_state:
         raise HTTPException(status_code=400, detail="Missing 'purpose' in state.")
 
     purpose = parsed_state.get("purpose")[0]
+    connect_id = parsed_state.get("connect_id", [""])[0]
 
-    flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(
-        GOOGLE_CLIENT_SECRETS_FILE, scopes=SCOPES, state=returned_state)
-
-    flow.redirect_uri = str(request.base_url) + "api/oauth/oauth2callback"
-
-    # Use the authorization server's response to fetch the OAuth 2.0 tokens.
-    authorization_response = str(request.url)
+    if purpose not in ("signup", "authorize", "connect"):
+        raise HTTPException(status_code=400, detail="Invalid purpose in state.")
 
-    flow.fetch_token(authorization_response=authorization_response)
+    if purpose == "connect":
+        #a connect request is verified by its one time connect id, which has to be the one of this browser
+        if not connect_id or connect_id != request.cookies.get("gmail_connect_id"):
+            raise HTTPException(status_code=400, detail="State mismatch. Possible CSRF attack.")
 
-    # Store credentials in the session.
-    # ACTION ITEM: In a production app, you likely want to save these
-    #              credentials in a persistent database instead.
-    credentials = flow.credentials
+    elif returned_state != stored_state:
+        raise HTTPException(status_code=400, detail="State mismatch. Possible CSRF attack.")
 
-    credentials_dict = credentials_to_dict(credentials)
-    print(credentials_dict)
+    if "code" not in request.query_params:
+        raise HTTPException(status_code=400, detail="Missing authorization code.")
 
+    # Use the authorization server's response to fetch the OAuth 2.0 tokens, without blocking a threadpool thread
+    # on google while many users log in at once.
+    try:
+        credentials_dict = await exchange_authorization_code(request.query_params["code"], str(request.base_url) + "api/oauth/oauth2callback")
+        userinfo = await fetch_google_userinfo(credentials_dict["token"])
 
-    authed_session = AuthorizedSession(credentials)
-    userinfo = authed_session.get("https://www.googleapis.com/oauth2/v2/userinfo").json()
+    except OAuthExchangeError as e:
+        raise HTTPException(status_code=400, detail="Google authorization failed. Please try again.") from e
 
-    existing_user = db_connection.query(User).filter(User.email == userinfo['email']).first()
+    #the db session and the redis client are sync, so the rest of the login runs on the threadpool and not on the event loop
+    fresh_jwt_refresh_token = await run_in_threadpool(_complete_oauth_login, db_connection, purpose, connect_id, userinfo, credentials_dict)
 
     if purpose == "signup":
 
-        if existing_user:
-            raise HTTPException(status_code=400, detail="User already exists. Please log in.")
-
-        new_user = User(name=userinfo['name'], email=userinfo['email'], password="oauth_google", resume=None, cover_letter=None)
-
-        db_connection.add(new_user)
-
-        db_connection.flush()
-
-        fresh_jwt_refresh_token = create_jwt_refresh_token(data=new_user.uid)
-
-        db_connection.query(User).filter(User.uid == new_user.uid).update({User.jwt_refresh_token: fresh_jwt_refresh_token})
-
-
-        #store the user tokens in the db
-        new_user_token = UserToken(access_token=credentials_dict['token'],
-                                       refresh_token=credentials_dict['refresh_token'],
-                                       token_type='Google',
-                                       expires_at=credentials_dict['expiry'],
-                                       uid=new_user.uid)
-
-        db_connection.add(new_user_token)
-
-        db_connection.commit()
-
-
         # redirected_response = RedirectResponse(
         #     url="http://localhost:5173/dashboard",
         #     status_code=302
@@ -170,31 +248,9 @@ def oauth2callback(request: Request, db_connection: Session = Depends(get_db_ses
 
         return redirected_response
 
-    elif purpose == "authorize":
-        if not existing_user:
-            raise HTTPException(status_code=404, detail="User not found. Please sign up first.")
-
-        token_record = db_connection.query(UserToken).filter(UserToken.uid == existing_user.uid).first()
-
-        if token_record:
-            token_record.access_token = credentials_dict["token"]
-            token_record.expires_at = credentials_dict["expiry"]
+    redirected_response = RedirectResponse(url="http://localhost:5173/dashboard")
 
-            if "refresh_token" in credentials_dict and credentials_dict["refresh_token"] is not None:
-                token_record.refresh_token = credentials_dict["refresh_token"]
+    if purpose == "connect":
+        redirected_response.delete_cookie("gmail_connect_id")
 
-        else:
-            new_user_token = UserToken(access_token=credentials_dict['token'],
-                                       refresh_token=credentials_dict['refresh_token'],
-                                       token_type='Google',
-                                       expires_at=credentials_dict['expiry'],
-                                       uid=existing_user.uid)
-
-            db_connection.add(new_user_token)
-
-        db_connection.commit()
-
-        return RedirectResponse(url="http://localhost:5173/dashboard")
-
-    else:
-        raise HTTPException(status_code=400, detail="Invalid purpose in state.")
+    return redirected_response
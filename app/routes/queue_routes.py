@@ -4,7 +4,7 @@ from datetime import datetime
 from email.policy import default
 from typing import List
 
-from fastapi import APIRouter, Depends, Body
+from fastapi import APIRouter, Depends, Body, Request, Response, Header
 from redis.asyncio.client import Pipeline
 from sqlalchemy.orm import Session
 from redis.asyncio import Redis
@@ -15,6 +15,12 @@ from app.auth.dependency_auth import authenticate_request
 from app.db.dbConnection import get_db_session
 from app.db.redisConnection import get_redis_connection
 from app.pydantic_schemas.response_pydantic import ResponseSchema
+from app.services.attachment_services import get_user_attachments
+from app.services.cache_services import get_or_fill_cache
+from app.services.campaign_services import create_campaign
+from app.services.idempotency_services import claim_idempotency_key, store_idempotent_response, release_idempotency_key
+from app.services.version_services import queue_version_key, get_version, record_changes, build_etag, etag_matches, \
+    set_etag_headers, not_modified_response
 from app.tasks.celery_tasks import send_emails_from_user_queue
 from app.utils.utils import generate_eid
 
@@ -24,15 +30,23 @@ queue_router = APIRouter(
 )
 
 @queue_router.get("/get-email-queue")
-async def get_email_queue(jwt_payload: dict = Depends(authenticate_request),
+async def get_email_queue(request: Request, response: Response,
+                    jwt_payload: dict = Depends(authenticate_request),
                     db_connection: Session = Depends(get_db_session),
                     redis_connection: Redis = Depends(get_redis_connection)):
     """
     Endpoint to get the email queue for the authenticated user.
+    Supports conditional requests, a matching If-None-Match returns 304 without reading the queue.
     """
 
     user_id = jwt_payload.get("sub")
 
+    #read the version before the data, so the etag can only ever be older than the payload it is sent with
+    queue_etag = build_etag(queue_version_key(user_id), await get_version(redis_connection, queue_version_key(user_id)))
+
+    if etag_matches(request, queue_etag):
+        return not_modified_response(queue_etag)
+
     user = db_connection.query(User).filter(User.uid == user_id).first()
 
     if not user:
@@ -44,57 +58,82 @@ async def get_email_queue(jwt_payload: dict = Depends(authenticate_request),
         )
 
     redis_email_queue_key = f"email_queue:{user_id}"
-    email_queue = await redis_connection.lrange(redis_email_queue_key, 0, -1)
-
-    if email_queue:
-
-        emails = [json.loads(email) for email in email_queue]
-
-        await redis_connection.expire(redis_email_queue_key, 90*60) #extend the expiry time of the email queue because it was recently used
-
-        return ResponseSchema(
-            success=True,
-            status_code=200,
-            message="Email queue retrieved successfully from Redis.",
-            data={"queue_length": len(emails), "emails": emails}
-        )
+    from_email = user.email
 
-    else:
+    def load_email_queue(db_session: Session) -> list[str]:
         #searching in db
-        email_queue = db_connection.query(Email).filter((Email.uid == user_id) & (Email.is_sent == False)).all()
+        unsent_emails = db_session.query(Email).filter((Email.uid == user_id) & (Email.is_sent == False)).all()
 
-        #add the emails to redis for future requests
         email_list = []
-
-        for email in email_queue:
+        for email in unsent_emails:
             email_dict = EmailSchema.model_validate(email, from_attributes=True).model_dump()
-            email_dict["from_email"] = user.email
+            email_dict["from_email"] = from_email
 
             if isinstance(email_dict.get("send_at"), datetime):
                 email_dict["send_at"] = email_dict["send_at"].isoformat()
 
-            await redis_connection.rpush(redis_email_queue_key, json.dumps(email_dict))
-            email_list.append(email_dict)
+            email_list.append(json.dumps(email_dict))
 
-        await redis_connection.expire(redis_email_queue_key, 90*60)
+        return email_list
 
-        return ResponseSchema(
-            success=True,
-            status_code=200,
-            message="Email queue retrieved successfully from DB (not found in Redis).",
-            data={"queue_length": len(email_list), "emails": email_list}
-        )
+    email_queue, cache_source = await get_or_fill_cache(redis_connection=redis_connection,
+                                                        cache_key=redis_email_queue_key,
+                                                        kind="list",
+                                                        loader=load_email_queue,
+                                                        db_connection=db_connection,
+                                                        version_key=queue_version_key(user_id))
+
+    emails = [json.loads(email) for email in email_queue]
+
+    set_etag_headers(response, queue_etag)
+
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message="Email queue retrieved successfully from DB (not found in Redis)." if cache_source == "db" else "Email queue retrieved successfully from Redis.",
+        data={"queue_length": len(emails), "emails": emails}
+    )
 
 
 @queue_router.post("/add-to-queue")
 async def add_to_queue(email: EmailSchema, jwt_payload: dict = Depends(authenticate_request),
                  db_connection: Session = Depends(get_db_session),
-                 redis_connection: Redis = Depends(get_redis_connection)):
+                 redis_connection: Redis = Depends(get_redis_connection),
+                 idempotency_key: str | None = Header(default=None, alias="Idempotency-Key")):
     """
     Endpoint to add an email to the processing queue.
+    A client that retries with the same Idempotency-Key gets the first response back instead of queueing the email twice.
     """
     user_id = jwt_payload.get("sub")
 
+    if idempotency_key is not None:
+        stored_record = await claim_idempotency_key(redis_connection, user_id, "add_to_queue", idempotency_key, {"status": "pending"})
+
+        if stored_record is not None and "response" in stored_record:
+            return ResponseSchema(**stored_record["response"])
+
+        if stored_record is not None:
+            return ResponseSchema(
+                success=False,
+                status_code=409,
+                message="A request with this Idempotency-Key is still being processed.",
+                data={}
+            )
+
+    try:
+        response = await _add_email_to_queue(email, user_id, db_connection, redis_connection)
+
+    except Exception:
+        if idempotency_key is not None:
+            await release_idempotency_key(redis_connection, user_id, "add_to_queue", idempotency_key)
+        raise
+
+    if idempotency_key is not None:
+        await store_idempotent_response(redis_connection, user_id, "add_to_queue", idempotency_key, response.model_dump())
+
+    return response
+
+async def _add_email_to_queue(email: EmailSchema, user_id: str, db_connection: Session, redis_connection: Redis) -> ResponseSchema:
     user = db_connection.query(User).filter(User.uid == user_id).first()
 
     if not user:
@@ -105,6 +144,14 @@ async def add_to_queue(email: EmailSchema, jwt_payload: dict = Depends(authentic
             data={}
         )
 
+    if email.attachment_ids and len(get_user_attachments(db_connection, user_id, email.attachment_ids)) != len(set(email.attachment_ids)):
+        return ResponseSchema(
+            success=False,
+            status_code=400,
+            message="Unknown attachment.",
+            data={}
+        )
+
     redis_email_queue_key = f"email_queue:{user.uid}"     #this hash value will act as a pointer to the email queue for each user
 
     email_dict = email.model_dump()
@@ -121,6 +168,7 @@ async def add_to_queue(email: EmailSchema, jwt_payload: dict = Depends(authentic
 
     pushed_lenght = await redis_connection.rpush(redis_email_queue_key, json.dumps(email_dict))
     await redis_connection.expire(redis_email_queue_key, 90*60)
+    await record_changes(redis_connection, queue_version_key(user_id), [{"op": "add", "id": new_email.eid, "data": json.dumps(email_dict)}])
 
     return ResponseSchema(
         success=True,
@@ -149,13 +197,15 @@ async def send_queued_emails(email_ids: List[int] = Body(...),
             data={}
         )
 
-    send_emails_from_user_queue.delay(user_id, email_ids)
+    campaign_id = await create_campaign(redis_connection, user_id, email_ids)
+
+    send_emails_from_user_queue.delay(user_id, email_ids, campaign_id, 1)
 
     return ResponseSchema(
         success=True,
         status_code=200,
         message=f"{len(email_ids)} emails added to background worker successfully.",
-        data={"sent_emails": email_ids}
+        data={"sent_emails": email_ids, "campaign_id": campaign_id}
     )
 
 @queue_router.delete("/delete-queue-email")
@@ -199,6 +249,7 @@ async def delete_queue_email(email_ids: List[int] = Body(...),
 
     redis_pipeline.expire(redis_email_queue_key, 90*60)
     await redis_pipeline.execute()
+    await record_changes(redis_connection, queue_version_key(user_id), [{"op": "delete", "id": eid} for eid in email_ids])
 
     return ResponseSchema(
         success=True,
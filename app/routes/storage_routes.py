@@ -1,13 +1,18 @@
 import os.path
 
+from typing import List
+
 from fastapi import APIRouter, Depends, File, UploadFile
 from sqlalchemy.orm import Session
 
 from app.auth.dependency_auth import authenticate_request
 from app.db.dbConnection import get_db_session
-from app.models import User
+from app.models import User, Attachment
 from app.pydantic_schemas.response_pydantic import ResponseSchema
-from app.services.storage_service import upload_file_to_storage
+from app.pydantic_schemas.storage_pydantic import DirectUploadSchema, DirectUploadCompleteSchema
+from app.services.circuit_breaker_services import CircuitOpenError
+from app.services.attachment_services import store_attachment, create_direct_upload, complete_direct_upload
+from app.utils.config import settings
 from app.utils.utils import sanitize_filename_base
 
 storage_router = APIRouter(
@@ -50,51 +55,253 @@ def upload_file(uploaded_file: UploadFile = File(...), filecontent: str = "resum
             data={}
         )
 
-    temp_storage_dir = "temp"
-    os.makedirs(temp_storage_dir, exist_ok=True)
+    try:
+        #the resume is an attachment like any other, uploading the same pdf again does not store it again
+        attachment, deduplicated = store_attachment(db_connection, user_id, file_bytes,
+                                                    filename=f"{sanitize_filename_base(name=user.name)}_resume.pdf",
+                                                    content_type="application/pdf")
 
-    new_file_name = f"{user_id}_{sanitize_filename_base(name=user.name)}.pdf"
+        if attachment is None:
+            return ResponseSchema(
+                success=False,
+                status_code=500,
+                message="File upload failed.",
+                data={}
+            )
 
-    temp_file_path = os.path.join(temp_storage_dir, new_file_name)
+        user.resume = attachment.object_url
 
-    with open(temp_file_path, "wb") as temp_file:
-        temp_file.write(file_bytes)
+        db_connection.commit()
+
+        return ResponseSchema(
+            success=True,
+            status_code=200,
+            message="File uploaded successfully.",
+            data={"attachment_id": attachment.attachment_id, "deduplicated": deduplicated}
+        )
+
+    except CircuitOpenError as e:
+        return ResponseSchema(
+            success=False,
+            status_code=503,
+            message="File storage is temporarily unavailable, please try again later.",
+            data={"retry_in_ms": e.retry_after_ms}
+        )
+
+    except Exception as e:
+        print(f"Error uploading file: {str(e)}")
+        return ResponseSchema(
+            success=False,
+            status_code=500,
+            message="An error occurred while uploading the file",
+            data={"Error": str(e)}
+        )
+
+@storage_router.post("/attachments")
+def upload_attachments(uploaded_files: List[UploadFile] = File(...), jwt_payload: dict = Depends(authenticate_request), db_connection: Session = Depends(get_db_session)):
+    """
+    Endpoint to upload one or more attachments. Files are stored by their SHA-256, a file the user already uploaded is
+    not stored again (deduplicated). Emails reference the returned attachment ids in attachment_ids.
+    """
+    user_id = jwt_payload.get("sub")
+
+    for uploaded_file in uploaded_files:
+        if uploaded_file.content_type not in settings.ATTACHMENT_CONTENT_TYPES:
+            return ResponseSchema(
+                success=False,
+                status_code=400,
+                message=f"File type {uploaded_file.content_type} is not allowed.",
+                data={"allowed_content_types": settings.ATTACHMENT_CONTENT_TYPES}
+            )
+
+    uploaded_attachments = []
 
     try:
+        for uploaded_file in uploaded_files:
+            file_bytes = uploaded_file.file.read()
 
-        file_url = upload_file_to_storage(file_path=temp_file_path)
+            if len(file_bytes) > settings.ATTACHMENT_MAX_BYTES:
+                return ResponseSchema(
+                    success=False,
+                    status_code=400,
+                    message=f"File {uploaded_file.filename} exceeds the maximum size of {settings.ATTACHMENT_MAX_BYTES} bytes.",
+                    data={"attachments": uploaded_attachments}
+                )
 
-        print(f"File URL: {file_url}")
+            attachment, deduplicated = store_attachment(db_connection, user_id, file_bytes,
+                                                        filename=os.path.basename(uploaded_file.filename or "attachment"),
+                                                        content_type=uploaded_file.content_type)
 
-        if file_url != "upload_failed":
+            if attachment is None:
+                return ResponseSchema(
+                    success=False,
+                    status_code=500,
+                    message=f"Upload of {uploaded_file.filename} failed.",
+                    data={"attachments": uploaded_attachments}
+                )
 
-            user.resume = file_url
+            uploaded_attachments.append({**_attachment_data(attachment), "deduplicated": deduplicated})
 
-            db_connection.commit()
+    except CircuitOpenError as e:
+        return ResponseSchema(
+            success=False,
+            status_code=503,
+            message="File storage is temporarily unavailable, please try again later.",
+            data={"retry_in_ms": e.retry_after_ms, "attachments": uploaded_attachments}
+        )
 
-            os.remove(temp_file_path)
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message="Attachments uploaded successfully.",
+        data={"attachments": uploaded_attachments}
+    )
 
-            return ResponseSchema(
-                success=True,
-                status_code=200,
-                message="File uploaded successfully.",
-                data={}
-            )
+@storage_router.get("/attachments")
+def list_attachments(jwt_payload: dict = Depends(authenticate_request), db_connection: Session = Depends(get_db_session)):
+    """
+    Endpoint to list the user's attachments.
+    """
+    user_id = jwt_payload.get("sub")
 
-        os.remove(temp_file_path)
+    attachments = db_connection.query(Attachment).filter(Attachment.uid == user_id).order_by(Attachment.attachment_id).all()
 
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message="Attachments retrieved successfully.",
+        data={"attachments": [_attachment_data(attachment) for attachment in attachments]}
+    )
+
+@storage_router.post("/upload-url")
+def create_upload_url(upload: DirectUploadSchema, jwt_payload: dict = Depends(authenticate_request), db_connection: Session = Depends(get_db_session)):
+    """
+    Endpoint to start a direct upload: returns a short lived signed url the client PUTs the file to, so the file never
+    passes through the api. The upload has to be finished with /upload-complete within expires_in_seconds.
+    """
+    user_id = jwt_payload.get("sub")
+
+    allowed_content_types = ["application/pdf"] if upload.purpose == "resume" else settings.ATTACHMENT_CONTENT_TYPES
+
+    if upload.content_type not in allowed_content_types:
         return ResponseSchema(
             success=False,
-            status_code=500,
-            message="File upload failed.",
+            status_code=400,
+            message=f"File type {upload.content_type} is not allowed.",
+            data={"allowed_content_types": allowed_content_types}
+        )
+
+    if upload.size > settings.ATTACHMENT_MAX_BYTES:
+        return ResponseSchema(
+            success=False,
+            status_code=400,
+            message=f"File exceeds the maximum size of {settings.ATTACHMENT_MAX_BYTES} bytes.",
             data={}
         )
 
-    except Exception as e:
-        print(f"Error uploading file: {str(e)}")
+    try:
+        direct_upload = create_direct_upload(db_connection, user_id, os.path.basename(upload.filename), upload.content_type,
+                                             upload.size, upload.sha256, upload.purpose)
+
+    except CircuitOpenError as e:
+        return ResponseSchema(
+            success=False,
+            status_code=503,
+            message="File storage is temporarily unavailable, please try again later.",
+            data={"retry_in_ms": e.retry_after_ms}
+        )
+
+    if direct_upload is None:
         return ResponseSchema(
             success=False,
             status_code=500,
-            message=f"An error occurred while uploading the file",
-            data={"Error": str(e)}
+            message="Failed to create the upload url.",
+            data={}
+        )
+
+    if "attachment" in direct_upload:
+        #the user already uploaded this file, nothing to transfer
+        attachment = direct_upload["attachment"]
+        _set_resume(db_connection, user_id, upload.purpose, attachment)
+
+        return ResponseSchema(
+            success=True,
+            status_code=200,
+            message="File already uploaded.",
+            data={"attachment": {**_attachment_data(attachment), "deduplicated": True}}
+        )
+
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message="Upload url created successfully.",
+        data=direct_upload
+    )
+
+@storage_router.post("/upload-complete")
+def complete_upload(upload_complete: DirectUploadCompleteSchema, jwt_payload: dict = Depends(authenticate_request), db_connection: Session = Depends(get_db_session)):
+    """
+    Endpoint the client calls once its direct upload finished. The stored object is checked against the size and type
+    the upload was started with before it becomes an attachment (and the user's resume for purpose resume).
+    """
+    user_id = jwt_payload.get("sub")
+
+    try:
+        attachment, purpose, error = complete_direct_upload(db_connection, user_id, upload_complete.upload_id)
+
+    except CircuitOpenError as e:
+        return ResponseSchema(
+            success=False,
+            status_code=503,
+            message="File storage is temporarily unavailable, please try again later.",
+            data={"retry_in_ms": e.retry_after_ms}
+        )
+
+    if error == "upload_not_found":
+        return ResponseSchema(
+            success=False,
+            status_code=404,
+            message="Upload not found or expired.",
+            data={}
+        )
+
+    if error == "upload_missing":
+        return ResponseSchema(
+            success=False,
+            status_code=409,
+            message="The file was not uploaded yet.",
+            data={}
+        )
+
+    if error == "upload_mismatch":
+        return ResponseSchema(
+            success=False,
+            status_code=400,
+            message="The uploaded file does not match the size or type of the upload.",
+            data={}
         )
+
+    _set_resume(db_connection, user_id, purpose, attachment)
+
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message="File uploaded successfully.",
+        data={"attachment": _attachment_data(attachment)}
+    )
+
+def _set_resume(db_connection: Session, user_id: str, purpose: str, attachment: Attachment) -> None:
+    if purpose != "resume":
+        return
+
+    db_connection.query(User).filter(User.uid == user_id).update({User.resume: attachment.object_url})
+    db_connection.commit()
+
+def _attachment_data(attachment: Attachment) -> dict:
+    return {
+        "attachment_id": attachment.attachment_id,
+        "filename": attachment.filename,
+        "content_type": attachment.content_type,
+        "size": attachment.size,
+        "sha256": attachment.sha256
+    }
@@ -0,0 +1,44 @@
+from typing import Literal
+
+from fastapi import APIRouter, Depends
+from redis.asyncio import Redis
+
+from app.auth.dependency_auth import authenticate_request
+from app.db.redisConnection import get_redis_connection
+from app.pydantic_schemas.response_pydantic import ResponseSchema
+from app.services.version_services import queue_version_key, templates_version_key, read_changes_since
+
+sync_router = APIRouter(
+    prefix="/api/sync",
+    tags=["Sync"]
+)
+
+@sync_router.get("/changes")
+async def get_changes(resource: Literal["queue", "templates"], since_version: int,
+                      jwt_payload: dict = Depends(authenticate_request),
+                      redis_connection: Redis = Depends(get_redis_connection)):
+    """
+    Endpoint to get the add, update and delete events of the user's queue or templates since the version the client
+    last saw (the number in the ETag of get-email-queue / get-all-templates, or the version returned here).
+    If the change log no longer covers that version, full_reload is true and the client has to fetch the whole list.
+    """
+    user_id = jwt_payload.get("sub")
+
+    version_key = queue_version_key(user_id) if resource == "queue" else templates_version_key(user_id)
+
+    current_version, changes = await read_changes_since(redis_connection, version_key, since_version)
+
+    if changes is None:
+        return ResponseSchema(
+            success=True,
+            status_code=200,
+            message="Change log does not cover the requested version, full reload required.",
+            data={"version": current_version, "full_reload": True, "changes": []}
+        )
+
+    return ResponseSchema(
+        success=True,
+        status_code=200,
+        message=f"{len(changes)} changes since version {since_version}.",
+        data={"version": current_version, "full_reload": False, "changes": changes}
+    )
@@ -1,7 +1,7 @@
 from typing import List
 
 import redis
-from fastapi import APIRouter, Depends, Request, Body
+from fastapi import APIRouter, Depends, Request, Response, Body
 from sqlalchemy import delete
 from sqlalchemy.orm import Session
 
@@ -11,6 +11,9 @@ from app.db.redisConnection import get_redis_connection
 from app.models.template_models import Template
 from app.pydantic_schemas.response_pydantic import ResponseSchema
 from app.pydantic_schemas.template_pydantic import TemplateSchema
+from app.services.cache_services import get_or_fill_cache
+from app.services.version_services import templates_version_key, get_version, record_changes, build_etag, etag_matches, \
+    set_etag_headers, not_modified_response
 from app.utils.utils import serialize_for_redis, deserialize_from_redis
 
 template_router = APIRouter(
@@ -19,9 +22,10 @@ template_router = APIRouter(
 )
 
 @template_router.get("/get-all-templates")
-async def get_all_templates(jwt_payload: dict = Depends(authenticate_request), db_connection: Session = Depends(get_db_session), redis_connection: redis.Redis = Depends(get_redis_connection)):
+async def get_all_templates(request: Request, response: Response, jwt_payload: dict = Depends(authenticate_request), db_connection: Session = Depends(get_db_session), redis_connection: redis.Redis = Depends(get_redis_connection)):
     """
     Endpoint to get all templates for the authenticated user.
+    Supports conditional requests, a matching If-None-Match returns 304 without reading the templates.
     """
 
     user_id = jwt_payload.get("sub")
@@ -34,28 +38,40 @@ async def get_all_templates(jwt_payload: dict = Depends(authenticate_request), d
             data={}
         )
 
+    #read the version before the data, so the etag can only ever be older than the payload it is sent with
+    templates_etag = build_etag(templates_version_key(user_id), await get_version(redis_connection, templates_version_key(user_id)))
+
+    if etag_matches(request, templates_etag):
+        return not_modified_response(templates_etag)
+
     redis_template_key: str = f"user:{user_id}:templates"
-    redis_templates_cache = await redis_connection.hgetall(redis_template_key)
 
-    if len(redis_templates_cache) > 0:
-        return ResponseSchema(
-            status_code=200,
-            success=True,
-            message="Templates retrieved from Redis cache.",
-            data={"templates": list(deserialize_from_redis(redis_templates_cache).values())}
-        )
+    def load_templates(db_session: Session) -> dict[str, str]:
+        all_templates = db_session.query(Template).filter(Template.uid == user_id).all()
 
+        return {
+            str(template.template_id): serialize_for_redis(TemplateSchema.model_validate(template).model_dump())
+            for template in all_templates
+        }
 
-    all_templates = db_connection.query(Template).filter(Template.uid == user_id).all()
+    redis_templates_cache, cache_source = await get_or_fill_cache(redis_connection=redis_connection,
+                                                                  cache_key=redis_template_key,
+                                                                  kind="hash",
+                                                                  loader=load_templates,
+                                                                  db_connection=db_connection,
+                                                                  version_key=templates_version_key(user_id))
 
-    template_list = [TemplateSchema.model_validate(template).model_dump() for template in all_templates]
+    template_list = list(deserialize_from_redis(redis_templates_cache).values())
 
-    redis_pipeline = redis_connection.pipeline()
-    for template in template_list:
-        await redis_pipeline.hset(redis_template_key, template["template_id"], serialize_for_redis(template))
+    set_etag_headers(response, templates_etag)
 
-    await redis_pipeline.expire(redis_template_key, 60 * 90)
-    await redis_pipeline.execute()
+    if cache_source != "db":
+        return ResponseSchema(
+            status_code=200,
+            success=True,
+            message="Templates retrieved from Redis cache.",
+            data={"templates": template_list}
+        )
 
     return ResponseSchema(
         status_code=200,
@@ -82,9 +98,10 @@ async def add_template(template_data: TemplateSchema, jwt_payload: dict = Depend
     db_connection.commit()
 
     redis_template_key: str = f"user:{user_id}:templates"
-    redis_template_value: str = serialize_for_redis(new_template)
+    redis_template_value: str = serialize_for_redis(TemplateSchema.model_validate(new_template).model_dump())
     await redis_connection.hset(redis_template_key, str(new_template.template_id), redis_template_value)
     await redis_connection.expire(redis_template_key, 60 * 90)
+    await record_changes(redis_connection, templates_version_key(user_id), [{"op": "add", "id": new_template.template_id, "data": redis_template_value}])
 
     return ResponseSchema(
         status_code=201,
@@ -125,6 +142,7 @@ async def update_template(template_data: TemplateSchema, jwt_payload: dict = Dep
     )
     await redis_connection.hset(redis_template_key, str(update_template.template_id), redis_template_value)
     await redis_connection.expire(redis_template_key, 60 * 90)
+    await record_changes(redis_connection, templates_version_key(user_id), [{"op": "update", "id": update_template.template_id, "data": redis_template_value}])
 
     return ResponseSchema(
         status_code=200,
@@ -165,6 +183,7 @@ async def delete_template(template_ids: List[int] = Body(...), jwt_payload: dict
 
     await redis_pipeline.expire(redis_template_key, 60 * 90)
     await redis_pipeline.execute()
+    await record_changes(redis_connection, templates_version_key(user_id), [{"op": "delete", "id": template_id} for template_id in template_ids])
 
     return ResponseSchema(
         status_code=200,
@@ -0,0 +1,287 @@
+import hashlib
+import json
+import os.path
+import time
+import uuid
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.db.redisConnection import sync_redis_client
+from app.models import Attachment
+from app.services.circuit_breaker_services import CircuitOpenError
+from app.services.resumable_upload_services import upload_to_storage_resumable
+from app.services.storage_service import get_file_from_storage, upload_bytes_to_storage, storage_object_url, \
+    create_signed_upload_url, get_storage_object_info, delete_from_storage
+from app.utils.config import settings
+
+def attachment_object_name(sha256: str) -> str:
+    #content addressed, the same file content is one object no matter who uploaded it or how it is named
+    return f"attachments/{sha256}"
+
+def direct_upload_object_name(user_id: str | int, upload_id: str) -> str:
+    #the hash of a direct upload is only declared by the client, so it never takes a content addressed name
+    return f"uploads/{user_id}/{upload_id}"
+
+def direct_upload_key(upload_id: str) -> str:
+    return f"storage_upload:{upload_id}"
+
+#direct uploads that were started and not completed yet, scored by when their object is removed if they never are
+PENDING_DIRECT_UPLOADS_KEY = "storage_upload:pending"
+
+def is_content_addressed(attachment: Attachment) -> bool:
+    """
+    Whether the hash of the attachment was computed by us, i.e. it was uploaded through the api and not directly.
+    Only those objects are shared between users and cached by hash alone.
+    """
+    return attachment.object_url == storage_object_url(attachment_object_name(attachment.sha256))
+
+def store_attachment(db_connection: Session, user_id: str | int, file_bytes: bytes, filename: str, content_type: str) -> tuple[Attachment | None, bool]:
+    """
+    Store an uploaded file as an attachment of the user. The object is content addressed, so the same content is stored
+    once for all users. Only a file the user already has skips the transfer: skipping it for the file of another user
+    would tell the uploader that somebody else has that file.
+
+    :return: (the attachment, whether the user already had the file), (None, False) when the upload failed.
+    :raises CircuitOpenError: when the storage breaker is open, the upload was not attempted.
+    """
+    sha256 = hashlib.sha256(file_bytes).hexdigest()
+
+    own_attachment = db_connection.query(Attachment).filter(Attachment.uid == user_id, Attachment.sha256 == sha256).first()
+
+    if own_attachment is not None:
+        return own_attachment, True
+
+    #the same content written to the same object, also when another user or a concurrent upload stored it already
+    if len(file_bytes) > settings.STORAGE_RESUMABLE_UPLOAD_THRESHOLD_BYTES:
+        object_url = upload_to_storage_resumable(file_bytes, attachment_object_name(sha256), content_type)
+    else:
+        object_url = upload_bytes_to_storage(file_bytes, attachment_object_name(sha256), content_type, upsert=True)
+
+    if object_url == "upload_failed":
+        return None, False
+
+    attachment = Attachment(
+        uid=user_id,
+        sha256=sha256,
+        filename=filename,
+        content_type=content_type,
+        size=len(file_bytes),
+        object_url=object_url
+    )
+
+    try:
+        db_connection.add(attachment)
+        db_connection.commit()
+
+    except IntegrityError:
+        #a concurrent upload of the same file by the same user added the row first
+        db_connection.rollback()
+        return db_connection.query(Attachment).filter(Attachment.uid == user_id, Attachment.sha256 == sha256).first(), True
+
+    return attachment, False
+
+def get_user_attachments(db_connection: Session, user_id: str | int, attachment_ids: list[int]) -> dict[int, Attachment]:
+    """
+    :return: {attachment_id: attachment} of the ids that are attachments of the user.
+    """
+    if not attachment_ids:
+        return {}
+
+    attachments = db_connection.query(Attachment).filter(Attachment.uid == user_id, Attachment.attachment_id.in_(set(attachment_ids))).all()
+
+    return {attachment.attachment_id: attachment for attachment in attachments}
+
+def _file_sha256(file_path: str) -> str:
+    file_hash = hashlib.sha256()
+
+    with open(file_path, "rb") as cached_file:
+        for block in iter(lambda: cached_file.read(1024 * 1024), b""):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+def _prune_attachment_cache() -> None:
+    cached_files = []
+
+    for entry in os.scandir(settings.ATTACHMENT_CACHE_DIR):
+        if entry.is_file() and not entry.name.endswith(".part"):
+            entry_stat = entry.stat()
+            cached_files.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+
+    cache_bytes = sum(size for _, size, _ in cached_files)
+
+    #least recently used first, a cache hit touches its file
+    for _, size, file_path in sorted(cached_files):
+        if cache_bytes <= settings.ATTACHMENT_CACHE_MAX_BYTES:
+            break
+
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+        cache_bytes -= size
+
+def _attachment_cache_path(attachment: Attachment) -> str:
+    #a direct upload gets its own entry, only content addressed objects are shared between users
+    cache_name = attachment.sha256 if is_content_addressed(attachment) else f"{attachment.sha256}-{attachment.attachment_id}"
+    return os.path.join(settings.ATTACHMENT_CACHE_DIR, cache_name)
+
+def cached_attachment_path(attachment: Attachment) -> str:
+    """
+    Local copy of an attachment for the worker, cached on disk by SHA-256 in ATTACHMENT_CACHE_DIR, so every file content
+    is downloaded once per host no matter how many emails, batches or users send it. The least recently used files are
+    removed once the cache grows over ATTACHMENT_CACHE_MAX_BYTES.
+
+    :return: path of the cached file, "download_failed" when it could not be downloaded.
+    :raises CircuitOpenError: when the storage breaker is open, the download was not attempted.
+    """
+    cached_path = _attachment_cache_path(attachment)
+
+    if os.path.exists(cached_path):
+        os.utime(cached_path)
+        return cached_path
+
+    os.makedirs(settings.ATTACHMENT_CACHE_DIR, exist_ok=True)
+
+    #download next to the cache entry and move it in place, so other workers never read a half written file
+    download_path = f"{cached_path}.{uuid.uuid4().hex}.part"
+
+    if get_file_from_storage(object_url=attachment.object_url, file_path=download_path) == "download_failed":
+        return "download_failed"
+
+    if _file_sha256(download_path) != attachment.sha256:
+        print(f"Attachment {attachment.attachment_id} does not match its hash")
+        os.remove(download_path)
+        return "download_failed"
+
+    os.replace(download_path, cached_path)
+    _prune_attachment_cache()
+
+    return cached_path
+
+def create_direct_upload(db_connection: Session, user_id: str | int, filename: str, content_type: str, size: int, sha256: str, purpose: str) -> dict | None:
+    """
+    Start an upload that goes from the client straight to storage. The upload is remembered for DIRECT_UPLOAD_TTL_SECONDS,
+    complete_direct_upload checks the stored object against it.
+
+    :return: {"upload_id", "upload_url", "expires_in_seconds"}, or {"attachment"} when the user already has a file
+             with this hash and nothing has to be uploaded, None when no upload url could be signed.
+    :raises CircuitOpenError: when the storage breaker is open.
+    """
+    own_attachment = db_connection.query(Attachment).filter(Attachment.uid == user_id, Attachment.sha256 == sha256).first()
+
+    if own_attachment is not None:
+        return {"attachment": own_attachment}
+
+    upload_id = uuid.uuid4().hex
+    object_name = direct_upload_object_name(user_id, upload_id)
+
+    upload_url = create_signed_upload_url(object_name)
+
+    if upload_url == "sign_failed":
+        return None
+
+    redis_pipeline = sync_redis_client.pipeline(transaction=True)
+    redis_pipeline.set(direct_upload_key(upload_id), json.dumps({
+        "user_id": str(user_id),
+        "object_url": storage_object_url(object_name),
+        "filename": filename,
+        "content_type": content_type,
+        "size": size,
+        "sha256": sha256,
+        "purpose": purpose
+    }), ex=settings.DIRECT_UPLOAD_TTL_SECONDS)
+    redis_pipeline.zadd(PENDING_DIRECT_UPLOADS_KEY, {f"{user_id}:{upload_id}": time.time() + settings.DIRECT_UPLOAD_STALE_SECONDS})
+    redis_pipeline.execute()
+
+    return {"upload_id": upload_id, "upload_url": upload_url, "expires_in_seconds": settings.DIRECT_UPLOAD_TTL_SECONDS}
+
+def _end_direct_upload(user_id: str | int, upload_id: str) -> None:
+    redis_pipeline = sync_redis_client.pipeline(transaction=True)
+    redis_pipeline.delete(direct_upload_key(upload_id))
+    redis_pipeline.zrem(PENDING_DIRECT_UPLOADS_KEY, f"{user_id}:{upload_id}")
+    redis_pipeline.execute()
+
+def complete_direct_upload(db_connection: Session, user_id: str | int, upload_id: str) -> tuple[Attachment | None, str | None, str | None]:
+    """
+    Turn a finished direct upload into an attachment of the user, after checking that the stored object has the size
+    and content type the upload was started with. Only a HEAD request is made, the file never passes through the api.
+    The declared SHA-256 is checked by the worker that downloads the file (cached_attachment_path) before it is sent.
+    An object that does not match is deleted.
+
+    :return: (attachment, purpose, None), or (None, None, error) with error "upload_not_found" (unknown or expired),
+             "upload_missing" (nothing was uploaded yet) or "upload_mismatch".
+    :raises CircuitOpenError: when the storage breaker is open.
+    """
+    upload_json = sync_redis_client.get(direct_upload_key(upload_id))
+    upload = json.loads(upload_json) if upload_json else None
+
+    if upload is None or upload["user_id"] != str(user_id):
+        return None, None, "upload_not_found"
+
+    object_info = get_storage_object_info(upload["object_url"])
+
+    if object_info is None:
+        return None, None, "upload_missing"
+
+    if object_info["size"] != upload["size"] or object_info["content_type"] != upload["content_type"]:
+        delete_from_storage(upload["object_url"])
+        _end_direct_upload(user_id, upload_id)
+        return None, None, "upload_mismatch"
+
+    attachment = Attachment(
+        uid=user_id,
+        sha256=upload["sha256"],
+        filename=upload["filename"],
+        content_type=upload["content_type"],
+        size=upload["size"],
+        object_url=upload["object_url"]
+    )
+
+    try:
+        db_connection.add(attachment)
+        db_connection.commit()
+
+    except IntegrityError:
+        #the upload was completed twice, or the user uploaded the same file in between
+        db_connection.rollback()
+        attachment = db_connection.query(Attachment).filter(Attachment.uid == user_id, Attachment.sha256 == upload["sha256"]).first()
+
+        if attachment.object_url != upload["object_url"]:
+            #the user has this file already, the uploaded copy is not needed
+            delete_from_storage(upload["object_url"])
+
+    _end_direct_upload(user_id, upload_id)
+
+    return attachment, upload["purpose"], None
+
+def remove_stale_direct_uploads(limit: int = 100) -> int:
+    """
+    Delete the objects of direct uploads that were started but never completed, once their signed url can no longer be
+    used (DIRECT_UPLOAD_STALE_SECONDS), so abandoned uploads do not stay in storage.
+
+    :return: the number of uploads removed.
+    """
+    stale_uploads = sync_redis_client.zrangebyscore(PENDING_DIRECT_UPLOADS_KEY, "-inf", time.time(), start=0, num=limit)
+
+    removed_uploads = 0
+    for pending_upload in stale_uploads:
+        user_id, upload_id = pending_upload.split(":", 1)
+
+        try:
+            deleted = delete_from_storage(storage_object_url(direct_upload_object_name(user_id, upload_id)))
+
+        except CircuitOpenError:
+            #storage is down, the next sweep tries again
+            break
+
+        #a 404 is an upload the client never made, there is nothing left to delete either
+        if not deleted and get_storage_object_info(storage_object_url(direct_upload_object_name(user_id, upload_id))) is not None:
+            continue
+
+        sync_redis_client.zrem(PENDING_DIRECT_UPLOADS_KEY, pending_upload)
+        removed_uploads += 1
+
+    return removed_uploads
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import uuid
+from typing import Callable, Literal
+
+from redis.asyncio import Redis
+from sqlalchemy.orm import Session
+
+from app.db.dbConnection import SessionLocal
+from app.services.metrics_services import increment_counter
+from app.services.version_services import bump_version
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+CacheKind = Literal["list", "hash"]
+CachePayload = list[str] | dict[str, str]
+CacheLoader = Callable[[Session], CachePayload]
+
+CACHE_METRICS_GROUP = "cache"
+
+#compare-and-delete, so a slow filler never releases a lock that already expired and was taken by another filler
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+#keep a reference to the running refresh tasks, otherwise the event loop may garbage collect them mid-flight
+_background_refreshes: set[asyncio.Task] = set()
+
+def fresh_marker_key(cache_key: str) -> str:
+    return f"{cache_key}:fresh"
+
+def fill_lock_key(cache_key: str) -> str:
+    return f"{cache_key}:fill_lock"
+
+async def acquire_fill_lock(redis_connection: Redis, cache_key: str) -> str | None:
+    """
+    Try to become the single filler of a cache key. Returns the lock token if acquired, None otherwise.
+    """
+    lock_token = uuid.uuid4().hex
+    acquired = await redis_connection.set(fill_lock_key(cache_key), lock_token, nx=True, px=settings.CACHE_FILL_LOCK_MS)
+    return lock_token if acquired else None
+
+async def release_fill_lock(redis_connection: Redis, cache_key: str, lock_token: str) -> None:
+    await redis_connection.eval(RELEASE_LOCK_SCRIPT, 1, fill_lock_key(cache_key), lock_token)
+
+async def write_cache(redis_connection: Redis, cache_key: str, kind: CacheKind, payload: CachePayload) -> None:
+    """
+    Replace the whole cache entry in one transaction and mark it fresh for the soft ttl.
+    Replacing instead of appending means a refill can never duplicate entries that are already cached.
+    """
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    redis_pipeline.delete(cache_key)
+
+    if payload:
+        if kind == "list":
+            redis_pipeline.rpush(cache_key, *payload)
+        else:
+            redis_pipeline.hset(cache_key, mapping=payload)
+        redis_pipeline.expire(cache_key, settings.CACHE_HARD_TTL_SECONDS)
+
+    #the marker is written even for an empty payload, so users with nothing cached do not hit the db on every read
+    redis_pipeline.set(fresh_marker_key(cache_key), 1, ex=settings.CACHE_SOFT_TTL_SECONDS)
+    await redis_pipeline.execute()
+
+async def _read_cache(redis_connection: Redis, cache_key: str, kind: CacheKind) -> tuple[CachePayload, bool]:
+    redis_pipeline = redis_connection.pipeline()
+
+    if kind == "list":
+        redis_pipeline.lrange(cache_key, 0, -1)
+    else:
+        redis_pipeline.hgetall(cache_key)
+
+    redis_pipeline.exists(fresh_marker_key(cache_key))
+    payload, is_fresh = await redis_pipeline.execute()
+
+    return payload, bool(is_fresh)
+
+def _load_with_new_session(loader: CacheLoader) -> CachePayload:
+    #the request session is closed once the response is sent, so background refreshes open their own
+    db_connection = SessionLocal()
+    try:
+        return loader(db_connection)
+    finally:
+        db_connection.close()
+
+async def _refresh_in_background(redis_connection: Redis, cache_key: str, kind: CacheKind, loader: CacheLoader, lock_token: str,
+                                 stale_payload: CachePayload, version_key: str | None) -> None:
+    try:
+        payload = await asyncio.to_thread(_load_with_new_session, loader)
+        await write_cache(redis_connection, cache_key, kind, payload)
+
+        #the db can differ from the stale copy (e.g. rows written outside the routes), so clients must not keep their etag
+        if version_key and payload != stale_payload:
+            await bump_version(redis_connection, version_key)
+
+        await increment_counter(redis_connection, CACHE_METRICS_GROUP, "background_refreshes")
+
+    except Exception as e:
+        logger.error(f"Background refresh of {cache_key} failed: {e}")
+
+    finally:
+        await release_fill_lock(redis_connection, cache_key, lock_token)
+
+async def _wait_for_fill(redis_connection: Redis, cache_key: str, kind: CacheKind) -> CachePayload | None:
+    """
+    Poll until the filler that holds the lock has written the entry, or give up after CACHE_FILL_WAIT_MS.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.CACHE_FILL_WAIT_MS / 1000
+
+    while loop.time() < deadline:
+        await asyncio.sleep(settings.CACHE_FILL_POLL_MS / 1000)
+
+        payload, is_fresh = await _read_cache(redis_connection, cache_key, kind)
+        if payload or is_fresh:
+            return payload
+
+    return None
+
+async def get_or_fill_cache(redis_connection: Redis, cache_key: str, kind: CacheKind, loader: CacheLoader, db_connection: Session,
+                            version_key: str | None = None) -> tuple[CachePayload, str]:
+    """
+    Read-through cache with single-flight fills and stale-while-revalidate.
+
+    - fresh entry: served from redis.
+    - entry past its soft ttl: served stale from redis while one background task refreshes it from the db.
+    - missing entry: one request takes a short redis lock and fills it from the db, concurrent requests wait for
+      that fill instead of all querying postgres at once.
+
+    :param loader: function that receives a db session and returns the serialized payload (list items or hash mapping).
+    :param version_key: optional data version that is bumped when a background refresh finds different data in the db.
+                        Filling a missing entry does not bump it, a cold cache does not mean the data changed.
+    :return: the payload and where it came from, "redis", "redis_stale" or "db".
+    """
+    payload, is_fresh = await _read_cache(redis_connection, cache_key, kind)
+
+    if payload or is_fresh:
+        if payload:
+            await redis_connection.expire(cache_key, settings.CACHE_HARD_TTL_SECONDS)
+
+        if is_fresh:
+            await increment_counter(redis_connection, CACHE_METRICS_GROUP, "hits")
+            return payload, "redis"
+
+        await increment_counter(redis_connection, CACHE_METRICS_GROUP, "stale_hits")
+
+        lock_token = await acquire_fill_lock(redis_connection, cache_key)
+        if lock_token:
+            refresh_task = asyncio.create_task(_refresh_in_background(redis_connection, cache_key, kind, loader, lock_token, payload, version_key))
+            _background_refreshes.add(refresh_task)
+            refresh_task.add_done_callback(_background_refreshes.discard)
+
+        return payload, "redis_stale"
+
+    lock_token = await acquire_fill_lock(redis_connection, cache_key)
+
+    if lock_token:
+        await increment_counter(redis_connection, CACHE_METRICS_GROUP, "misses")
+        try:
+            #run the db query off the event loop so the requests waiting on this fill keep being served
+            payload = await asyncio.to_thread(loader, db_connection)
+            await write_cache(redis_connection, cache_key, kind, payload)
+        finally:
+            await release_fill_lock(redis_connection, cache_key, lock_token)
+
+        return payload, "db"
+
+    #another request is already filling this key, so wait for its result instead of querying the db again
+    await increment_counter(redis_connection, CACHE_METRICS_GROUP, "coalesced_misses")
+    payload = await _wait_for_fill(redis_connection, cache_key, kind)
+
+    if payload is not None:
+        return payload, "redis"
+
+    #the filler is too slow or died, read the db without writing so we do not race with it
+    await increment_counter(redis_connection, CACHE_METRICS_GROUP, "fill_wait_timeouts")
+    return await asyncio.to_thread(loader, db_connection), "db"
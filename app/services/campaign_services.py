@@ -0,0 +1,275 @@
+import json
+import time
+import uuid
+
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import WatchError
+
+from app.utils.config import settings
+
+CAMPAIGN_COUNTERS = ("queued", "in_flight", "sent", "failed", "dead", "skipped")
+
+#a campaign can only be moved to a status from the statuses listed here
+CAMPAIGN_TRANSITIONS = {
+    "paused": ("queued", "running"),
+    "queued": ("paused",),
+    "cancelled": ("queued", "running", "paused"),
+    "running": ("queued",),
+}
+
+#check and set the status in one step, so a worker finishing the campaign can never overwrite a cancel that just happened
+SET_STATUS_SCRIPT = """
+local current_status = redis.call('hget', KEYS[1], 'status')
+if not current_status then
+    return nil
+end
+for i = 2, #ARGV do
+    if ARGV[i] == current_status then
+        redis.call('hset', KEYS[1], 'status', ARGV[1])
+        return ARGV[1]
+    end
+end
+return current_status
+"""
+
+#a finished campaign moves the ids that were requested but no longer found in the queue from queued to skipped.
+#it is only complete while it is running and no chunk of any of its runs is still open
+COMPLETE_CAMPAIGN_SCRIPT = """
+if redis.call('hget', KEYS[1], 'status') ~= 'running' or tonumber(redis.call('hget', KEYS[1], 'open_chunks') or '0') > 0 then
+    return 0
+end
+local not_found = tonumber(redis.call('hget', KEYS[1], 'queued'))
+redis.call('hincrby', KEYS[1], 'skipped', not_found)
+redis.call('hset', KEYS[1], 'queued', 0, 'status', 'completed')
+return 1
+"""
+
+#count the email a chunk is sending as in flight only once, also when a resumed chunk starts it again after a crash
+START_CHUNK_EMAIL_SCRIPT = """
+if redis.call('set', KEYS[2], '1', 'NX', 'EX', tonumber(ARGV[1])) then
+    redis.call('hincrby', KEYS[1], 'queued', -1)
+    redis.call('hincrby', KEYS[1], 'in_flight', 1)
+end
+return 1
+"""
+
+#a chunk closes once, also when a resumed chunk whose first worker died after closing it finishes again.
+#returns the number of chunks of the campaign that are still open, -1 when the chunk was closed already
+FINISH_CHUNK_SCRIPT = """
+if redis.call('sadd', KEYS[2], ARGV[1]) == 0 then
+    return -1
+end
+redis.call('expire', KEYS[2], tonumber(ARGV[2]))
+return redis.call('hincrby', KEYS[1], 'open_chunks', -1)
+"""
+
+#the unsent emails of a stopped chunk go back into the user's queue only while the campaign is still paused or cancelled.
+#checked in the same step, so a resume that already re-read the queue can never miss them: the chunk sends them instead
+REQUEUE_STOPPED_CHUNK_SCRIPT = """
+local status = redis.call('hget', KEYS[1], 'status')
+if status ~= 'paused' and status ~= 'cancelled' then
+    return false
+end
+local emails = redis.call('lrange', KEYS[2], 0, -1)
+if #emails > 0 then
+    redis.call('rpush', KEYS[3], unpack(emails))
+    redis.call('expire', KEYS[3], tonumber(ARGV[1]))
+end
+redis.call('del', KEYS[2])
+return emails
+"""
+
+def campaign_key(campaign_id: str) -> str:
+    return f"campaign:{campaign_id}"
+
+def campaign_run_key(campaign_id: str, run: int) -> str:
+    return f"campaign:{campaign_id}:run:{run}"
+
+def campaign_chunk_key(campaign_id: str, run: int, chunk_index: int) -> str:
+    return f"{campaign_run_key(campaign_id, run)}:chunk:{chunk_index}"
+
+def campaign_done_chunks_key(campaign_id: str, run: int) -> str:
+    return f"{campaign_run_key(campaign_id, run)}:done"
+
+def campaign_chunk_in_flight_key(campaign_id: str, run: int, chunk_index: int) -> str:
+    return f"{campaign_chunk_key(campaign_id, run, chunk_index)}:in_flight"
+
+def campaign_chunk_results_key(campaign_id: str, run: int, chunk_index: int) -> str:
+    return f"{campaign_chunk_key(campaign_id, run, chunk_index)}:results"
+
+async def create_campaign(redis_connection: Redis, user_id: str | int, email_ids: list[int]) -> str:
+    """
+    Create the campaign record for one send request. The counters live in a redis hash, so reading the progress of a
+    campaign is a single HGETALL no matter how many emails it has.
+    """
+    campaign_id = uuid.uuid4().hex
+
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    redis_pipeline.hset(campaign_key(campaign_id), mapping={
+        "campaign_id": campaign_id,
+        "user_id": str(user_id),
+        "status": "queued",
+        "run": 1,
+        "created_at": int(time.time()),
+        "total": len(email_ids),
+        "email_ids": json.dumps(email_ids),
+        **{counter: 0 for counter in CAMPAIGN_COUNTERS},
+        "queued": len(email_ids),
+        "open_chunks": 0,
+    })
+    redis_pipeline.expire(campaign_key(campaign_id), settings.CAMPAIGN_TTL_SECONDS)
+    await redis_pipeline.execute()
+
+    return campaign_id
+
+async def get_campaign(redis_connection: Redis, campaign_id: str) -> dict | None:
+    campaign = await redis_connection.hgetall(campaign_key(campaign_id))
+
+    if not campaign:
+        return None
+
+    for field in (*CAMPAIGN_COUNTERS, "total", "run", "created_at", "open_chunks"):
+        campaign[field] = int(campaign.get(field, 0))
+    campaign["email_ids"] = json.loads(campaign["email_ids"])
+
+    return campaign
+
+async def set_campaign_status(redis_connection: Redis, campaign_id: str, new_status: str) -> str | None:
+    """
+    Move a campaign to new_status if the transition is allowed.
+
+    :return: the status the campaign has afterwards (new_status if the transition happened), None if it does not exist.
+    """
+    return await redis_connection.eval(SET_STATUS_SCRIPT, 1, campaign_key(campaign_id), new_status, *CAMPAIGN_TRANSITIONS[new_status])
+
+async def start_new_run(redis_connection: Redis, campaign_id: str) -> int:
+    """
+    Start a new worker run of the campaign (e.g. on resume), over the emails that are back in the queue. Chunks of an
+    older run that were still queued, deferred or sending when the campaign was resumed keep sending their own emails,
+    the campaign completes once the chunks of all its runs are done.
+    """
+    return await redis_connection.hincrby(campaign_key(campaign_id), "run", 1)
+
+async def update_campaign_counters(redis_connection: Redis, campaign_id: str | None, **counter_deltas: int) -> None:
+    """
+    Atomically apply counter changes, e.g. update_campaign_counters(redis, campaign_id, in_flight=-1, sent=1).
+    """
+    if not campaign_id:
+        return
+
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    queue_campaign_counters(redis_pipeline, campaign_id, **counter_deltas)
+    await redis_pipeline.execute()
+
+def queue_campaign_counters(redis_pipeline: Pipeline, campaign_id: str | None, **counter_deltas: int) -> None:
+    """
+    Queue counter changes on a pipeline, so they are applied in the same transaction as the work they count.
+    """
+    if not campaign_id:
+        return
+
+    for counter, delta in counter_deltas.items():
+        redis_pipeline.hincrby(campaign_key(campaign_id), counter, delta)
+
+async def start_chunk_email(redis_connection: Redis, campaign_id: str, run: int, chunk_index: int) -> None:
+    """
+    Move the email at the head of a chunk from queued to in_flight. The in flight marker is removed again by the
+    chunk's checkpoint (queue_chunk_email_done) or by stop_chunk_email.
+    """
+    await redis_connection.eval(START_CHUNK_EMAIL_SCRIPT, 2, campaign_key(campaign_id),
+                                campaign_chunk_in_flight_key(campaign_id, run, chunk_index), settings.CAMPAIGN_TTL_SECONDS)
+
+def queue_chunk_email_done(redis_pipeline: Pipeline, campaign_id: str, run: int, chunk_index: int, outcome: str) -> None:
+    queue_campaign_counters(redis_pipeline, campaign_id, in_flight=-1, **{outcome: 1})
+    redis_pipeline.delete(campaign_chunk_in_flight_key(campaign_id, run, chunk_index))
+
+async def stop_chunk_email(redis_connection: Redis, campaign_id: str, run: int, chunk_index: int) -> None:
+    """
+    Put the in flight email of a chunk back to queued, when it was not attempted after all.
+    """
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    queue_chunk_email_done(redis_pipeline, campaign_id, run, chunk_index, "queued")
+    await redis_pipeline.execute()
+
+async def complete_campaign(redis_connection: Redis, campaign_id: str | None) -> None:
+    if campaign_id:
+        await redis_connection.eval(COMPLETE_CAMPAIGN_SCRIPT, 1, campaign_key(campaign_id))
+
+async def should_stop_campaign(redis_connection: Redis, campaign_id: str | None) -> bool:
+    """
+    Checked by the worker before every email: stop when the campaign was paused or cancelled.
+    """
+    if not campaign_id:
+        return False
+
+    return await redis_connection.hget(campaign_key(campaign_id), "status") in ("paused", "cancelled")
+
+async def requeue_stopped_chunk(redis_connection: Redis, queue_key: str, campaign_id: str, run: int, chunk_index: int) -> list[str] | None:
+    """
+    Put the unsent emails of a chunk that stopped because the campaign was paused or cancelled back into the user's
+    queue, in one step with checking that the campaign is still paused or cancelled.
+
+    :return: the requeued emails, None when the campaign was resumed in between and the chunk has to keep sending.
+    """
+    return await redis_connection.eval(REQUEUE_STOPPED_CHUNK_SCRIPT, 3, campaign_key(campaign_id),
+                                       campaign_chunk_key(campaign_id, run, chunk_index), queue_key, settings.CACHE_HARD_TTL_SECONDS)
+
+async def claim_campaign_chunks(redis_connection: Redis, queue_key: str, campaign_id: str, run: int, email_ids: list[int], chunk_size: int) -> list[int]:
+    """
+    Move the selected emails out of the user's queue into fixed-size chunk lists of this campaign run, in one
+    transaction. The chunk workers then only ever touch their own chunk list, so they can run in parallel without the
+    read-delete-rewrite races a shared queue key would have.
+
+    :return: the eids that were claimed, in queue order. The chunks are counted as open in the campaign hash.
+    """
+    selected_eids = set(email_ids)
+
+    while True:
+        async with redis_connection.pipeline(transaction=True) as redis_pipeline:
+            try:
+                #retry from scratch if anybody changes the queue between our read and our write
+                await redis_pipeline.watch(queue_key)
+                email_queue = await redis_pipeline.lrange(queue_key, 0, -1)
+
+                kept_emails, claimed_emails, claimed_eids = [], [], []
+                for email_json in email_queue:
+                    eid = json.loads(email_json).get("eid")
+
+                    if eid in selected_eids and eid not in claimed_eids:
+                        claimed_emails.append(email_json)
+                        claimed_eids.append(eid)
+                    else:
+                        kept_emails.append(email_json)
+
+                chunks = [claimed_emails[start:start + chunk_size] for start in range(0, len(claimed_emails), chunk_size)]
+
+                redis_pipeline.multi()
+                redis_pipeline.delete(queue_key)
+                if kept_emails:
+                    redis_pipeline.rpush(queue_key, *kept_emails)
+                    redis_pipeline.expire(queue_key, settings.CACHE_HARD_TTL_SECONDS)
+
+                for chunk_index, chunk in enumerate(chunks):
+                    redis_pipeline.rpush(campaign_chunk_key(campaign_id, run, chunk_index), *chunk)
+                    redis_pipeline.expire(campaign_chunk_key(campaign_id, run, chunk_index), settings.CAMPAIGN_TTL_SECONDS)
+
+                #the chunks are open until they finish, the campaign completes when no chunk of any run is open
+                redis_pipeline.hincrby(campaign_key(campaign_id), "open_chunks", len(chunks))
+                await redis_pipeline.execute()
+
+                return claimed_eids
+
+            except WatchError:
+                continue
+
+async def finish_campaign_chunk(redis_connection: Redis, campaign_id: str, run: int, chunk_index: int) -> bool:
+    """
+    Mark one chunk of a run as done. Returns True for the chunk that closed the last open chunk of the campaign, over
+    all of its runs, which triggers the final callback. Finishing a chunk again (a resumed chunk whose first worker
+    died after finishing it) changes nothing.
+    """
+    open_chunks = await redis_connection.eval(FINISH_CHUNK_SCRIPT, 2, campaign_key(campaign_id), campaign_done_chunks_key(campaign_id, run),
+                                              chunk_index, settings.CAMPAIGN_TTL_SECONDS)
+
+    return open_chunks == 0
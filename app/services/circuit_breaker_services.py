@@ -0,0 +1,168 @@
+from contextlib import contextmanager
+from typing import Callable
+
+from redis import Redis as SyncRedis
+
+from app.services.metrics_services import metrics_key, METRICS_GROUPS_KEY
+from app.utils.config import settings
+
+BREAKER_METRICS_GROUP = "circuit_breaker"
+
+#the failure rate is counted over BREAKER_WINDOW_SECONDS split into this many buckets
+WINDOW_BUCKETS = 6
+
+def breaker_key(name: str) -> str:
+    return f"breaker:{name}"
+
+def breaker_window_key(name: str) -> str:
+    return f"breaker:{name}:window"
+
+class CircuitOpenError(Exception):
+    """
+    The call was not attempted because the circuit breaker of the dependency is open.
+    """
+    def __init__(self, name: str, retry_after_ms: int):
+        super().__init__(f"Circuit breaker {name} is open, retry in {retry_after_ms} ms")
+        self.name = name
+        self.retry_after_ms = retry_after_ms
+
+#closed: every call goes through. open: every call fails fast until open_until. After that the breaker is half open and
+#exactly one call at a time is let through as a probe, the others keep failing fast.
+#returns 0 for a normal call, -1 for the probe call, otherwise the ms until a call may be tried again
+BEFORE_CALL_SCRIPT = """
+local now_time = redis.call('time')
+local now = tonumber(now_time[1]) * 1000 + math.floor(tonumber(now_time[2]) / 1000)
+
+local state = redis.call('hget', KEYS[1], 'state') or 'closed'
+if state == 'closed' then
+    return 0
+end
+
+local wait_until = tonumber(redis.call('hget', KEYS[1], 'open_until') or '0')
+if state == 'half_open' then
+    wait_until = tonumber(redis.call('hget', KEYS[1], 'probe_until') or '0')
+end
+
+if wait_until > now then
+    redis.call('hincrby', KEYS[2], ARGV[1] .. ':rejected', 1)
+    redis.call('sadd', KEYS[3], ARGV[3])
+    return wait_until - now
+end
+
+redis.call('hset', KEYS[1], 'state', 'half_open', 'probe_until', now + tonumber(ARGV[2]))
+return -1
+"""
+
+#the probe decides alone: success closes the breaker, failure opens it again. Otherwise the outcome is counted in the
+#time bucketed window, and the breaker opens when the window has enough calls and too many of them failed
+RECORD_CALL_SCRIPT = """
+local now_time = redis.call('time')
+local now = tonumber(now_time[1]) * 1000 + math.floor(tonumber(now_time[2]) / 1000)
+local outcome, is_probe = ARGV[2], ARGV[3] == '1'
+local bucket_ms, window_ms = tonumber(ARGV[4]), tonumber(ARGV[5])
+
+local function open_breaker()
+    redis.call('hset', KEYS[1], 'state', 'open', 'open_until', now + tonumber(ARGV[8]))
+    redis.call('hdel', KEYS[1], 'probe_until')
+    redis.call('del', KEYS[2])
+    redis.call('hincrby', KEYS[3], ARGV[1] .. ':opened', 1)
+    redis.call('sadd', KEYS[4], ARGV[9])
+    return 1
+end
+
+if is_probe then
+    if outcome == 'failure' then
+        return open_breaker()
+    end
+    redis.call('hset', KEYS[1], 'state', 'closed')
+    redis.call('hdel', KEYS[1], 'open_until', 'probe_until')
+    redis.call('del', KEYS[2])
+    return 0
+end
+
+--calls that started before the breaker opened do not count
+if (redis.call('hget', KEYS[1], 'state') or 'closed') ~= 'closed' then
+    return 0
+end
+
+local current_bucket = math.floor(now / bucket_ms)
+redis.call('hincrby', KEYS[2], current_bucket .. ':' .. outcome, 1)
+redis.call('pexpire', KEYS[2], window_ms)
+
+local calls, failures = 0, 0
+local window = redis.call('hgetall', KEYS[2])
+for i = 1, #window, 2 do
+    local bucket, bucket_outcome = string.match(window[i], '^(%d+):(%a+)$')
+    if tonumber(bucket) <= current_bucket - window_ms / bucket_ms then
+        redis.call('hdel', KEYS[2], window[i])
+    else
+        calls = calls + tonumber(window[i + 1])
+        if bucket_outcome == 'failure' then
+            failures = failures + tonumber(window[i + 1])
+        end
+    end
+end
+
+if calls >= tonumber(ARGV[6]) and failures / calls >= tonumber(ARGV[7]) then
+    return open_breaker()
+end
+return 0
+"""
+
+class _BreakerCall:
+    def __init__(self):
+        self.failed = False
+
+    def record_failure(self) -> None:
+        """
+        Count the call as failed even though it did not raise, e.g. a 5xx response.
+        """
+        self.failed = True
+
+class CircuitBreaker:
+    """
+    Circuit breaker whose state lives in redis, so every api and worker process stops calling a degraded dependency
+    together instead of each of them waiting out full timeouts first.
+
+    Usage:
+        with storage_breaker.guard() as breaker_call:
+            response = httpx.get(...)
+            if response.status_code >= 500:
+                breaker_call.record_failure()
+
+    guard() raises CircuitOpenError without running the block while the breaker is open. An exception leaving the
+    block counts as a failure when is_failure(exception) is true.
+    """
+    def __init__(self, name: str, redis_connection: SyncRedis, is_failure: Callable[[Exception], bool] = lambda error: True):
+        self.name = name
+        self._redis = redis_connection
+        self._is_failure = is_failure
+
+    def _record(self, failed: bool, is_probe: bool) -> None:
+        window_ms = settings.BREAKER_WINDOW_SECONDS * 1000
+
+        self._redis.eval(RECORD_CALL_SCRIPT, 4, breaker_key(self.name), breaker_window_key(self.name),
+                         metrics_key(BREAKER_METRICS_GROUP), METRICS_GROUPS_KEY,
+                         self.name, "failure" if failed else "success", "1" if is_probe else "0",
+                         window_ms // WINDOW_BUCKETS, window_ms, settings.BREAKER_MIN_CALLS,
+                         settings.BREAKER_FAILURE_RATE, settings.BREAKER_OPEN_SECONDS * 1000, BREAKER_METRICS_GROUP)
+
+    @contextmanager
+    def guard(self):
+        wait_ms = self._redis.eval(BEFORE_CALL_SCRIPT, 3, breaker_key(self.name), metrics_key(BREAKER_METRICS_GROUP),
+                                   METRICS_GROUPS_KEY, self.name, settings.BREAKER_PROBE_TIMEOUT_SECONDS * 1000,
+                                   BREAKER_METRICS_GROUP)
+
+        if wait_ms > 0:
+            raise CircuitOpenError(self.name, wait_ms)
+
+        breaker_call = _BreakerCall()
+
+        try:
+            yield breaker_call
+
+        except Exception as e:
+            self._record(breaker_call.failed or self._is_failure(e), wait_ms == -1)
+            raise
+
+        self._record(breaker_call.failed, wait_ms == -1)
@@ -0,0 +1,144 @@
+import asyncio
+import uuid
+
+from redis.asyncio import Redis
+
+from app.services.metrics_services import metrics_key, METRICS_GROUPS_KEY
+from app.utils.config import settings
+
+CONCURRENCY_METRICS_GROUP = "send_concurrency"
+
+AIMD_LIMITS_KEY = "aimd:limit"
+AIMD_BLOCKED_UNTIL_KEY = "aimd:blocked_until"
+AIMD_DECREASED_AT_KEY = "aimd:decreased_at"
+
+GLOBAL_SCOPE = "global"
+
+def account_scope(account_id: str) -> str:
+    return f"account:{account_id}"
+
+def in_flight_key(scope: str) -> str:
+    return f"aimd:in_flight:{scope}"
+
+class GmailThrottledError(Exception):
+    """
+    Gmail refused a send because of rate limiting (429, rateLimitExceeded) or a server error (5xx).
+    """
+    def __init__(self, status_code: int, retry_after_ms: int | None = None):
+        super().__init__(f"Gmail throttled the send with status {status_code}")
+        self.status_code = status_code
+        self.retry_after_ms = retry_after_ms
+
+    @property
+    def provider_wide(self) -> bool:
+        #a 5xx is gmail itself struggling, a 429 or rateLimitExceeded only concerns the sending account
+        return self.status_code >= 500
+
+#a send needs a free slot in the global scope and in the scope of its sending account. Slots are leases in a sorted set scored by their
+#expiry, so a worker that dies mid-send only holds its slot until the lease runs out. The limits are floats, a slot is
+#free while the number of leases is below the limit rounded down.
+#returns 0 when the slot was taken, -1 when the scopes are full, otherwise the ms until a Retry-After block ends
+ACQUIRE_SLOT_SCRIPT = """
+local now_time = redis.call('time')
+local now = tonumber(now_time[1]) * 1000 + math.floor(tonumber(now_time[2]) / 1000)
+
+for i = 1, 2 do
+    local scope = ARGV[i]
+    local blocked_until = tonumber(redis.call('hget', KEYS[2], scope) or '0')
+    if blocked_until > now then
+        return blocked_until - now
+    end
+
+    redis.call('zremrangebyscore', KEYS[2 + i], '-inf', now)
+    local limit = tonumber(redis.call('hget', KEYS[1], scope) or ARGV[2 + i])
+    if redis.call('zcard', KEYS[2 + i]) >= math.max(1, math.floor(limit)) then
+        return -1
+    end
+end
+
+for i = 1, 2 do
+    redis.call('zadd', KEYS[2 + i], now + tonumber(ARGV[5]), ARGV[6])
+    redis.call('pexpire', KEYS[2 + i], tonumber(ARGV[5]))
+end
+return 0
+"""
+
+#additive increase on success (+1 per limit's worth of successes, like tcp congestion avoidance), multiplicative decrease
+#on a throttle. A throttle ('throttled') decreases and blocks the account scope only, so one rate limited account does
+#not slow down the others, a gmail server error ('server_error') both scopes. A burst of throttled in-flight sends only
+#decreases a scope once per cooldown. The limits are also written to the metrics hash, so they show up in
+#/api/metrics/counters
+RELEASE_SLOT_SCRIPT = """
+local now_time = redis.call('time')
+local now = tonumber(now_time[1]) * 1000 + math.floor(tonumber(now_time[2]) / 1000)
+local outcome = ARGV[7]
+
+for i = 1, 2 do
+    local scope = ARGV[i]
+    redis.call('zrem', KEYS[5 + i], ARGV[8])
+
+    local limit = tonumber(redis.call('hget', KEYS[1], scope) or ARGV[2 + i])
+    local max_limit = tonumber(ARGV[4 + i])
+
+    if outcome == 'success' then
+        limit = math.min(max_limit, limit + 1 / math.max(1, limit))
+    elseif outcome == 'server_error' or (outcome == 'throttled' and i == 2) then
+        redis.call('hincrby', KEYS[4], 'throttled:' .. scope, 1)
+
+        local decreased_at = tonumber(redis.call('hget', KEYS[3], scope) or '0')
+        if now - decreased_at >= tonumber(ARGV[10]) then
+            limit = math.max(1, limit * tonumber(ARGV[9]))
+            redis.call('hset', KEYS[3], scope, now)
+        end
+
+        if ARGV[11] ~= '' then
+            local blocked_until = now + tonumber(ARGV[11])
+            if blocked_until > tonumber(redis.call('hget', KEYS[2], scope) or '0') then
+                redis.call('hset', KEYS[2], scope, blocked_until)
+            end
+        end
+    end
+
+    redis.call('hset', KEYS[1], scope, limit)
+    redis.call('hset', KEYS[4], 'limit:' .. scope, limit)
+end
+
+redis.call('sadd', KEYS[5], ARGV[12])
+return 1
+"""
+
+async def acquire_send_slot(redis_connection: Redis, account_id: str) -> str:
+    """
+    Wait until the adaptive concurrency limits of the sending account and of all accounts allow one more gmail send in
+    flight.
+
+    :return: the lease id, to be passed to release_send_slot once the send is done.
+    """
+    lease_id = uuid.uuid4().hex
+
+    while True:
+        wait_ms = await redis_connection.eval(ACQUIRE_SLOT_SCRIPT, 4, AIMD_LIMITS_KEY, AIMD_BLOCKED_UNTIL_KEY,
+                                              in_flight_key(GLOBAL_SCOPE), in_flight_key(account_scope(account_id)),
+                                              GLOBAL_SCOPE, account_scope(account_id),
+                                              settings.AIMD_INITIAL_LIMIT_GLOBAL, settings.AIMD_INITIAL_LIMIT_ACCOUNT,
+                                              settings.AIMD_SLOT_LEASE_MS, lease_id)
+
+        if wait_ms == 0:
+            return lease_id
+
+        await asyncio.sleep((settings.AIMD_POLL_MS if wait_ms < 0 else wait_ms) / 1000)
+
+async def release_send_slot(redis_connection: Redis, account_id: str, lease_id: str, outcome: str, retry_after_ms: int | None = None) -> None:
+    """
+    Free the slot of a finished send and adapt the limits to its outcome: "success" raises them a little, "throttled"
+    halves the limit of the account and honors Retry-After for it, "server_error" does the same for the account and for
+    all accounts, "neutral" (any other failure) leaves them alone.
+    """
+    await redis_connection.eval(RELEASE_SLOT_SCRIPT, 7, AIMD_LIMITS_KEY, AIMD_BLOCKED_UNTIL_KEY, AIMD_DECREASED_AT_KEY,
+                                metrics_key(CONCURRENCY_METRICS_GROUP), METRICS_GROUPS_KEY,
+                                in_flight_key(GLOBAL_SCOPE), in_flight_key(account_scope(account_id)),
+                                GLOBAL_SCOPE, account_scope(account_id),
+                                settings.AIMD_INITIAL_LIMIT_GLOBAL, settings.AIMD_INITIAL_LIMIT_ACCOUNT,
+                                settings.AIMD_MAX_LIMIT_GLOBAL, settings.AIMD_MAX_LIMIT_ACCOUNT,
+                                outcome, lease_id, settings.AIMD_DECREASE_FACTOR, settings.AIMD_DECREASE_COOLDOWN_MS,
+                                "" if retry_after_ms is None else retry_after_ms, CONCURRENCY_METRICS_GROUP)
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from redis.asyncio import Redis
+from redis.asyncio.client import PubSub
+
+from app.db.redisConnection import redis_client
+from app.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+def user_events_channel(user_id: str | int) -> str:
+    return f"events:user:{user_id}"
+
+async def publish_user_event(redis_connection: Redis, user_id: str | int, event_type: str, **event_fields) -> None:
+    """
+    Publish a real-time event (e.g. "sent", "failed", "dead") to every client of the user connected to any api process.
+    Pub/sub is fire and forget, clients that are not connected simply miss the event.
+    """
+    event = {"type": event_type, **event_fields}
+    await redis_connection.publish(user_events_channel(user_id), json.dumps(event, default=str))
+
+class EventBroadcaster:
+    """
+    Fan-out of redis pub/sub events to the clients connected to this api process.
+    The process holds one pub/sub connection, subscribed only to the channels of the users that have a client connected
+    here, and every incoming event is copied into the bounded in-memory queue of each local subscriber of that user.
+    """
+    def __init__(self, redis_connection: Redis, max_queued_events: int = 100):
+        self.redis_connection = redis_connection
+        self.max_queued_events = max_queued_events
+        self._subscribers: dict[str, set[asyncio.Queue]] = defaultdict(set)
+        self._pubsub: PubSub | None = None
+        self._listener: asyncio.Task | None = None
+
+    def _dispatch(self, channel: str, event_data: str) -> None:
+        user_id = channel.rsplit(":", 1)[-1]
+
+        for event_queue in self._subscribers.get(user_id, ()):
+            #a slow client loses its oldest events instead of growing the memory of the process
+            if event_queue.full():
+                event_queue.get_nowait()
+            event_queue.put_nowait(event_data)
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                #the subscriptions change while this waits, they are sent on the same connection by subscribe
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+
+                if message is not None and message["type"] == "message":
+                    self._dispatch(message["channel"], message["data"])
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                #connected clients keep their streams open, the connection resubscribes its channels when it reconnects
+                logger.error(f"Event subscription failed, resubscribing: {e}")
+                await asyncio.sleep(1)
+
+    @asynccontextmanager
+    async def subscribe(self, user_id: str | int) -> AsyncIterator[asyncio.Queue]:
+        if self._pubsub is None:
+            self._pubsub = self.redis_connection.pubsub()
+
+        event_queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_queued_events)
+        user_subscribers = self._subscribers[str(user_id)]
+        first_subscriber = not user_subscribers
+        user_subscribers.add(event_queue)
+
+        try:
+            #the first client of the user in this process subscribes to the user's channel
+            if first_subscriber:
+                await self._pubsub.subscribe(user_events_channel(user_id))
+
+            if self._listener is None or self._listener.done():
+                self._listener = asyncio.create_task(self._listen())
+
+            yield event_queue
+
+        finally:
+            user_subscribers = self._subscribers.get(str(user_id))
+            if user_subscribers is not None:
+                user_subscribers.discard(event_queue)
+                if not user_subscribers:
+                    self._subscribers.pop(str(user_id), None)
+                    await self._unsubscribe(user_id)
+
+    async def _unsubscribe(self, user_id: str | int) -> None:
+        try:
+            await self._pubsub.unsubscribe(user_events_channel(user_id))
+        except Exception as e:
+            #events of a channel without local subscribers are dropped by _dispatch anyway
+            logger.error(f"Event unsubscription failed: {e}")
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+
+event_broadcaster = EventBroadcaster(redis_client, max_queued_events=settings.EVENTS_MAX_QUEUED_PER_CLIENT)
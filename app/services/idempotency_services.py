@@ -0,0 +1,109 @@
+import json
+
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+
+from app.services.metrics_services import metrics_key, METRICS_GROUPS_KEY, increment_counter
+from app.utils.config import settings
+
+IDEMPOTENCY_METRICS_GROUP = "idempotency"
+
+def send_claim_key(eid: int) -> str:
+    return f"send_claim:{eid}"
+
+def idempotency_key(user_id: str | int, scope: str, client_key: str) -> str:
+    return f"idempotency:{user_id}:{scope}:{client_key}"
+
+#an eid is claimed with SET NX before it is handed to gmail. The claim names the attempt (owner) that took it, which is
+#unique per attempt (the lease of a chunk, a retry batch), so a claim can only be taken over once it expired. Any other
+#attempt is short circuited: with the gmail message id once the email was sent, or with the ms until the claim expires
+#while the first attempt is still sending (or died while sending).
+#returns {'claimed', ''}, {'sent', google_message_id} or {'in_flight', ms}
+CLAIM_SEND_SCRIPT = """
+local current = redis.call('get', KEYS[1])
+
+if not current then
+    redis.call('set', KEYS[1], 'pending:' .. ARGV[1], 'EX', tonumber(ARGV[2]))
+    return {'claimed', ''}
+end
+
+local outcome, value = 'in_flight', tostring(math.max(0, redis.call('pttl', KEYS[1])))
+if string.sub(current, 1, 5) == 'sent:' then
+    outcome, value = 'sent', string.sub(current, 6)
+end
+
+redis.call('hincrby', KEYS[2], 'send:duplicate_' .. outcome, 1)
+redis.call('sadd', KEYS[3], ARGV[3])
+return {outcome, value}
+"""
+
+#only the attempt that holds the claim drops it, an attempt that outlived its claim can not drop the claim of the next one
+RELEASE_CLAIM_SCRIPT = """
+if redis.call('get', KEYS[1]) == 'pending:' .. ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+async def claim_email_send(redis_connection: Redis, eid: int, owner: str) -> tuple[str, str | int | None]:
+    """
+    Claim the right to send an email before calling gmail, so retries, re-clicks and redelivered tasks never send the
+    same eid twice.
+
+    :param owner: names the send attempt and has to be unique per attempt, e.g. the lease token of a chunk.
+    :return: ("claimed", None) to go ahead, ("sent", google_message_id) when it was already sent, or
+             ("in_flight", ms until the claim expires) when another attempt is sending it right now.
+    """
+    outcome, value = await redis_connection.eval(CLAIM_SEND_SCRIPT, 3, send_claim_key(eid),
+                                                 metrics_key(IDEMPOTENCY_METRICS_GROUP), METRICS_GROUPS_KEY,
+                                                 owner, settings.SEND_CLAIM_TTL_SECONDS, IDEMPOTENCY_METRICS_GROUP)
+
+    if outcome == "claimed":
+        return outcome, None
+
+    return outcome, int(value) if outcome == "in_flight" else value
+
+def queue_email_sent(redis_pipeline: Pipeline, eid: int, google_message_id: str) -> None:
+    """
+    Record the result of a claimed send, queued on the pipeline that records the rest of the outcome.
+    """
+    redis_pipeline.set(send_claim_key(eid), f"sent:{google_message_id}", ex=settings.SEND_DEDUPE_TTL_SECONDS)
+
+def queue_email_send_release(redis_pipeline: Pipeline, eid: int, owner: str) -> None:
+    """
+    Drop the claim of a send that failed or was not attempted, so the next attempt may send it.
+    """
+    redis_pipeline.eval(RELEASE_CLAIM_SCRIPT, 1, send_claim_key(eid), owner)
+
+async def record_email_sent(redis_connection: Redis, eid: int, google_message_id: str) -> None:
+    await redis_connection.set(send_claim_key(eid), f"sent:{google_message_id}", ex=settings.SEND_DEDUPE_TTL_SECONDS)
+
+async def release_email_send(redis_connection: Redis, eid: int, owner: str) -> None:
+    await redis_connection.eval(RELEASE_CLAIM_SCRIPT, 1, send_claim_key(eid), owner)
+
+async def claim_idempotency_key(redis_connection: Redis, user_id: str | int, scope: str, client_key: str, record: dict, ttl_seconds: int | None = None) -> dict | None:
+    """
+    Claim a client supplied Idempotency-Key of a route with SET NX.
+
+    :param record: what the first request stores under the key, replaced by its response with store_idempotent_response.
+    :param ttl_seconds: how long the key is remembered, IDEMPOTENCY_KEY_TTL_SECONDS by default.
+    :return: None when the key was claimed, otherwise the record stored by the first request with the same key.
+    """
+    if await redis_connection.set(idempotency_key(user_id, scope, client_key), json.dumps(record), nx=True, ex=ttl_seconds or settings.IDEMPOTENCY_KEY_TTL_SECONDS):
+        return None
+
+    stored_record = await redis_connection.get(idempotency_key(user_id, scope, client_key))
+
+    if stored_record is None:
+        #the first request failed and released the key in between, this one may go ahead
+        return await claim_idempotency_key(redis_connection, user_id, scope, client_key, record, ttl_seconds)
+
+    await increment_counter(redis_connection, IDEMPOTENCY_METRICS_GROUP, f"{scope}:replayed")
+
+    return json.loads(stored_record)
+
+async def store_idempotent_response(redis_connection: Redis, user_id: str | int, scope: str, client_key: str, response: dict) -> None:
+    await redis_connection.set(idempotency_key(user_id, scope, client_key), json.dumps({"response": response}, default=str), ex=settings.IDEMPOTENCY_KEY_TTL_SECONDS)
+
+async def release_idempotency_key(redis_connection: Redis, user_id: str | int, scope: str, client_key: str) -> None:
+    await redis_connection.delete(idempotency_key(user_id, scope, client_key))
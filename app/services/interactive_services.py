@@ -0,0 +1,52 @@
+import json
+
+from redis.asyncio import Redis
+
+from app.utils.config import settings
+
+def send_request_key(request_id: str) -> str:
+    return f"email_send:{request_id}"
+
+def send_request_done_key(request_id: str) -> str:
+    return f"email_send:{request_id}:done"
+
+async def create_send_request(redis_connection: Redis, request_id: str, user_id: str | int) -> None:
+    """
+    Create the status record of a send-email-now request before its task is queued on the interactive lane.
+    """
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    redis_pipeline.hset(send_request_key(request_id), mapping={"user_id": str(user_id), "status": "pending"})
+    redis_pipeline.expire(send_request_key(request_id), settings.SEND_RESULT_TTL_SECONDS)
+    await redis_pipeline.execute()
+
+async def store_send_result(redis_connection: Redis, request_id: str, result: dict) -> None:
+    """
+    Store the result of the send task and wake up the api request that is waiting for it.
+    The result lives in redis instead of the celery result backend, which is disabled.
+    """
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    redis_pipeline.hset(send_request_key(request_id), mapping={"status": "done", "result": json.dumps(result, default=str)})
+    redis_pipeline.expire(send_request_key(request_id), settings.SEND_RESULT_TTL_SECONDS)
+    redis_pipeline.rpush(send_request_done_key(request_id), 1)
+    redis_pipeline.expire(send_request_done_key(request_id), settings.SEND_NOW_WAIT_SECONDS * 2)
+    await redis_pipeline.execute()
+
+async def get_send_request(redis_connection: Redis, request_id: str) -> dict | None:
+    send_request = await redis_connection.hgetall(send_request_key(request_id))
+
+    if not send_request:
+        return None
+
+    if "result" in send_request:
+        send_request["result"] = json.loads(send_request["result"])
+
+    return send_request
+
+async def wait_for_send_result(redis_connection: Redis, request_id: str, timeout_seconds: int) -> dict | None:
+    """
+    Block (without holding an api thread) until the send task stored its result, or return None after the timeout.
+    """
+    if await redis_connection.blpop([send_request_done_key(request_id)], timeout=timeout_seconds) is None:
+        return None
+
+    return (await get_send_request(redis_connection, request_id)).get("result")
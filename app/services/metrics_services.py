@@ -0,0 +1,48 @@
+import re
+
+from redis.asyncio import Redis
+
+METRICS_GROUPS_KEY = "metrics:groups"
+
+#counters of one user or one of its sending accounts ("user:{uid}:...", "account:{uid}:{token_id}")
+USER_COUNTER_PATTERN = re.compile(r"(?:^|:)(?:user|account):([^:]+)(?::|$)")
+
+def metrics_key(group: str) -> str:
+    return f"metrics:{group}"
+
+async def increment_counter(redis_connection: Redis, group: str, field: str, amount: int = 1) -> None:
+    """
+    Increment a named counter inside a metrics group. Every group is a redis hash so that all api and worker
+    processes share the same numbers, and the group name is remembered so the metrics route can list it.
+    """
+    redis_pipeline = redis_connection.pipeline()
+    redis_pipeline.hincrby(metrics_key(group), field, amount)
+    redis_pipeline.sadd(METRICS_GROUPS_KEY, group)
+    await redis_pipeline.execute()
+
+def _to_number(value: str) -> int | float:
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+def _visible_to(field: str, user_id: str | int | None) -> bool:
+    user_counter = USER_COUNTER_PATTERN.search(field)
+    return user_counter is None or (user_id is not None and user_counter.group(1) == str(user_id))
+
+async def read_counters(redis_connection: Redis, user_id: str | int | None = None) -> dict[str, dict[str, int | float]]:
+    """
+    Read every metrics group as {group: {counter: value}}. Counters of a single user or of its sending accounts are
+    only included for user_id, the counters of everybody else are left out.
+    """
+    groups = sorted(await redis_connection.smembers(METRICS_GROUPS_KEY))
+
+    redis_pipeline = redis_connection.pipeline()
+    for group in groups:
+        redis_pipeline.hgetall(metrics_key(group))
+    group_values = await redis_pipeline.execute()
+
+    return {
+        group: {field: _to_number(value) for field, value in values.items() if _visible_to(field, user_id)}
+        for group, values in zip(groups, group_values)
+    }
@@ -0,0 +1,118 @@
+import json
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+
+import httpx
+
+from app.routes.constant_routes import GOOGLE_CLIENT_SECRETS_FILE, SCOPES
+from app.utils.config import settings
+
+GOOGLE_USERINFO_URL = "https://www.googleapis.com/oauth2/v2/userinfo"
+
+_google_client_config: dict | None = None
+_oauth_http_client: httpx.AsyncClient | None = None
+
+class OAuthExchangeError(Exception):
+    pass
+
+def load_google_client_config() -> dict:
+    """
+    Read and parse GOOGLE_CLIENT_SECRETS_FILE once per process (at startup), every oauth request uses the parsed config.
+    """
+    global _google_client_config
+
+    if _google_client_config is None:
+        with open(GOOGLE_CLIENT_SECRETS_FILE) as client_secrets_file:
+            client_secrets = json.load(client_secrets_file)
+
+        _google_client_config = client_secrets.get("web") or client_secrets["installed"]
+
+    return _google_client_config
+
+def get_oauth_http_client() -> httpx.AsyncClient:
+    #one pool for all logins, the connections to google are reused instead of opened per callback
+    global _oauth_http_client
+
+    if _oauth_http_client is None:
+        _oauth_http_client = httpx.AsyncClient(timeout=settings.OAUTH_HTTP_TIMEOUT_SECONDS,
+                                               limits=httpx.Limits(max_connections=settings.OAUTH_HTTP_MAX_CONNECTIONS))
+
+    return _oauth_http_client
+
+async def close_oauth_http_client() -> None:
+    global _oauth_http_client
+
+    if _oauth_http_client is not None:
+        await _oauth_http_client.aclose()
+        _oauth_http_client = None
+
+def build_authorization_url(redirect_uri: str, state: str, prompt: str) -> str:
+    client_config = load_google_client_config()
+
+    return client_config["auth_uri"] + "?" + urlencode({
+        "response_type": "code",
+        "client_id": client_config["client_id"],
+        "redirect_uri": redirect_uri,
+        "scope": " ".join(SCOPES),
+        "state": state,
+        # Enable offline access so that you can refresh an access token without
+        # re-prompting the user for permission. Recommended for web server apps.
+        "access_type": "offline",
+        # Enable incremental authorization. Recommended as a best practice.
+        "include_granted_scopes": "true",
+        "prompt": prompt
+    })
+
+async def exchange_authorization_code(code: str, redirect_uri: str) -> dict:
+    """
+    Exchange the code of the oauth callback for the tokens of the user.
+
+    :return: the credentials in the format of credentials_to_dict.
+    :raises OAuthExchangeError: when google does not accept the code or can not be reached.
+    """
+    client_config = load_google_client_config()
+
+    try:
+        response = await get_oauth_http_client().post(client_config["token_uri"], data={
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": redirect_uri,
+            "client_id": client_config["client_id"],
+            "client_secret": client_config["client_secret"]
+        })
+
+    except httpx.RequestError as e:
+        raise OAuthExchangeError(f"token exchange failed: {e}") from e
+
+    if response.status_code != 200:
+        raise OAuthExchangeError(f"token exchange failed with {response.status_code}: {response.text}")
+
+    token_response = response.json()
+
+    #naive utc like google.oauth2.credentials.Credentials.expiry
+    expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=token_response["expires_in"])
+
+    return {
+        "token": token_response["access_token"],
+        "refresh_token": token_response.get("refresh_token"),
+        "token_uri": client_config["token_uri"],
+        "client_id": client_config["client_id"],
+        "client_secret": client_config["client_secret"],
+        "granted_scopes": token_response.get("scope", "").split(),
+        "expiry": str(expiry)
+    }
+
+async def fetch_google_userinfo(access_token: str) -> dict:
+    """
+    :raises OAuthExchangeError: when the userinfo could not be fetched.
+    """
+    try:
+        response = await get_oauth_http_client().get(GOOGLE_USERINFO_URL, headers={"Authorization": f"Bearer {access_token}"})
+
+    except httpx.RequestError as e:
+        raise OAuthExchangeError(f"userinfo request failed: {e}") from e
+
+    if response.status_code != 200:
+        raise OAuthExchangeError(f"userinfo request failed with {response.status_code}")
+
+    return response.json()
@@ -0,0 +1,78 @@
+import asyncio
+import uuid
+
+from redis.asyncio import Redis
+
+from app.services.metrics_services import increment_counter
+from app.utils.config import settings
+
+QUOTA_METRICS_GROUP = "gmail_quota"
+
+DAY_WINDOW_MS = 24 * 60 * 60 * 1000
+SECOND_WINDOW_MS = 1000
+
+def daily_sends_key(account_id: str) -> str:
+    return f"gmail_quota:{account_id}:day"
+
+def second_sends_key(account_id: str) -> str:
+    return f"gmail_quota:{account_id}:second"
+
+#sliding window ledger of the sends of one gmail account (gmail enforces its quota per account): one sorted set per window, scored by the send time. The send is only
+#recorded in both windows when both have room, otherwise the script returns how long until the oldest send leaves the
+#full window. The redis clock is used so all workers agree on the time.
+RESERVE_SEND_SCRIPT = """
+local now_time = redis.call('time')
+local now = tonumber(now_time[1]) * 1000 + math.floor(tonumber(now_time[2]) / 1000)
+
+local windows = {
+    {KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[3])},
+    {KEYS[2], tonumber(ARGV[2]), tonumber(ARGV[4])},
+}
+
+for _, window in ipairs(windows) do
+    local key, window_ms, limit = window[1], window[2], window[3]
+    redis.call('zremrangebyscore', key, '-inf', now - window_ms)
+
+    if redis.call('zcard', key) >= limit then
+        local oldest = redis.call('zrange', key, 0, 0, 'WITHSCORES')
+        return tonumber(oldest[2]) + window_ms - now + 1
+    end
+end
+
+for _, window in ipairs(windows) do
+    redis.call('zadd', window[1], now, ARGV[5])
+    redis.call('pexpire', window[1], window[2])
+end
+
+return 0
+"""
+
+async def reserve_send_quota(redis_connection: Redis, account_id: str) -> int:
+    """
+    Record one send in the quota ledger of a sending account if the daily and per second limits both allow it.
+
+    :return: 0 when the send may go ahead, otherwise the milliseconds until the next send fits in the quota.
+    """
+    return await redis_connection.eval(RESERVE_SEND_SCRIPT, 2, daily_sends_key(account_id), second_sends_key(account_id),
+                                       DAY_WINDOW_MS, SECOND_WINDOW_MS, settings.GMAIL_DAILY_SEND_LIMIT,
+                                       settings.GMAIL_SENDS_PER_SECOND, uuid.uuid4().hex)
+
+async def wait_for_send_quota(redis_connection: Redis, account_id: str) -> int:
+    """
+    Called before every gmail send. Short waits (the per second limit) are slept through, a send that would only fit
+    after QUOTA_MAX_INLINE_WAIT_MS (the daily limit) is not attempted and has to be deferred by the caller.
+
+    :return: 0 when the send was recorded and may go ahead, otherwise the milliseconds to defer it by.
+    """
+    while True:
+        wait_ms = await reserve_send_quota(redis_connection, account_id)
+
+        if wait_ms == 0:
+            return 0
+
+        if wait_ms > settings.QUOTA_MAX_INLINE_WAIT_MS:
+            await increment_counter(redis_connection, QUOTA_METRICS_GROUP, "deferred", 1)
+            return wait_ms
+
+        await increment_counter(redis_connection, QUOTA_METRICS_GROUP, "throttled", 1)
+        await asyncio.sleep(wait_ms / 1000)
@@ -0,0 +1,209 @@
+import base64
+import json
+import os.path
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from app.db.redisConnection import sync_redis_client
+from app.services.storage_service import storage_breaker, storage_object_url, STORAGE_BUCKET
+from app.utils.config import settings
+
+TUS_VERSION = "1.0.0"
+
+#tus answers 404 or 410 for an upload url it no longer knows
+TUS_EXPIRED_STATUS_CODES = (404, 410)
+
+#one connection pool for all resumable uploads of the process, the parts of an upload reuse its connections
+_upload_client = httpx.Client(timeout=settings.STORAGE_UPLOAD_TIMEOUT_SECONDS,
+                              limits=httpx.Limits(max_connections=settings.STORAGE_UPLOAD_PARALLELISM * 2))
+
+_tus_extensions: set[str] | None = None
+
+class _UploadError(Exception):
+    pass
+
+class _UploadExpiredError(_UploadError):
+    """
+    The server no longer has the upload (or one of its parts), it has to start over.
+    """
+    pass
+
+def resumable_upload_key(object_name: str) -> str:
+    return f"resumable_upload:{object_name}"
+
+def _tus_endpoint() -> str:
+    return f"{settings.SUPABASE_S3_STORAGE_ENDPOINT}/upload/resumable"
+
+def _headers(**extra_headers: str) -> dict:
+    return {"Authorization": f"Bearer {settings.SUPABASE_SERVICE_ROLE}", "Tus-Resumable": TUS_VERSION, **extra_headers}
+
+def _request(method: str, url: str, **kwargs) -> httpx.Response:
+    with storage_breaker.guard() as breaker_call:
+        response = _upload_client.request(method, url, **kwargs)
+
+        if response.status_code >= 500:
+            breaker_call.record_failure()
+
+    return response
+
+def _server_extensions() -> set[str]:
+    #asked once per process, the server's capabilities do not change while we run. A failed probe is not remembered,
+    #the next upload asks again and uploads without concatenation meanwhile
+    global _tus_extensions
+
+    if _tus_extensions is not None:
+        return _tus_extensions
+
+    response = _request("OPTIONS", _tus_endpoint(), headers=_headers())
+    extensions = {extension.strip() for extension in response.headers.get("tus-extension", "").split(",") if extension.strip()}
+
+    if 200 <= response.status_code < 300:
+        _tus_extensions = extensions
+
+    return extensions
+
+def _metadata(object_name: str, content_type: str) -> str:
+    metadata = {"bucketName": STORAGE_BUCKET, "objectName": object_name, "contentType": content_type}
+    return ",".join(f"{key} {base64.b64encode(value.encode()).decode()}" for key, value in metadata.items())
+
+def _read(source: bytes | str, offset: int, length: int) -> bytes:
+    if isinstance(source, bytes):
+        return source[offset:offset + length]
+
+    #every part thread reads with its own file handle
+    with open(source, "rb") as source_file:
+        source_file.seek(offset)
+        return source_file.read(length)
+
+def _create_upload(length: int, **extra_headers: str) -> str:
+    response = _request("POST", _tus_endpoint(), headers=_headers(**{"Upload-Length": str(length), **extra_headers}))
+
+    if response.status_code != 201:
+        raise _UploadError(f"creating the upload failed with {response.status_code}")
+
+    return response.headers["location"]
+
+def _upload_offset(upload_url: str) -> int:
+    """
+    :raises _UploadExpiredError: when the server no longer has the upload.
+    """
+    response = _request("HEAD", upload_url, headers=_headers())
+
+    if response.status_code in TUS_EXPIRED_STATUS_CODES:
+        raise _UploadExpiredError(f"the upload expired ({response.status_code})")
+
+    if response.status_code != 200:
+        raise _UploadError(f"reading the upload offset failed with {response.status_code}")
+
+    return int(response.headers["upload-offset"])
+
+def _upload_part(source: bytes | str, upload_url: str, part_start: int, part_length: int) -> None:
+    """
+    Upload the bytes [part_start, part_start + part_length) of source to a tus upload, from the offset the server already
+    has. A failed chunk is retried up to STORAGE_UPLOAD_PART_RETRIES times with backoff, continuing from the offset the
+    server reports, so only the unconfirmed bytes are sent again.
+    """
+    offset = _upload_offset(upload_url)
+    failures = 0
+
+    while offset < part_length:
+        chunk = _read(source, part_start + offset, min(settings.STORAGE_UPLOAD_CHUNK_BYTES, part_length - offset))
+
+        try:
+            response = _request("PATCH", upload_url, content=chunk,
+                                headers=_headers(**{"Upload-Offset": str(offset), "Content-Type": "application/offset+octet-stream"}))
+
+            if response.status_code == 204:
+                offset = int(response.headers["upload-offset"])
+                failures = 0
+                continue
+
+            if response.status_code in TUS_EXPIRED_STATUS_CODES:
+                raise _UploadExpiredError(f"the upload expired ({response.status_code})")
+
+            if response.status_code < 500 and response.status_code != 409:
+                #409 is an offset the server does not agree with, anything else is not going to work on a retry
+                raise _UploadError(f"uploading a chunk failed with {response.status_code}")
+
+        except httpx.RequestError as e:
+            print(f"An error occurred while uploading a chunk: {e}")
+
+        failures += 1
+        if failures > settings.STORAGE_UPLOAD_PART_RETRIES:
+            raise _UploadError("uploading a chunk failed too often")
+
+        time.sleep(settings.STORAGE_UPLOAD_RETRY_BASE_DELAY_SECONDS * 2 ** (failures - 1))
+
+        offset = _upload_offset(upload_url)
+
+def _part_ranges(length: int) -> list[tuple[int, int]]:
+    #at most STORAGE_UPLOAD_PARALLELISM parts, none smaller than a chunk
+    part_bytes = max(settings.STORAGE_UPLOAD_CHUNK_BYTES, -(-length // settings.STORAGE_UPLOAD_PARALLELISM))
+    return [(start, min(part_bytes, length - start)) for start in range(0, length, part_bytes)]
+
+def upload_to_storage_resumable(source: bytes | str, object_name: str, content_type: str) -> str:
+    """
+    Upload a large file (content or path) to storage with the tus resumable upload protocol, in chunks of
+    STORAGE_UPLOAD_CHUNK_BYTES. When the server supports the tus concatenation extension, the file is split into up
+    to STORAGE_UPLOAD_PARALLELISM parts that are uploaded in parallel and joined by the server.
+
+    The upload urls are kept in redis, so an upload of the same object that was interrupted (crash, timeout, retry by
+    the client) continues where the server stopped instead of starting from zero.
+
+    :return: Full object url if upload was successful, "upload_failed" otherwise.
+    :raises CircuitOpenError: when the storage breaker is open.
+    """
+    length = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+    upload_key = resumable_upload_key(object_name)
+
+    try:
+        stored_upload = sync_redis_client.get(upload_key)
+        upload = json.loads(stored_upload) if stored_upload else None
+
+        if upload is None or upload["length"] != length or "parts" not in upload:
+            parallel = "concatenation" in _server_extensions() and length > settings.STORAGE_UPLOAD_CHUNK_BYTES
+            part_ranges = _part_ranges(length) if parallel else [(0, length)]
+
+            if parallel:
+                part_urls = [_create_upload(part_length, **{"Upload-Concat": "partial"}) for _, part_length in part_ranges]
+            else:
+                part_urls = [_create_upload(length, **{"Upload-Metadata": _metadata(object_name, content_type), "x-upsert": "true"})]
+
+            upload = {"length": length, "parallel": parallel, "parts": [[url, start, part_length] for url, (start, part_length) in zip(part_urls, part_ranges)]}
+            sync_redis_client.set(upload_key, json.dumps(upload), ex=settings.STORAGE_UPLOAD_RESUME_TTL_SECONDS)
+
+        with ThreadPoolExecutor(max_workers=min(settings.STORAGE_UPLOAD_PARALLELISM, len(upload["parts"]))) as part_pool:
+            part_uploads = [part_pool.submit(_upload_part, source, url, start, part_length) for url, start, part_length in upload["parts"]]
+
+            for part_upload in part_uploads:
+                part_upload.result()
+
+        if upload["parallel"]:
+            final_upload = _request("POST", _tus_endpoint(), headers=_headers(**{
+                "Upload-Concat": "final;" + " ".join(url for url, _, _ in upload["parts"]),
+                "Upload-Metadata": _metadata(object_name, content_type),
+                "x-upsert": "true"
+            }))
+
+            if final_upload.status_code in TUS_EXPIRED_STATUS_CODES:
+                raise _UploadExpiredError(f"joining the parts failed with {final_upload.status_code}")
+
+            if final_upload.status_code != 201:
+                raise _UploadError(f"joining the parts failed with {final_upload.status_code}")
+
+    except _UploadExpiredError as e:
+        #an upload that expired on the server has to start over
+        print(f"An error occurred while uploading the file: {e}")
+        sync_redis_client.delete(upload_key)
+        return "upload_failed"
+
+    except (_UploadError, httpx.RequestError) as e:
+        #otherwise the next attempt resumes it
+        print(f"An error occurred while uploading the file: {e}")
+        return "upload_failed"
+
+    sync_redis_client.delete(upload_key)
+
+    return storage_object_url(object_name)
@@ -0,0 +1,311 @@
+import json
+import random
+import time
+import uuid
+
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import WatchError
+
+from app.pydantic_schemas.dead_letter_pydantic import DeadLetterFilterSchema
+from app.utils.config import settings
+
+RETRY_SCHEDULE_KEY = "email_retry:schedule"
+RETRY_IN_FLIGHT_KEY = "email_retry:in_flight"
+
+#failed emails waited in one list per user (failed_email_queue:{uid}) before the schedule. Set once none are left, new
+#ones are never written
+LEGACY_RETRY_QUEUE_PATTERN = "failed_email_queue:*"
+LEGACY_RETRY_QUEUES_DRAINED_KEY = "email_retry:legacy_drained"
+
+def dead_email_queue_key(user_id: str | int) -> str:
+    return f"dead_email_queue:{user_id}"
+
+def retry_batch_key(batch_id: str) -> str:
+    return f"email_retry:batch:{batch_id}"
+
+#move the due retries into leased batches of up to ARGV[3] per user in one step: two sweepers running at the same time
+#never release the same retry, and a retry is never only in the memory of a sweeper that died
+LEASE_DUE_RETRIES_SCRIPT = """
+local due_retries = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #due_retries == 0 then
+    return {}
+end
+redis.call('zrem', KEYS[1], unpack(due_retries))
+local batch_size = tonumber(ARGV[3])
+local open_batches = {}
+local batches = {}
+local batch_count = 0
+for _, retry in ipairs(due_retries) do
+    local user_id = cjson.decode(retry)['user_id']
+    local batch = open_batches[user_id]
+    if batch == nil or batch['size'] == batch_size then
+        batch_count = batch_count + 1
+        batch = {id = ARGV[5] .. ':' .. batch_count, size = 0}
+        open_batches[user_id] = batch
+        table.insert(batches, user_id)
+        table.insert(batches, batch['id'])
+        redis.call('zadd', KEYS[2], tonumber(ARGV[4]), batch['id'])
+    end
+    redis.call('rpush', 'email_retry:batch:' .. batch['id'], retry)
+    batch['size'] = batch['size'] + 1
+end
+return batches
+"""
+
+#put the retries left in batches whose lease ran out (the worker died or never started) back into the schedule, due now
+REQUEUE_EXPIRED_BATCHES_SCRIPT = """
+local expired_batches = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local requeued = 0
+for _, batch_id in ipairs(expired_batches) do
+    redis.call('zrem', KEYS[1], batch_id)
+    local batch_key = 'email_retry:batch:' .. batch_id
+    for _, retry in ipairs(redis.call('lrange', batch_key, 0, -1)) do
+        redis.call('zadd', KEYS[2], tonumber(ARGV[1]), retry)
+        requeued = requeued + 1
+    end
+    redis.call('del', batch_key)
+end
+return requeued
+"""
+
+#move one legacy list into the schedule, due now. The email json is copied as is, decoding and encoding it in lua would
+#turn empty lists into objects
+DRAIN_LEGACY_RETRY_QUEUE_SCRIPT = """
+local drained = 0
+for _, email_json in ipairs(redis.call('lrange', KEYS[1], 0, -1)) do
+    drained = drained + 1
+    local retry = '{"retry_id": ' .. cjson.encode(ARGV[2] .. ':' .. drained) .. ', "user_id": ' .. cjson.encode(ARGV[3]) .. ', "email": ' .. email_json .. '}'
+    redis.call('zadd', KEYS[2], tonumber(ARGV[1]), retry)
+end
+redis.call('del', KEYS[1])
+return drained
+"""
+
+def _retry_member(user_id: str | int, email_data: dict) -> str:
+    #the retry id keeps two identical emails from collapsing into one member of the sorted set
+    return json.dumps({"retry_id": uuid.uuid4().hex, "user_id": str(user_id), "email": email_data})
+
+def retry_delay_seconds(retry_count: int) -> float:
+    """
+    Exponential backoff with jitter: the n-th retry waits between half and all of RETRY_BASE_DELAY_SECONDS * 2^(n-1),
+    capped at RETRY_MAX_DELAY_SECONDS, so emails that failed together (e.g. during an outage) do not retry together.
+    """
+    backoff = min(settings.RETRY_MAX_DELAY_SECONDS, settings.RETRY_BASE_DELAY_SECONDS * 2 ** max(0, retry_count - 1))
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+async def schedule_retry(redis_connection: Redis, user_id: str | int, email_data: dict, delay_seconds: float | None = None) -> float:
+    """
+    Schedule the next attempt of a failed email. Without delay_seconds the delay is the backoff for its retry_count.
+
+    :return: the delay in seconds.
+    """
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    delay_seconds = queue_retry(redis_pipeline, user_id, email_data, delay_seconds)
+    await redis_pipeline.execute()
+
+    return delay_seconds
+
+def queue_retry(redis_pipeline: Pipeline, user_id: str | int, email_data: dict, delay_seconds: float | None = None) -> float:
+    """
+    schedule_retry queued on a pipeline, for callers that record the failure together with other state.
+    """
+    if delay_seconds is None:
+        delay_seconds = retry_delay_seconds(email_data.get("retry_count", 1))
+
+    redis_pipeline.zadd(RETRY_SCHEDULE_KEY, {_retry_member(user_id, email_data): time.time() + delay_seconds})
+
+    return delay_seconds
+
+#only the owner of the lease defers a batch, a batch the sweep took back is already in the schedule again
+DEFER_BATCH_SCRIPT = """
+if not redis.call('zscore', KEYS[1], ARGV[1]) then
+    return 0
+end
+redis.call('zrem', KEYS[1], ARGV[1])
+local batch_key = 'email_retry:batch:' .. ARGV[1]
+local deferred = redis.call('lrange', batch_key, 0, -1)
+for _, retry in ipairs(deferred) do
+    redis.call('zadd', KEYS[2], tonumber(ARGV[2]), retry)
+end
+redis.call('del', batch_key)
+return #deferred
+"""
+
+async def lease_due_retries(redis_connection: Redis, limit: int) -> list[tuple[str, str]]:
+    """
+    Move up to limit retries whose next attempt time has passed out of the schedule into batches of up to
+    RETRY_BATCH_SIZE retries of one user. A batch is leased for RETRY_LEASE_SECONDS, its worker renews the lease with
+    every email it acks (queue_retry_ack) and the batches of dead workers are put back by requeue_expired_retry_batches.
+
+    :return: [(user_id, batch_id)]
+    """
+    batches = await redis_connection.eval(LEASE_DUE_RETRIES_SCRIPT, 2, RETRY_SCHEDULE_KEY, RETRY_IN_FLIGHT_KEY, time.time(), limit,
+                                          settings.RETRY_BATCH_SIZE, time.time() + settings.RETRY_LEASE_SECONDS, uuid.uuid4().hex)
+    return list(zip(batches[::2], batches[1::2]))
+
+async def requeue_expired_retry_batches(redis_connection: Redis, limit: int = 100) -> int:
+    """
+    :return: the number of retries that were put back into the schedule.
+    """
+    return await redis_connection.eval(REQUEUE_EXPIRED_BATCHES_SCRIPT, 2, RETRY_IN_FLIGHT_KEY, RETRY_SCHEDULE_KEY, time.time(), limit)
+
+async def drain_legacy_retry_queues(redis_connection: Redis) -> int:
+    """
+    Move the failed emails still waiting in the per user lists of the old retry task into the schedule, due now, so an
+    upgrade does not strand them. Once a sweep finds no such list, later sweeps skip the scan.
+
+    :return: the number of emails moved.
+    """
+    if await redis_connection.exists(LEGACY_RETRY_QUEUES_DRAINED_KEY):
+        return 0
+
+    drained = 0
+    async for legacy_queue_key in redis_connection.scan_iter(match=LEGACY_RETRY_QUEUE_PATTERN, _type="list"):
+        user_id = legacy_queue_key.split(":", 1)[1]
+        drained += await redis_connection.eval(DRAIN_LEGACY_RETRY_QUEUE_SCRIPT, 2, legacy_queue_key, RETRY_SCHEDULE_KEY,
+                                               time.time(), uuid.uuid4().hex, user_id)
+
+    if drained == 0:
+        await redis_connection.set(LEGACY_RETRY_QUEUES_DRAINED_KEY, 1)
+
+    return drained
+
+async def read_retry_batch(redis_connection: Redis, batch_id: str) -> list[str]:
+    """
+    :return: the retries of the batch that were not acked yet, as stored in the schedule.
+    """
+    return await redis_connection.lrange(retry_batch_key(batch_id), 0, -1)
+
+async def defer_retry_batch(redis_connection: Redis, batch_id: str, delay_seconds: float) -> int:
+    """
+    Put the retries of the batch that were not acked back into the schedule, due after delay_seconds, and end the
+    lease. Does nothing when the batch was already taken back by the sweep.
+
+    :return: the number of deferred retries.
+    """
+    return await redis_connection.eval(DEFER_BATCH_SCRIPT, 2, RETRY_IN_FLIGHT_KEY, RETRY_SCHEDULE_KEY, batch_id, time.time() + delay_seconds)
+
+def parse_retry(retry: str) -> dict:
+    """
+    :return: {"retry_id", "user_id", "email"}
+    """
+    return json.loads(retry)
+
+async def owns_retry_batch(redis_connection: Redis, batch_id: str) -> bool:
+    #the lease is gone once the batch expired and its retries were put back, another batch may be sending them now
+    return await redis_connection.zscore(RETRY_IN_FLIGHT_KEY, batch_id) is not None
+
+def queue_retry_ack(redis_pipeline: Pipeline, batch_id: str) -> None:
+    """
+    Ack the retry at the head of the batch and renew the batch's lease, queued on the pipeline that records its outcome.
+    """
+    redis_pipeline.lpop(retry_batch_key(batch_id))
+    redis_pipeline.zadd(RETRY_IN_FLIGHT_KEY, {batch_id: time.time() + settings.RETRY_LEASE_SECONDS}, xx=True)
+
+async def release_retry_batch(redis_connection: Redis, batch_id: str) -> None:
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    redis_pipeline.delete(retry_batch_key(batch_id))
+    redis_pipeline.zrem(RETRY_IN_FLIGHT_KEY, batch_id)
+    await redis_pipeline.execute()
+
+def queue_dead_letter(redis_pipeline: Pipeline, user_id: str | int, email_data: dict) -> None:
+    redis_pipeline.rpush(dead_email_queue_key(user_id), json.dumps(email_data))
+
+def dead_letter_error(email_data: dict) -> str:
+    return email_data.get("error") or "unknown"
+
+def _matches_dead_letter_filter(email_data: dict, dead_letter_filter: DeadLetterFilterSchema) -> bool:
+    if dead_letter_filter.error is not None and dead_letter_error(email_data) != dead_letter_filter.error:
+        return False
+
+    if dead_letter_filter.campaign_id is not None and email_data.get("campaign_id") != dead_letter_filter.campaign_id:
+        return False
+
+    return dead_letter_filter.eids is None or email_data.get("eid") in dead_letter_filter.eids
+
+async def list_dead_letters(redis_connection: Redis, user_id: str | int, offset: int, limit: int, error: str | None = None) -> tuple[int, list[dict]]:
+    """
+    One page of the user's dead letters in the order they died, optionally only those that failed with error.
+
+    :return: (number of matching dead letters, the page)
+    """
+    if error is None:
+        redis_pipeline = redis_connection.pipeline()
+        redis_pipeline.llen(dead_email_queue_key(user_id))
+        redis_pipeline.lrange(dead_email_queue_key(user_id), offset, offset + limit - 1)
+        total, page = await redis_pipeline.execute()
+
+        return total, [json.loads(email_json) for email_json in page]
+
+    matching = [
+        email_data for email_data in map(json.loads, await redis_connection.lrange(dead_email_queue_key(user_id), 0, -1))
+        if dead_letter_error(email_data) == error
+    ]
+
+    return len(matching), matching[offset:offset + limit]
+
+async def count_dead_letters_by_error(redis_connection: Redis, user_id: str | int) -> dict[str, int]:
+    error_counts: dict[str, int] = {}
+
+    for email_json in await redis_connection.lrange(dead_email_queue_key(user_id), 0, -1):
+        error = dead_letter_error(json.loads(email_json))
+        error_counts[error] = error_counts.get(error, 0) + 1
+
+    return dict(sorted(error_counts.items(), key=lambda error_count: error_count[1], reverse=True))
+
+async def _take_dead_letters(redis_connection: Redis, user_id: str | int, dead_letter_filter: DeadLetterFilterSchema, requeue: bool) -> list[dict]:
+    dead_queue_key = dead_email_queue_key(user_id)
+
+    while True:
+        async with redis_connection.pipeline(transaction=True) as redis_pipeline:
+            try:
+                #retry from scratch if an email dies while we are rewriting the dead letter queue
+                await redis_pipeline.watch(dead_queue_key)
+                dead_letters = await redis_pipeline.lrange(dead_queue_key, 0, -1)
+
+                kept_emails, taken_emails = [], []
+                for email_json in dead_letters:
+                    email_data = json.loads(email_json)
+
+                    if _matches_dead_letter_filter(email_data, dead_letter_filter):
+                        taken_emails.append(email_data)
+                    else:
+                        kept_emails.append(email_json)
+
+                if not taken_emails:
+                    await redis_pipeline.unwatch()
+                    return []
+
+                redis_pipeline.multi()
+                redis_pipeline.delete(dead_queue_key)
+                if kept_emails:
+                    redis_pipeline.rpush(dead_queue_key, *kept_emails)
+
+                if requeue:
+                    #requeued emails get a fresh set of attempts and are due right away
+                    redis_pipeline.zadd(RETRY_SCHEDULE_KEY, {
+                        _retry_member(user_id, {**email_data, "retry_count": 0}): time.time() for email_data in taken_emails
+                    })
+                await redis_pipeline.execute()
+
+                return taken_emails
+
+            except WatchError:
+                continue
+
+async def requeue_dead_letters(redis_connection: Redis, user_id: str | int, dead_letter_filter: DeadLetterFilterSchema) -> list[dict]:
+    """
+    Move the matching dead letters back into the retry schedule, due immediately, in one transaction.
+
+    :return: the requeued emails.
+    """
+    return await _take_dead_letters(redis_connection, user_id, dead_letter_filter, requeue=True)
+
+async def purge_dead_letters(redis_connection: Redis, user_id: str | int, dead_letter_filter: DeadLetterFilterSchema) -> list[dict]:
+    """
+    Delete the matching dead letters in one transaction.
+
+    :return: the purged emails.
+    """
+    return await _take_dead_letters(redis_connection, user_id, dead_letter_filter, requeue=False)
@@ -0,0 +1,61 @@
+import bisect
+import hashlib
+
+from app.utils.config import settings
+
+#tasks that read and rewrite per-user redis keys, they must never run in parallel for the same user
+USER_ROUTED_TASKS: set[str] = {"send_emails_from_user_queue"}
+
+#single manual sends, they get their own queue and workers so bulk campaign chunks can never delay them
+INTERACTIVE_TASKS: set[str] = {"send_email_now"}
+
+class ConsistentHashRing:
+    """
+    Consistent hash ring that maps users to a fixed set of celery queues.
+    Every queue is placed on the ring many times (virtual nodes) so users spread evenly, and adding or removing a queue
+    only moves the users of the ring segments next to it, roughly 1/len(queues) of all users.
+    """
+    def __init__(self, nodes: list[str], virtual_nodes: int = 100):
+        self._ring: list[tuple[int, str]] = sorted(
+            (self._hash(f"{node}#{replica}"), node) for node in nodes for replica in range(virtual_nodes)
+        )
+        self._hashes = [node_hash for node_hash, _ in self._ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        #python's hash() is salted per process, the ring has to give the same answer in every api and worker process
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def get_node(self, key: str) -> str | None:
+        if not self._ring:
+            return None
+
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+USER_TASK_QUEUES: list[str] = [queue.strip() for queue in settings.USER_TASK_QUEUES.split(",") if queue.strip()]
+
+user_queue_ring = ConsistentHashRing(USER_TASK_QUEUES)
+
+def queue_for_user(user_id: str | int) -> str | None:
+    return user_queue_ring.get_node(str(user_id))
+
+def route_user_task(name, args, kwargs, options, task=None, **kw):
+    """
+    Celery task router: the per-user tasks always go to the queue their user hashes to, so with one consumer per queue
+    two tasks of the same user run one after the other. Interactive tasks go to the interactive queue, all other tasks
+    use the default queue.
+    """
+    if name in INTERACTIVE_TASKS:
+        return {"queue": settings.INTERACTIVE_TASK_QUEUE}
+
+    if name not in USER_ROUTED_TASKS:
+        return None
+
+    user_id = kwargs.get("user_id") if kwargs and "user_id" in kwargs else (args[0] if args else None)
+
+    if user_id is None:
+        return None
+
+    user_queue = queue_for_user(user_id)
+    return {"queue": user_queue} if user_queue else None
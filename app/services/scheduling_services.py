@@ -0,0 +1,231 @@
+import json
+import time
+import uuid
+
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+
+from app.services.campaign_services import campaign_chunk_key
+from app.services.metrics_services import increment_counter
+from app.utils.config import settings
+
+FAIR_ACTIVE_USERS_KEY = "fair:active"
+FAIR_DEFICITS_KEY = "fair:deficit"
+FAIR_DEFERRED_CHUNKS_KEY = "fair:deferred"
+FAIR_IN_PROGRESS_KEY = "fair:in_progress"
+USER_PLAN_KEY = "user_plan"
+SCHEDULER_METRICS_GROUP = "fair_scheduler"
+
+#parse "free:1,pro:2" once, the same way the rate limit paths are parsed
+PLAN_WEIGHTS: dict[str, float] = {
+    plan.strip(): float(weight)
+    for plan, weight in (entry.split(":", 1) for entry in settings.FAIR_PLAN_WEIGHTS.split(",") if ":" in entry)
+}
+
+def fair_user_queue_key(user_id: str | int) -> str:
+    return f"fair:queue:{user_id}"
+
+def chunk_lease_member(user_id: str | int, campaign_id: str, run: int, chunk_index: int, lease_token: str) -> str:
+    return f"{user_id}:{campaign_id}:{run}:{chunk_index}:{lease_token}"
+
+def chunk_lease_key(campaign_id: str, run: int, chunk_index: int) -> str:
+    #the token of the pick that holds the chunk, a worker whose token is no longer in there lost the chunk
+    return f"{campaign_chunk_key(campaign_id, run, chunk_index)}:lease"
+
+#deficit round robin over the active users, picking exactly one chunk per call. The user at the head of the ring is
+#served while its deficit covers the size of its next chunk, otherwise it gets its quantum (scaled by its plan weight)
+#and moves to the back of the ring. Users whose sub-queue is empty leave the ring and lose their deficit.
+#the picked chunk gets a lease with the token of this pick in the same step, so a chunk can never be lost between the
+#pick and its worker starting
+PICK_CHUNK_SCRIPT = """
+local plan_weights = cjson.decode(ARGV[1])
+local quantum = tonumber(ARGV[2])
+local max_steps = tonumber(ARGV[3])
+
+for step = 1, max_steps do
+    local user_id = redis.call('lindex', KEYS[1], 0)
+    if not user_id then
+        return nil
+    end
+
+    local user_queue = 'fair:queue:' .. user_id
+    local next_chunk = redis.call('lindex', user_queue, 0)
+
+    if not next_chunk then
+        redis.call('lpop', KEYS[1])
+        redis.call('hdel', KEYS[2], user_id)
+    else
+        local chunk_size = cjson.decode(next_chunk)['size']
+        local deficit = tonumber(redis.call('hget', KEYS[2], user_id) or '0')
+
+        if deficit >= chunk_size then
+            redis.call('lpop', user_queue)
+
+            local chunk = cjson.decode(next_chunk)
+            local chunk_key = 'campaign:' .. chunk['campaign_id'] .. ':run:' .. chunk['run'] .. ':chunk:' .. chunk['chunk_index']
+            redis.call('set', chunk_key .. ':lease', ARGV[5], 'EX', tonumber(ARGV[6]))
+            redis.call('zadd', KEYS[4], tonumber(ARGV[4]), chunk['user_id'] .. ':' .. chunk['campaign_id'] .. ':' .. chunk['run'] .. ':' .. chunk['chunk_index'] .. ':' .. ARGV[5])
+
+            if redis.call('llen', user_queue) == 0 then
+                redis.call('lpop', KEYS[1])
+                redis.call('hdel', KEYS[2], user_id)
+            else
+                redis.call('hset', KEYS[2], user_id, deficit - chunk_size)
+            end
+
+            return next_chunk
+        end
+
+        local plan = redis.call('hget', KEYS[3], user_id) or 'default'
+        local weight = plan_weights[plan] or plan_weights['default'] or 1
+        redis.call('hset', KEYS[2], user_id, deficit + quantum * weight)
+        redis.call('lmove', KEYS[1], KEYS[1], 'LEFT', 'RIGHT')
+    end
+end
+
+return nil
+"""
+
+#end a lease only while it is still held by the given token, a worker that lost its chunk can not end the lease of the
+#worker that has it now
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[2]) ~= ARGV[2] then
+    return 0
+end
+redis.call('del', KEYS[2])
+redis.call('zrem', KEYS[1], ARGV[1])
+if KEYS[3] then
+    redis.call('zadd', KEYS[3], tonumber(ARGV[3]), ARGV[4])
+end
+return 1
+"""
+
+#register the user in the ring only when it is not in there already, in the same step as its chunks are queued
+ENQUEUE_CHUNKS_SCRIPT = """
+for i = 2, #ARGV do
+    redis.call('rpush', KEYS[2], ARGV[i])
+end
+if not redis.call('lpos', KEYS[1], ARGV[1]) then
+    redis.call('rpush', KEYS[1], ARGV[1])
+end
+return redis.call('llen', KEYS[2])
+"""
+
+def _fair_chunk(user_id: str | int, campaign_id: str, run: int, chunk_index: int, chunk_size: int) -> dict:
+    return {"user_id": str(user_id), "campaign_id": campaign_id, "run": run, "chunk_index": chunk_index, "size": chunk_size, "enqueued_at": time.time()}
+
+async def _push_fair_chunks(redis_connection: Redis, user_id: str | int, chunks: list[dict]) -> None:
+    await redis_connection.eval(ENQUEUE_CHUNKS_SCRIPT, 2, FAIR_ACTIVE_USERS_KEY, fair_user_queue_key(user_id), str(user_id),
+                                *[json.dumps(chunk) for chunk in chunks])
+
+async def enqueue_fair_chunks(redis_connection: Redis, user_id: str | int, campaign_id: str, run: int, chunk_sizes: list[int]) -> None:
+    """
+    Put the chunks of a campaign run into the user's sub-queue of the fair scheduler.
+    """
+    await _push_fair_chunks(redis_connection, user_id, [
+        _fair_chunk(user_id, campaign_id, run, chunk_index, chunk_size) for chunk_index, chunk_size in enumerate(chunk_sizes)
+    ])
+
+async def defer_fair_chunk(redis_connection: Redis, user_id: str | int, campaign_id: str, run: int, chunk_index: int, lease_token: str,
+                           chunk_size: int, delay_ms: int) -> bool:
+    """
+    Park a chunk that cannot be sent yet (e.g. the user is out of gmail quota) until delay_ms from now. It goes back
+    into the user's sub-queue when release_deferred_chunks finds it due. The worker's lease on the chunk ends in the
+    same step.
+
+    :return: False when the lease was lost, the chunk is then not the worker's to defer.
+    """
+    chunk = _fair_chunk(user_id, campaign_id, run, chunk_index, chunk_size)
+
+    return bool(await redis_connection.eval(RELEASE_LEASE_SCRIPT, 3, FAIR_IN_PROGRESS_KEY, chunk_lease_key(campaign_id, run, chunk_index), FAIR_DEFERRED_CHUNKS_KEY,
+                                            chunk_lease_member(user_id, campaign_id, run, chunk_index, lease_token), lease_token,
+                                            chunk["enqueued_at"] + delay_ms / 1000, json.dumps(chunk)))
+
+async def release_deferred_chunks(redis_connection: Redis, limit: int = 100) -> int:
+    """
+    Move the deferred chunks that are due back into the fair scheduler.
+
+    :return: the number of chunks released, the caller starts one send slot per chunk.
+    """
+    due_chunks = await redis_connection.zrangebyscore(FAIR_DEFERRED_CHUNKS_KEY, "-inf", time.time(), start=0, num=limit)
+
+    released_chunks = 0
+    for chunk_json in due_chunks:
+        #only the sweeper whose ZREM removes the chunk releases it, so overlapping sweeps never release a chunk twice
+        if not await redis_connection.zrem(FAIR_DEFERRED_CHUNKS_KEY, chunk_json):
+            continue
+
+        chunk = json.loads(chunk_json)
+        await _push_fair_chunks(redis_connection, chunk["user_id"], [{**chunk, "enqueued_at": time.time()}])
+        released_chunks += 1
+
+    return released_chunks
+
+async def pick_fair_chunk(redis_connection: Redis) -> dict | None:
+    """
+    Pick the next chunk to send across all users by deficit round robin, so one big campaign cannot hold back the small
+    batches of other users, and record how long the chunk waited. The worker holds a lease on the chunk until it calls
+    release_chunk_lease, and has to renew it while it is sending.
+
+    :return: the chunk with the lease_token of this pick, which the worker passes to every lease operation.
+    """
+    lease_token = uuid.uuid4().hex
+    picked_chunk = await redis_connection.eval(PICK_CHUNK_SCRIPT, 4, FAIR_ACTIVE_USERS_KEY, FAIR_DEFICITS_KEY, USER_PLAN_KEY, FAIR_IN_PROGRESS_KEY,
+                                               json.dumps(PLAN_WEIGHTS), settings.FAIR_QUANTUM, settings.FAIR_MAX_PICK_STEPS,
+                                               time.time() + settings.CHUNK_LEASE_SECONDS, lease_token, settings.CAMPAIGN_TTL_SECONDS)
+
+    if picked_chunk is None:
+        return None
+
+    chunk = {**json.loads(picked_chunk), "lease_token": lease_token}
+    wait_ms = int((time.time() - chunk["enqueued_at"]) * 1000)
+
+    await increment_counter(redis_connection, SCHEDULER_METRICS_GROUP, f"user:{chunk['user_id']}:wait_ms_total", wait_ms)
+    await increment_counter(redis_connection, SCHEDULER_METRICS_GROUP, f"user:{chunk['user_id']}:chunks", 1)
+
+    return chunk
+
+async def owns_chunk_lease(redis_connection: Redis, campaign_id: str, run: int, chunk_index: int, lease_token: str) -> bool:
+    return await redis_connection.get(chunk_lease_key(campaign_id, run, chunk_index)) == lease_token
+
+def queue_chunk_lease_renewal(redis_pipeline: Pipeline, user_id: str | int, campaign_id: str, run: int, chunk_index: int, lease_token: str) -> None:
+    """
+    Queue the renewal of a chunk lease on a pipeline, so it is extended together with the worker's checkpoint. The
+    checkpoint has to WATCH chunk_lease_key and check owns_chunk_lease first, the renewal itself does not check the owner.
+    """
+    redis_pipeline.zadd(FAIR_IN_PROGRESS_KEY, {chunk_lease_member(user_id, campaign_id, run, chunk_index, lease_token): time.time() + settings.CHUNK_LEASE_SECONDS}, xx=True)
+
+async def release_chunk_lease(redis_connection: Redis, user_id: str | int, campaign_id: str, run: int, chunk_index: int, lease_token: str) -> bool:
+    """
+    :return: False when the lease was already lost.
+    """
+    return bool(await redis_connection.eval(RELEASE_LEASE_SCRIPT, 2, FAIR_IN_PROGRESS_KEY, chunk_lease_key(campaign_id, run, chunk_index),
+                                            chunk_lease_member(user_id, campaign_id, run, chunk_index, lease_token), lease_token))
+
+async def requeue_expired_chunks(redis_connection: Redis, limit: int = 100) -> int:
+    """
+    Put the chunks whose worker died (the lease ran out without being renewed) back into the fair scheduler. The chunk
+    list only holds the emails that were not checkpointed yet, so the next worker resumes where the dead one stopped.
+
+    :return: the number of chunks requeued, the caller starts one send slot per chunk.
+    """
+    expired_leases = await redis_connection.zrangebyscore(FAIR_IN_PROGRESS_KEY, "-inf", time.time(), start=0, num=limit)
+
+    requeued_chunks = 0
+    for lease_member in expired_leases:
+        #only the sweeper whose ZREM removes the lease requeues the chunk
+        if not await redis_connection.zrem(FAIR_IN_PROGRESS_KEY, lease_member):
+            continue
+
+        user_id, campaign_id, run, chunk_index, lease_token = lease_member.rsplit(":", 4)
+
+        #the worker that held the lease stops at its next checkpoint
+        await release_chunk_lease(redis_connection, user_id, campaign_id, int(run), int(chunk_index), lease_token)
+
+        remaining_emails = await redis_connection.llen(campaign_chunk_key(campaign_id, int(run), int(chunk_index)))
+
+        #a chunk with nothing left still has to go through a worker, which commits its results and finishes it
+        await _push_fair_chunks(redis_connection, user_id, [_fair_chunk(user_id, campaign_id, int(run), int(chunk_index), remaining_emails)])
+        requeued_chunks += 1
+
+    return requeued_chunks
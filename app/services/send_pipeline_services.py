@@ -0,0 +1,393 @@
+import asyncio
+import os.path
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Awaitable, Callable, Iterable
+
+from google.auth.exceptions import RefreshError
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from sqlalchemy.orm import Session
+
+from app.models import User, Email, Attachment
+from app.pydantic_schemas.email_pydantic import EmailSchema
+from app.services.attachment_services import get_user_attachments, cached_attachment_path
+from app.services.circuit_breaker_services import CircuitOpenError
+from app.services.concurrency_services import GmailThrottledError, acquire_send_slot, release_send_slot
+from app.services.idempotency_services import claim_email_send, release_email_send, queue_email_sent, queue_email_send_release
+from app.services.metrics_services import metrics_key, METRICS_GROUPS_KEY
+from app.services.quota_services import wait_for_send_quota
+from app.services.sender_services import pick_sender_account, sender_account_id
+from app.services.storage_service import get_file_from_storage
+from app.services.token_services import get_google_access_token_async
+from app.services.transport_services import build_mime_message, get_email_transport
+from app.utils.config import settings
+
+SEND_PIPELINE_METRICS_GROUP = "send_pipeline"
+
+
+class SendResult:
+    """
+    Outcome of one email of a pipeline run:
+        sent       google_message_id is set. duplicate when an earlier attempt had already sent the eid
+        failed     worth retrying, error says why (None when gmail refused the email)
+        dead       retrying can never work, error says why
+        in_flight  another attempt is sending the eid right now, retry_in_ms until its claim expires
+        deferred   this and the rest of the batch were not attempted: out of quota or a breaker is open (reason) for retry_in_ms
+        stopped    this and the rest of the batch were not attempted because should_stop asked the run to stop
+    """
+    def __init__(self, index: int, email_data: dict, outcome: str, email_object: EmailSchema | None = None, *,
+                 google_message_id: str | None = None, error: str | None = None, exception: Exception | None = None,
+                 retry_in_ms: int = 0, reason: str | None = None, claim_owner: str | None = None, duplicate: bool = False):
+        self.index = index
+        self.email_data = email_data
+        self.outcome = outcome
+        self.email_object = email_object
+        self.google_message_id = google_message_id
+        self.error = error
+        self.exception = exception
+        self.retry_in_ms = retry_in_ms
+        self.reason = reason
+        self.claim_owner = claim_owner
+        self.duplicate = duplicate
+
+    def queue_claim_outcome(self, redis_pipeline: Pipeline) -> None:
+        """
+        Record the outcome of the send claim taken by this run (if any) on the pipeline that persists the rest of the
+        result: the eid is marked sent, or released for the next attempt.
+        """
+        if self.claim_owner is None:
+            return
+
+        if self.outcome == "sent":
+            queue_email_sent(redis_pipeline, self.email_object.eid, self.google_message_id)
+        else:
+            queue_email_send_release(redis_pipeline, self.email_object.eid, self.claim_owner)
+
+
+class SendPipeline:
+    """
+    The one send path of the app, shared by send-email-now, campaign chunks and retries. A run takes a batch of emails
+    of one user and passes every email through the stages:
+
+        attach   resolve the resume and the attachments of the email, from the attachment cache or once per batch
+        claim    claim the eid, so no other attempt sends it at the same time or again (only with a claim_owner)
+        account  pick the sending account, get its token, check its quota and take an AIMD concurrency slot
+        build    build the MIME message
+        send     hand it to the account's transport
+        persist  the caller's persist(result), which records the outcome the way its entry point needs it
+
+    Stage timings are counted in the send_pipeline metrics group once per run and passed to every timing hook as
+    hook(stage, seconds), so improvements and regressions of a stage show up for all entry points at once.
+    """
+    def __init__(self, redis_connection: Redis, db_connection: Session, user: User | None, claim_owner: str | None = None,
+                 timing_hooks: Iterable[Callable[[str, float], None]] = ()):
+        self.redis = redis_connection
+        self.db = db_connection
+        self.user = user
+        self.claim_owner = claim_owner
+        self.timing_hooks = list(timing_hooks)
+
+        self._resume: tuple[str, str, str] | str | None = None
+        self._resume_path: str | None = None
+        self._attachments: dict[int, Attachment] = {}
+        self._stage_seconds: dict[str, float] = {}
+        self._stage_calls: dict[str, int] = {}
+
+    @contextmanager
+    def _timed(self, stage: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started_at
+            self._stage_seconds[stage] = self._stage_seconds.get(stage, 0) + seconds
+            self._stage_calls[stage] = self._stage_calls.get(stage, 0) + 1
+
+            for hook in self.timing_hooks:
+                hook(stage, seconds)
+
+    async def run(self, emails: list[dict], persist: Callable[[SendResult], Awaitable[None]],
+                  should_stop: Callable[[], Awaitable[bool]] | None = None,
+                  on_email_start: Callable[[dict], Awaitable[None]] | None = None) -> list[SendResult]:
+        """
+        Send a batch of emails in order. persist is awaited with the result of every email before the next one starts,
+        a deferred or stopped result ends the run.
+
+        :param should_stop: asked before every email, e.g. whether the campaign was paused.
+        :param on_email_start: awaited when an email is about to be attempted.
+        :return: the results, the last one is deferred or stopped when the run ended early.
+        """
+        results = []
+
+        try:
+            for index, email_data in enumerate(emails):
+                if should_stop is not None and await should_stop():
+                    result = SendResult(index, email_data, "stopped")
+
+                else:
+                    if on_email_start is not None:
+                        await on_email_start(email_data)
+
+                    result = await self._send_email(index, email_data)
+
+                with self._timed("persist"):
+                    await persist(result)
+
+                results.append(result)
+
+                if result.outcome in ("deferred", "stopped"):
+                    break
+
+        finally:
+            self._remove_attachments()
+            await self._record_stage_timings()
+
+        return results
+
+    async def _send_email(self, index: int, email_data: dict) -> SendResult:
+        email_object = EmailSchema.model_validate(email_data)
+
+        if self.user is None or not self.user.user_tokens:
+            #the user is gone or revoked gmail access, retrying can never work
+            return SendResult(index, email_data, "dead", email_object, error="gmail_not_authorized")
+
+        attachments = []
+
+        if email_object.include_resume or email_object.attachment_ids:
+            with self._timed("attach"):
+                try:
+                    #downloads and db reads, off the event loop
+                    attachments = await asyncio.to_thread(self._email_attachments, email_object)
+
+                except CircuitOpenError as e:
+                    #storage is down, failing every remaining email one timeout at a time would not help anybody
+                    return SendResult(index, email_data, "deferred", email_object, retry_in_ms=e.retry_after_ms, reason=e.name)
+
+            if attachments in ("resume_missing", "attachment_missing"):
+                return SendResult(index, email_data, "dead", email_object, error=attachments)
+
+            if attachments in ("resume_download_failed", "attachment_download_failed"):
+                return SendResult(index, email_data, "failed", email_object, error=attachments)
+
+        claim_owner = self.claim_owner if email_object.eid is not None else None
+
+        if claim_owner is not None:
+            with self._timed("claim"):
+                claim_outcome, claim_value = await claim_email_send(self.redis, email_object.eid, claim_owner)
+
+            if claim_outcome == "sent":
+                #a retry or an earlier run already sent this eid, report its first result instead of sending it again
+                return SendResult(index, email_data, "sent", email_object, google_message_id=claim_value, duplicate=True)
+
+            if claim_outcome == "in_flight":
+                #look again once its claim expired, by then it is either sent or released
+                return SendResult(index, email_data, "in_flight", email_object, error="duplicate_in_flight", retry_in_ms=claim_value)
+
+        try:
+            service_response, defer_ms = await self._send_from_user_accounts(email_object, attachments)
+
+        except CircuitOpenError as e:
+            #gmail or google oauth is down, the email was not attempted
+            if claim_owner is not None:
+                await release_email_send(self.redis, email_object.eid, claim_owner)
+            return SendResult(index, email_data, "deferred", email_object, retry_in_ms=e.retry_after_ms, reason=e.name)
+
+        except Exception as e:
+            print(f"Error sending email: {e}")
+            return SendResult(index, email_data, "failed", email_object, error=str(e), exception=e, claim_owner=claim_owner)
+
+        if defer_ms:
+            #the account is out of gmail quota, the rest of the batch would only be refused by gmail
+            if claim_owner is not None:
+                await release_email_send(self.redis, email_object.eid, claim_owner)
+            return SendResult(index, email_data, "deferred", email_object, retry_in_ms=defer_ms, reason="gmail_quota")
+
+        if service_response:
+            return SendResult(index, email_data, "sent", email_object, google_message_id=service_response.get("id"), claim_owner=claim_owner)
+
+        return SendResult(index, email_data, "failed", email_object, claim_owner=claim_owner)
+
+    def _email_attachments(self, email_object: EmailSchema) -> list[tuple[str, str, str]] | str:
+        """
+        :return: (file path, filename in the email, content type) of every attachment of the email, or the error when
+                 one of them is missing or could not be downloaded.
+        """
+        attachments = []
+
+        if email_object.include_resume:
+            if not self.user.resume:
+                return "resume_missing"
+
+            resume = self._resume_attachment()
+
+            if resume == "download_failed":
+                return "resume_download_failed"
+
+            attachments.append(resume)
+
+        if email_object.attachment_ids:
+            #the rows are loaded once per batch, the files are cached by hash across batches
+            missing_ids = [attachment_id for attachment_id in email_object.attachment_ids if attachment_id not in self._attachments]
+            self._attachments.update(get_user_attachments(self.db, self.user.uid, missing_ids))
+
+            for attachment_id in email_object.attachment_ids:
+                attachment = self._attachments.get(attachment_id)
+
+                if attachment is None:
+                    return "attachment_missing"
+
+                attachment_path = cached_attachment_path(attachment)
+
+                if attachment_path == "download_failed":
+                    return "attachment_download_failed"
+
+                attachments.append((attachment_path, attachment.filename, attachment.content_type))
+
+        return attachments
+
+    def _resume_attachment(self) -> tuple[str, str, str] | str:
+        #one download per batch, a failed download is tried again by the next email that needs it
+        if self._resume is not None and self._resume != "download_failed":
+            return self._resume
+
+        resume_attachment = self.db.query(Attachment).filter(Attachment.uid == self.user.uid, Attachment.object_url == self.user.resume).first()
+
+        if resume_attachment is not None:
+            resume_path = cached_attachment_path(resume_attachment)
+            self._resume = resume_path if resume_path == "download_failed" else (resume_path, resume_attachment.filename, resume_attachment.content_type)
+            return self._resume
+
+        #a resume uploaded before attachments existed, stored as resume/{uid}_{name}.pdf
+        self._resume_path = get_file_from_storage(object_url=self.user.resume)
+
+        if self._resume_path == "download_failed":
+            self._resume = "download_failed"
+            return self._resume
+
+        username = os.path.basename(self._resume_path).replace(".pdf", "_resume.pdf").split("_", 1)
+        self._resume = (self._resume_path, username[1], "application/pdf")
+
+        return self._resume
+
+    def _remove_attachments(self) -> None:
+        #only a legacy resume download is removed, attachments stay in the cache
+        if self._resume_path and self._resume_path != "download_failed" and os.path.exists(self._resume_path):
+            os.remove(self._resume_path)
+
+        self._resume_path = None
+        self._resume = None
+
+    async def _send_from_user_accounts(self, email_object: EmailSchema, attachments: list[tuple[str, str, str]]) -> tuple[dict | None, int]:
+        """
+        Send one email from one of the user's connected gmail accounts (see pick_sender_account), within the account's
+        gmail quota and inside a slot of the adaptive (AIMD) concurrency limits. A throttled send is retried up to
+        GMAIL_THROTTLE_RETRIES times, on another account while the user has one that was not throttled yet, otherwise on
+        the same account once a new slot was granted, which waits out the Retry-After. An account whose grant was revoked
+        is skipped the same way.
+
+        :return: the gmail response and 0, or None and the ms to defer the email by when its account is out of quota.
+        """
+        user = self.user
+        skipped_token_ids = set()
+
+        for attempt in range(settings.GMAIL_THROTTLE_RETRIES + 1):
+            with self._timed("account"):
+                user_token = await pick_sender_account(self.redis, user.uid, user.user_tokens, email_object.to_email, skipped_token_ids)
+                account_id = sender_account_id(user_token)
+                transport = get_email_transport(user_token.transport)
+
+                try:
+                    google_access_token = await get_google_access_token_async(user_token, self.db, self.redis) if transport.requires_google_token else None
+
+                except RefreshError:
+                    skipped_token_ids.add(user_token.token_id)
+
+                    #out of accounts or out of attempts, the loop must never end without a result
+                    if len(skipped_token_ids) == len(user.user_tokens) or attempt == settings.GMAIL_THROTTLE_RETRIES:
+                        raise
+                    continue
+
+                quota_wait_ms = await wait_for_send_quota(self.redis, account_id)
+
+                if quota_wait_ms:
+                    return None, quota_wait_ms
+
+                lease_id = await acquire_send_slot(self.redis, account_id)
+
+            from_email = user_token.sender_email or user.email
+
+            try:
+                #reading the attachments and the blocking transports run in a worker thread, the event loop keeps serving
+                #the redis calls of the run meanwhile
+                with self._timed("build"):
+                    message = await asyncio.to_thread(build_mime_message, email_object, from_email, attachments)
+
+                with self._timed("send"):
+                    service_response = await asyncio.to_thread(transport.send, message, google_access_token, from_email)
+
+            except GmailThrottledError as e:
+                await release_send_slot(self.redis, account_id, lease_id, "server_error" if e.provider_wide else "throttled", e.retry_after_ms)
+
+                if attempt == settings.GMAIL_THROTTLE_RETRIES:
+                    raise
+
+                skipped_token_ids.add(user_token.token_id)
+                continue
+
+            except Exception:
+                await release_send_slot(self.redis, account_id, lease_id, "neutral")
+                raise
+
+            await release_send_slot(self.redis, account_id, lease_id, "success" if service_response else "neutral")
+            return service_response, 0
+
+    async def _record_stage_timings(self) -> None:
+        if not self._stage_calls:
+            return
+
+        redis_pipeline = self.redis.pipeline()
+        for stage, calls in self._stage_calls.items():
+            redis_pipeline.hincrby(metrics_key(SEND_PIPELINE_METRICS_GROUP), f"{stage}:calls", calls)
+            redis_pipeline.hincrbyfloat(metrics_key(SEND_PIPELINE_METRICS_GROUP), f"{stage}:seconds", round(self._stage_seconds[stage], 6))
+        redis_pipeline.sadd(METRICS_GROUPS_KEY, SEND_PIPELINE_METRICS_GROUP)
+        await redis_pipeline.execute()
+
+        self._stage_seconds.clear()
+        self._stage_calls.clear()
+
+
+def save_sent_email(db_connection: Session, user_id: str | int, email_object: EmailSchema, google_message_id: str) -> Email | None:
+    """
+    Mark a sent email as sent in the db, or add it when it never had a row (e.g. a send-email-now email). The caller commits.
+    The eid of a send-email-now email comes from the client, an eid of another user is ignored and the email is added.
+
+    :return: the added email, None when an existing row was updated.
+    """
+    if email_object.eid:
+        updated_rows = db_connection.query(Email).filter(Email.eid == email_object.eid, Email.uid == user_id).update({
+            Email.is_sent: True,
+            Email.google_message_id: google_message_id,
+            Email.send_at: datetime.utcnow()
+        })
+
+        if updated_rows:
+            return None
+
+    sent_email = Email(
+        uid=user_id,
+        google_message_id=google_message_id,
+        subject=email_object.subject,
+        body=email_object.body,
+        is_sent=True,
+        to_email=email_object.to_email,
+        cc_email=email_object.cc_email,
+        bcc_email=email_object.bcc_email,
+        send_at=datetime.utcnow(),
+        include_resume=email_object.include_resume,
+        attachment_ids=email_object.attachment_ids
+    )
+    db_connection.add(sent_email)
+
+    return sent_email
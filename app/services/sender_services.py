@@ -0,0 +1,61 @@
+import random
+import time
+
+from redis.asyncio import Redis
+
+from app.models import UserToken
+from app.services.quota_services import daily_sends_key, DAY_WINDOW_MS
+from app.services.token_services import google_token_revoked_key
+from app.utils.config import settings
+
+def sender_account_id(user_token: UserToken) -> str:
+    """
+    Id of a connected gmail account in the quota ledger and the concurrency limits.
+    """
+    return f"{user_token.uid}:{user_token.token_id}"
+
+def sticky_senders_key(user_id: str | int) -> str:
+    return f"sender_sticky:{user_id}"
+
+async def pick_sender_account(redis_connection: Redis, user_id: str | int, user_tokens: list[UserToken], recipient: str,
+                              exclude_token_ids: set[int] | None = None) -> UserToken:
+    """
+    Pick the gmail account of the user that sends the next email to recipient.
+
+    A recipient keeps the account that wrote to it before, so a conversation stays in one mailbox, as long as that
+    account is usable and has quota left. Otherwise the account is drawn at random weighted by its remaining daily
+    quota, so a campaign is spread over all accounts and they run out of quota together. Revoked accounts and the
+    excluded ones (e.g. throttled right now) are only used when no other account is left.
+    """
+    exclude_token_ids = exclude_token_ids or set()
+
+    redis_pipeline = redis_connection.pipeline()
+    window_start = time.time() * 1000 - DAY_WINDOW_MS
+    for user_token in user_tokens:
+        redis_pipeline.exists(google_token_revoked_key(user_token.token_id))
+        redis_pipeline.zcount(daily_sends_key(sender_account_id(user_token)), window_start, "+inf")
+    redis_pipeline.hget(sticky_senders_key(user_id), recipient)
+    *account_states, sticky_token_id = await redis_pipeline.execute()
+
+    remaining_quota = {
+        user_token.token_id: max(0, settings.GMAIL_DAILY_SEND_LIMIT - sent_today)
+        for user_token, is_revoked, sent_today in zip(user_tokens, account_states[::2], account_states[1::2])
+        if not is_revoked and user_token.token_id not in exclude_token_ids
+    }
+
+    candidates = [user_token for user_token in user_tokens if user_token.token_id in remaining_quota] or user_tokens
+
+    sender = next((user_token for user_token in candidates if str(user_token.token_id) == sticky_token_id and remaining_quota.get(user_token.token_id)), None)
+
+    if sender is None:
+        weights = [remaining_quota.get(user_token.token_id, 0) for user_token in candidates]
+        #every account is out of quota: any of them, the quota check defers the email
+        sender = random.choices(candidates, weights=weights)[0] if any(weights) else random.choice(candidates)
+
+    if str(sender.token_id) != sticky_token_id:
+        redis_pipeline = redis_connection.pipeline(transaction=True)
+        redis_pipeline.hset(sticky_senders_key(user_id), recipient, sender.token_id)
+        redis_pipeline.expire(sticky_senders_key(user_id), settings.SENDER_STICKY_TTL_SECONDS)
+        await redis_pipeline.execute()
+
+    return sender
@@ -1,13 +1,25 @@
 import httpx
 import os
+from app.db.redisConnection import sync_redis_client
+from app.services.circuit_breaker_services import CircuitBreaker
 from app.utils.config import settings
 
-def get_file_from_storage(object_url: str) -> str:
+#shared by downloads and uploads, both go to the same supabase storage api
+storage_breaker = CircuitBreaker("supabase_storage", sync_redis_client)
+
+STORAGE_BUCKET = "mailstorm-storage"
+
+def storage_object_url(object_name: str) -> str:
+    return f"{settings.SUPABASE_S3_STORAGE_ENDPOINT}/object/{STORAGE_BUCKET}/{object_name}"
+
+def get_file_from_storage(object_url: str, file_path: str | None = None) -> str:
     """
     Download a file from a remote storage service.
 
     :param object_url: URL of the file to be downloaded.
+    :param file_path: where to store the file, downloads/{object name} by default.
     :return: Full path to the downloaded file if successful, False otherwise.
+    :raises CircuitOpenError: when the storage breaker is open, the download was not attempted.
     """
 
     headers = {
@@ -15,13 +27,18 @@ def get_file_from_storage(object_url: str) -> str:
     }
 
     try:
-        response = httpx.get(url=object_url, headers=headers)
+        with storage_breaker.guard() as breaker_call:
+            response = httpx.get(url=object_url, headers=headers)
+
+            if response.status_code >= 500:
+                breaker_call.record_failure()
 
         if response.status_code == 200:
-            filename = object_url.split("/")[-1]
+            if file_path is None:
+                filename = object_url.split("/")[-1]
 
-            os.makedirs("downloads", exist_ok=True)
-            file_path = os.path.join("downloads", filename)
+                os.makedirs("downloads", exist_ok=True)
+                file_path = os.path.join("downloads", filename)
 
             with open(file_path, "wb") as file:
                 file.write(response.content)
@@ -36,34 +53,118 @@ def get_file_from_storage(object_url: str) -> str:
         return "download_failed"
 
 
-def upload_file_to_storage(file_path: str) -> str:
+def upload_bytes_to_storage(file_bytes: bytes, object_name: str, content_type: str, upsert: bool = False) -> str:
     """
-    Upload a file to a remote storage service.
+    Upload file content to a remote storage service.
 
-    :param file_path: Path to the file to be uploaded.
-    :return: Full object url if upload was successful, False otherwise.
+    :param object_name: path of the object inside the bucket, e.g. attachments/{sha256}.
+    :param upsert: overwrite an existing object instead of failing, for content addressed objects whose content never changes.
+    :return: Full object url if upload was successful, "upload_failed" otherwise.
+    :raises CircuitOpenError: when the storage breaker is open, the upload was not attempted.
     """
-    if not os.path.exists(file_path):
-        print(f"File {file_path} does not exist.")
-        return False
-
-    filename: str = os.path.basename(file_path)
-    bucketName: str = "mailstorm-storage"
-    wildcard: str = f"resume/{filename}"
-    object_url: str = f"{settings.SUPABASE_S3_STORAGE_ENDPOINT}/object/{bucketName}/{wildcard}"
+    object_url: str = storage_object_url(object_name)
 
     headers = {
         "Authorization": f"Bearer {settings.SUPABASE_SERVICE_ROLE}",
-        "Content-Type": "application/pdf",
+        "Content-Type": content_type,
     }
 
-    with open(file_path, "rb") as upload_file:
-        upload_file_bytes = upload_file.read()
+    if upsert:
+        headers["x-upsert"] = "true"
 
     try:
-        response = httpx.post(url=object_url, headers=headers, content=upload_file_bytes)
+        with storage_breaker.guard() as breaker_call:
+            response = httpx.post(url=object_url, headers=headers, content=file_bytes)
+
+            if response.status_code >= 500:
+                breaker_call.record_failure()
+
         return object_url if response.status_code == 200 else "upload_failed"
 
     except httpx.RequestError as e:
         print(f"An error occurred while uploading the file: {e}")
-        return "upload_failed"
\ No newline at end of file
+        return "upload_failed"
+
+
+def create_signed_upload_url(object_name: str) -> str:
+    """
+    Signed url the client uploads a file to directly (PUT), without the file passing through the api.
+
+    :param object_name: path of the object inside the bucket, the url can only upload to this object.
+    :return: the signed upload url, "sign_failed" otherwise.
+    :raises CircuitOpenError: when the storage breaker is open, nothing was signed.
+    """
+    headers = {
+        "Authorization": f"Bearer {settings.SUPABASE_SERVICE_ROLE}"
+    }
+
+    try:
+        with storage_breaker.guard() as breaker_call:
+            response = httpx.post(url=f"{settings.SUPABASE_S3_STORAGE_ENDPOINT}/object/upload/sign/{STORAGE_BUCKET}/{object_name}", headers=headers)
+
+            if response.status_code >= 500:
+                breaker_call.record_failure()
+
+        if response.status_code != 200:
+            print(f"Failed to sign upload url: {response.status_code}")
+            return "sign_failed"
+
+        #the signed path is relative to the storage endpoint and carries the upload token
+        return f"{settings.SUPABASE_S3_STORAGE_ENDPOINT}{response.json()['url']}"
+
+    except httpx.RequestError as e:
+        print(f"An error occurred while signing the upload url: {e}")
+        return "sign_failed"
+
+
+def get_storage_object_info(object_url: str) -> dict | None:
+    """
+    Size and content type of a stored object, read with a HEAD request so the file itself is not transferred.
+
+    :return: {"size", "content_type"}, None when the object does not exist or could not be read.
+    :raises CircuitOpenError: when the storage breaker is open, the object was not looked up.
+    """
+    headers = {
+        "Authorization": f"Bearer {settings.SUPABASE_SERVICE_ROLE}"
+    }
+
+    try:
+        with storage_breaker.guard() as breaker_call:
+            response = httpx.head(url=object_url, headers=headers)
+
+            if response.status_code >= 500:
+                breaker_call.record_failure()
+
+        if response.status_code != 200:
+            return None
+
+        return {
+            "size": int(response.headers.get("content-length", -1)),
+            "content_type": response.headers.get("content-type", "").split(";")[0].strip()
+        }
+
+    except httpx.RequestError as e:
+        print(f"An error occurred while reading the object info: {e}")
+        return None
+
+
+def delete_from_storage(object_url: str) -> bool:
+    """
+    :raises CircuitOpenError: when the storage breaker is open, the object was not deleted.
+    """
+    headers = {
+        "Authorization": f"Bearer {settings.SUPABASE_SERVICE_ROLE}"
+    }
+
+    try:
+        with storage_breaker.guard() as breaker_call:
+            response = httpx.delete(url=object_url, headers=headers)
+
+            if response.status_code >= 500:
+                breaker_call.record_failure()
+
+        return response.status_code == 200
+
+    except httpx.RequestError as e:
+        print(f"An error occurred while deleting the object: {e}")
+        return False
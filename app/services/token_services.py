@@ -0,0 +1,203 @@
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import requests
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from redis import Redis as SyncRedis
+from redis.asyncio import Redis
+from sqlalchemy.orm import Session
+
+from app.db.redisConnection import sync_redis_client
+from app.models import UserToken
+from app.services.cache_services import RELEASE_LOCK_SCRIPT
+from app.services.circuit_breaker_services import CircuitBreaker
+from app.services.metrics_services import metrics_key, METRICS_GROUPS_KEY, increment_counter
+from app.utils.config import settings
+
+GOOGLE_TOKEN_METRICS_GROUP = "google_token"
+
+#a refused refresh token is the user's problem, only transport errors and 5xx responses count against the breaker
+google_oauth_breaker = CircuitBreaker("google_oauth", sync_redis_client, is_failure=lambda error: not isinstance(error, RefreshError))
+
+#one pooled http session for all token refreshes of the process, instead of a new connection per refresh
+_google_auth_request = Request(session=requests.Session())
+
+def google_token_key(token_id: int) -> str:
+    return f"google_token:{token_id}"
+
+def google_token_lock_key(token_id: int) -> str:
+    return f"google_token:{token_id}:refresh_lock"
+
+def google_token_revoked_key(token_id: int) -> str:
+    return f"google_token:{token_id}:revoked"
+
+def _count(redis_connection: SyncRedis, field: str) -> None:
+    redis_pipeline = redis_connection.pipeline()
+    redis_pipeline.hincrby(metrics_key(GOOGLE_TOKEN_METRICS_GROUP), field, 1)
+    redis_pipeline.sadd(METRICS_GROUPS_KEY, GOOGLE_TOKEN_METRICS_GROUP)
+    redis_pipeline.execute()
+
+def _expiry_timestamp(expires_at: datetime) -> float:
+    #google and the user_tokens table keep naive utc datetimes
+    return expires_at.replace(tzinfo=timezone.utc).timestamp()
+
+def _cache_google_token(redis_connection: SyncRedis, token_id: int, access_token: str, expires_at: datetime) -> None:
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    redis_pipeline.hset(google_token_key(token_id), mapping={"access_token": access_token, "expires_at": _expiry_timestamp(expires_at)})
+    redis_pipeline.expireat(google_token_key(token_id), int(_expiry_timestamp(expires_at)))
+    redis_pipeline.execute()
+
+def _valid_access_token(cached_token: dict, min_validity_seconds: int) -> str | None:
+    if cached_token and float(cached_token["expires_at"]) - time.time() > min_validity_seconds:
+        return cached_token["access_token"]
+
+    return None
+
+def _cached_google_token(redis_connection: SyncRedis, token_id: int, min_validity_seconds: int) -> str | None:
+    return _valid_access_token(redis_connection.hgetall(google_token_key(token_id)), min_validity_seconds)
+
+def _refresh_google_token(user_token: UserToken, db_connection: Session, redis_connection: SyncRedis) -> str:
+    creds = Credentials(
+        token=user_token.access_token,
+        refresh_token=user_token.refresh_token,
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=settings.GOOGLE_CLIENT_ID,
+        client_secret=settings.GOOGLE_CLIENT_SECRET
+    )
+
+    try:
+        with google_oauth_breaker.guard():
+            creds.refresh(_google_auth_request)
+
+    except RefreshError:
+        #the grant was revoked or expired, the account is left out of sending until the user authorizes it again
+        redis_connection.set(google_token_revoked_key(user_token.token_id), 1, ex=settings.GOOGLE_TOKEN_REVOKED_TTL_SECONDS)
+        raise
+
+    _cache_google_token(redis_connection, user_token.token_id, creds.token, creds.expiry)
+
+    #the db keeps the last token too, so a process that finds the cache empty does not refresh again
+    user_token.access_token = creds.token
+    user_token.expires_at = creds.expiry
+    db_connection.commit()
+
+    _count(redis_connection, "refreshes")
+
+    return creds.token
+
+def get_google_access_token(user_token: UserToken, db_connection: Session, min_validity_seconds: int | None = None) -> str:
+    """
+    Access token of a connected gmail account that stays valid for at least min_validity_seconds (GOOGLE_TOKEN_MIN_VALIDITY_SECONDS
+    by default). Tokens are cached in redis for all processes. A token that has to be refreshed is refreshed by a single
+    caller under a per-user redis lock, concurrent callers wait for its result instead of refreshing it again.
+    """
+    if min_validity_seconds is None:
+        min_validity_seconds = settings.GOOGLE_TOKEN_MIN_VALIDITY_SECONDS
+
+    redis_connection = sync_redis_client
+
+    access_token = _cached_google_token(redis_connection, user_token.token_id, min_validity_seconds)
+
+    if access_token is not None:
+        _count(redis_connection, "cache_hits")
+        return access_token
+
+    if _expiry_timestamp(user_token.expires_at) - time.time() > min_validity_seconds:
+        #e.g. right after the oauth callback stored a new token
+        _cache_google_token(redis_connection, user_token.token_id, user_token.access_token, user_token.expires_at)
+        return user_token.access_token
+
+    lock_token = uuid.uuid4().hex
+
+    if redis_connection.set(google_token_lock_key(user_token.token_id), lock_token, nx=True, px=settings.GOOGLE_TOKEN_REFRESH_LOCK_MS):
+        try:
+            return _refresh_google_token(user_token, db_connection, redis_connection)
+        finally:
+            redis_connection.eval(RELEASE_LOCK_SCRIPT, 1, google_token_lock_key(user_token.token_id), lock_token)
+
+    #another task is refreshing this token right now, wait for its result
+    _count(redis_connection, "coalesced_refreshes")
+    deadline = time.monotonic() + settings.GOOGLE_TOKEN_REFRESH_WAIT_MS / 1000
+
+    while time.monotonic() < deadline:
+        time.sleep(settings.GOOGLE_TOKEN_POLL_MS / 1000)
+
+        access_token = _cached_google_token(redis_connection, user_token.token_id, min_validity_seconds)
+        if access_token is not None:
+            return access_token
+
+    #the refreshing task is too slow or died, refresh without the lock rather than failing the send
+    _count(redis_connection, "refresh_wait_timeouts")
+    return _refresh_google_token(user_token, db_connection, redis_connection)
+
+async def get_google_access_token_async(user_token: UserToken, db_connection: Session, redis_connection: Redis,
+                                       min_validity_seconds: int | None = None) -> str:
+    """
+    get_google_access_token for async callers (the send pipeline): a cached token is read without leaving the event
+    loop, a refresh and the wait for another caller's refresh run in a worker thread, so they never block the loop.
+    """
+    if min_validity_seconds is None:
+        min_validity_seconds = settings.GOOGLE_TOKEN_MIN_VALIDITY_SECONDS
+
+    access_token = _valid_access_token(await redis_connection.hgetall(google_token_key(user_token.token_id)), min_validity_seconds)
+
+    if access_token is not None:
+        await increment_counter(redis_connection, GOOGLE_TOKEN_METRICS_GROUP, "cache_hits")
+        return access_token
+
+    return await asyncio.to_thread(get_google_access_token, user_token, db_connection, min_validity_seconds)
+
+def forget_google_token(token_id: int) -> None:
+    """
+    Drop the cached token and the revoked mark of an account whose tokens were replaced, e.g. after re-authorizing gmail.
+    """
+    sync_redis_client.delete(google_token_key(token_id), google_token_revoked_key(token_id))
+
+def gmail_connect_key(connect_id: str) -> str:
+    return f"gmail_connect:{connect_id}"
+
+def create_gmail_connect_request(user_id: str | int) -> str:
+    """
+    Remember which user started connecting another gmail account, for the oauth callback.
+
+    :return: the connect id to put into the oauth state.
+    """
+    connect_id = uuid.uuid4().hex
+    sync_redis_client.set(gmail_connect_key(connect_id), str(user_id), ex=settings.GMAIL_CONNECT_TTL_SECONDS)
+    return connect_id
+
+def pop_gmail_connect_request(connect_id: str) -> str | None:
+    """
+    :return: the user id of the connect request, None when it expired or was already used.
+    """
+    return sync_redis_client.getdel(gmail_connect_key(connect_id))
+
+def refresh_expiring_google_tokens(db_connection: Session, user_id: str | int | None = None) -> int:
+    """
+    Refresh every token (of user_id, or of all users) that expires within GOOGLE_TOKEN_REFRESH_AHEAD_SECONDS, so sends
+    never wait on a refresh.
+
+    :return: the number of tokens that were checked.
+    """
+    token_query = db_connection.query(UserToken).filter(
+        UserToken.expires_at < datetime.utcnow() + timedelta(seconds=settings.GOOGLE_TOKEN_REFRESH_AHEAD_SECONDS)
+    )
+
+    if user_id is not None:
+        token_query = token_query.filter(UserToken.uid == user_id)
+
+    user_tokens = token_query.all()
+
+    for user_token in user_tokens:
+        try:
+            get_google_access_token(user_token, db_connection, min_validity_seconds=settings.GOOGLE_TOKEN_REFRESH_AHEAD_SECONDS)
+
+        except Exception as e:
+            #a revoked token or google being down must not stop the refresh of the other tokens
+            print(f"Error refreshing google token of user {user_token.uid}: {e}")
+
+    return len(user_tokens)
@@ -0,0 +1,314 @@
+import base64
+import io
+import os.path
+import re
+import smtplib
+import ssl
+import tempfile
+import threading
+import uuid
+from collections import deque
+from email.generator import BytesGenerator
+from email.message import EmailMessage
+from email.utils import make_msgid, getaddresses
+from typing import BinaryIO
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
+
+from app.db.redisConnection import sync_redis_client
+from app.pydantic_schemas.email_pydantic import EmailSchema
+from app.services.circuit_breaker_services import CircuitBreaker
+from app.services.concurrency_services import GmailThrottledError
+from app.utils.config import settings
+
+#a 4xx from gmail (bad address, throttling) means gmail is up, only transport errors and 5xx responses count against the breaker
+gmail_breaker = CircuitBreaker("gmail_send", sync_redis_client, is_failure=lambda error: not isinstance(error, HttpError) or error.resp.status >= 500)
+
+#smtp 5xx replies are about the email (unknown recipient, rejected content), only 421 (service not available) and
+#connection errors mean the smtp server is in trouble
+SMTP_THROTTLE_CODES = {421, 450, 451, 452, 454}
+gmail_smtp_breaker = CircuitBreaker("gmail_smtp", sync_redis_client,
+                                    is_failure=lambda error: not isinstance(error, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)) or getattr(error, "smtp_code", None) == 421)
+
+#stands in for the content of an attachment part until the message is written out
+ATTACHMENT_PLACEHOLDER = "attachment-content:{}\n"
+ATTACHMENT_PLACEHOLDER_PATTERN = re.compile(rb"(attachment-content:[0-9a-f]{32}\n)")
+#a multiple of 57 bytes, every block encodes to whole 76 character base64 lines
+ATTACHMENT_STREAM_BLOCK_BYTES = 57 * 16 * 1024
+
+
+def build_mime_message(email_object: EmailSchema, from_email: str, attachments: list[tuple[str, str, str]] | None = None) -> EmailMessage:
+    """
+    The attachments are not read here, their parts hold a placeholder until write_mime_message streams the files in.
+
+    :param attachments: (file path, filename in the email, content type) of every file to attach.
+    """
+    message = EmailMessage()
+    message.attachment_files = {}
+
+    message.set_content(email_object.body, subtype="html", charset="utf-8")
+
+    message["To"] = email_object.to_email
+    message["From"] = from_email
+    message["Subject"] = email_object.subject
+
+    if email_object.cc_email:
+        message["Cc"] = email_object.cc_email
+
+    if email_object.bcc_email:
+        message["Bcc"] = email_object.bcc_email
+
+    for file_path, filename_in_email, content_type in attachments or []:
+        maintype, subtype = content_type.split("/", 1)
+
+        message.add_attachment(
+            b"",
+            maintype=maintype,
+            subtype=subtype,
+            filename=filename_in_email
+        )
+
+        #the part keeps its base64 headers, only the content is swapped for the placeholder
+        placeholder = ATTACHMENT_PLACEHOLDER.format(uuid.uuid4().hex)
+        message.get_payload()[-1].set_payload(placeholder)
+        message.attachment_files[placeholder] = file_path
+
+    return message
+
+
+def write_mime_message(message: EmailMessage, out_file: BinaryIO) -> None:
+    """
+    Write the raw MIME of a message from build_mime_message to out_file. The attachments are base64 encoded block by
+    block straight from their files, so only one block of an attachment is in memory at a time.
+    """
+    skeleton = io.BytesIO()
+    BytesGenerator(skeleton, mangle_from_=False, policy=message.policy).flatten(message)
+
+    attachment_files = getattr(message, "attachment_files", {})
+
+    for segment in ATTACHMENT_PLACEHOLDER_PATTERN.split(skeleton.getvalue()):
+        file_path = attachment_files.get(segment.decode("ascii", errors="replace"))
+
+        if file_path is None:
+            out_file.write(segment)
+            continue
+
+        with open(file_path, "rb") as attachment_file:
+            for block in iter(lambda: attachment_file.read(ATTACHMENT_STREAM_BLOCK_BYTES), b""):
+                out_file.write(base64.encodebytes(block))
+
+
+def _throttled_send_error(error: HttpError) -> GmailThrottledError | None:
+    """
+    Tell rate limiting and gmail server errors apart from errors caused by the email itself. The send engine backs off
+    on the first kind, retrying the second kind would fail the same way.
+    """
+    reasons = {detail.get("reason") for detail in error.error_details if isinstance(detail, dict)} if isinstance(error.error_details, list) else set()
+
+    if error.resp.status != 429 and error.resp.status < 500 and not reasons & {"rateLimitExceeded", "userRateLimitExceeded"}:
+        return None
+
+    retry_after = error.resp.get("retry-after")
+    retry_after_ms = int(retry_after) * 1000 if retry_after and retry_after.isdigit() else None
+
+    return GmailThrottledError(status_code=error.resp.status, retry_after_ms=retry_after_ms)
+
+
+class EmailTransport:
+    """
+    Delivers a built MIME message for one sending account.
+
+    send returns {"id": message id} when the message was accepted, None when it was refused because of the email itself,
+    and raises GmailThrottledError when the account is rate limited, so the send engine can back off or fail over.
+    """
+    name: str
+    requires_google_token: bool = True
+
+    def send(self, message: EmailMessage, google_access_token: str | None, from_email: str) -> dict | None:
+        raise NotImplementedError
+
+
+class GmailApiTransport(EmailTransport):
+    """
+    Gmail REST API. Small messages go base64 encoded in the raw field of the json body. Messages larger than
+    GMAIL_MEDIA_UPLOAD_THRESHOLD_BYTES (e.g. with a resume) are written, with the attachments streamed from their files,
+    to a temporary file that moves to disk past the threshold, and sent from it with a resumable media upload in chunks
+    of GMAIL_UPLOAD_CHUNK_BYTES. Memory use is then bounded by the threshold and the chunk size, not by the message.
+    """
+    name = "gmail_api"
+
+    def send(self, message: EmailMessage, google_access_token: str | None, from_email: str) -> dict | None:
+        user_credentials = Credentials(token=google_access_token)
+
+        try:
+            service = build("gmail", "v1", credentials=user_credentials)
+
+            with tempfile.SpooledTemporaryFile(max_size=settings.GMAIL_MEDIA_UPLOAD_THRESHOLD_BYTES) as raw_message:
+                write_mime_message(message, raw_message)
+
+                if raw_message.tell() <= settings.GMAIL_MEDIA_UPLOAD_THRESHOLD_BYTES:
+                    raw_message.seek(0)
+
+                    # encoded message
+                    encoded_message = base64.urlsafe_b64encode(raw_message.read()).decode()
+
+                    send_request = service.users().messages().send(userId="me", body={"raw": encoded_message})
+
+                else:
+                    raw_message.seek(0)
+
+                    media_body = MediaIoBaseUpload(raw_message, mimetype="message/rfc822",
+                                                   chunksize=settings.GMAIL_UPLOAD_CHUNK_BYTES, resumable=True)
+
+                    send_request = service.users().messages().send(userId="me", media_body=media_body)
+
+                with gmail_breaker.guard():
+                    send_message = send_request.execute()
+
+            print(f'Message Id: {send_message["id"]}')
+        except HttpError as error:
+            print(f"An error occurred: {error}")
+
+            throttled_error = _throttled_send_error(error)
+            if throttled_error is not None:
+                raise throttled_error from error
+
+            send_message = None
+
+        return send_message
+
+
+class SmtpTransport(EmailTransport):
+    """
+    Gmail over SMTP with XOAUTH2. Connections stay open after a send and are reused by the next send of the same account,
+    so the tcp, tls and auth round trips are paid once per connection instead of once per email. Up to SMTP_POOL_SIZE
+    idle connections are kept per account. smtplib sends the DATA of a message from bytes, so unlike the api transport
+    the whole message is in memory while it is sent.
+    """
+    name = "smtp"
+
+    def __init__(self):
+        self._idle_connections: dict[str, list[smtplib.SMTP]] = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, google_access_token: str, from_email: str) -> smtplib.SMTP:
+        xoauth2_string = f"user={from_email}\1auth=Bearer {google_access_token}\1\1"
+
+        connection = smtplib.SMTP(settings.SMTP_HOST, settings.SMTP_PORT, timeout=settings.SMTP_TIMEOUT_SECONDS)
+        try:
+            connection.starttls(context=ssl.create_default_context())
+            connection.ehlo()
+            #after a failed xoauth2 the server sends a challenge with the error details, answering it empty ends the exchange
+            connection.auth("XOAUTH2", lambda challenge=None: "" if challenge else xoauth2_string, initial_response_ok=True)
+        except Exception:
+            connection.close()
+            raise
+
+        return connection
+
+    def _checkout(self, google_access_token: str, from_email: str) -> smtplib.SMTP:
+        with self._lock:
+            idle_connections = self._idle_connections.get(from_email)
+            if idle_connections:
+                return idle_connections.pop()
+
+        return self._connect(google_access_token, from_email)
+
+    def _checkin(self, from_email: str, connection: smtplib.SMTP) -> None:
+        with self._lock:
+            idle_connections = self._idle_connections.setdefault(from_email, [])
+            if len(idle_connections) < settings.SMTP_POOL_SIZE:
+                idle_connections.append(connection)
+                return
+
+        connection.quit()
+
+    def send(self, message: EmailMessage, google_access_token: str | None, from_email: str) -> dict | None:
+        #smtp does not hand out the gmail message id, the Message-ID header is the id of the sent email instead
+        if "Message-ID" not in message:
+            message["Message-ID"] = make_msgid(domain=from_email.rsplit("@", 1)[-1])
+
+        recipients = [address for _, address in getaddresses([str(value) for field in ("To", "Cc", "Bcc") for value in message.get_all(field, [])])]
+        #the bcc recipients get the email, the header must not show them
+        del message["Bcc"]
+
+        raw_message = io.BytesIO()
+        write_mime_message(message, raw_message)
+
+        try:
+            with gmail_smtp_breaker.guard():
+                connection = self._checkout(google_access_token, from_email)
+
+                try:
+                    try:
+                        connection.sendmail(from_email, recipients, raw_message.getvalue())
+
+                    except smtplib.SMTPServerDisconnected:
+                        #gmail closed the idle connection, send once more on a new one
+                        connection = self._connect(google_access_token, from_email)
+                        connection.sendmail(from_email, recipients, raw_message.getvalue())
+
+                except Exception:
+                    connection.close()
+                    raise
+
+            self._checkin(from_email, connection)
+
+        except smtplib.SMTPResponseException as error:
+            print(f"An error occurred: {error}")
+
+            if error.smtp_code in SMTP_THROTTLE_CODES:
+                raise GmailThrottledError(status_code=error.smtp_code) from error
+
+            return None
+
+        except smtplib.SMTPRecipientsRefused as error:
+            print(f"An error occurred: {error}")
+            return None
+
+        print(f'Message Id: {message["Message-ID"]}')
+        return {"id": message["Message-ID"]}
+
+
+class SinkTransport(EmailTransport):
+    """
+    Sends nothing: captures the raw MIME of every message, as .eml files in EMAIL_SINK_DIR or in memory (the last
+    EMAIL_SINK_MAX_MESSAGES). For throughput tests and capacity planning dry runs without any google dependency.
+    """
+    name = "sink"
+    requires_google_token = False
+
+    def __init__(self):
+        self.messages: deque[bytes] = deque(maxlen=settings.EMAIL_SINK_MAX_MESSAGES)
+
+    def send(self, message: EmailMessage, google_access_token: str | None, from_email: str) -> dict | None:
+        message_id = f"sink-{uuid.uuid4().hex}"
+
+        if settings.EMAIL_SINK_DIR:
+            with open(os.path.join(settings.EMAIL_SINK_DIR, f"{message_id}.eml"), "wb") as sink_file:
+                write_mime_message(message, sink_file)
+        else:
+            raw_message = io.BytesIO()
+            write_mime_message(message, raw_message)
+            self.messages.append(raw_message.getvalue())
+
+        return {"id": message_id}
+
+
+EMAIL_TRANSPORTS: dict[str, EmailTransport] = {
+    transport.name: transport for transport in (GmailApiTransport(), SmtpTransport(), SinkTransport())
+}
+
+def get_email_transport(name: str | None = None) -> EmailTransport:
+    """
+    The transport called name, EMAIL_TRANSPORT when no name is given (e.g. an account without its own transport).
+    """
+    transport_name = name or settings.EMAIL_TRANSPORT
+
+    if transport_name not in EMAIL_TRANSPORTS:
+        raise ValueError(f"Unknown email transport {transport_name}, expected one of {', '.join(EMAIL_TRANSPORTS)}")
+
+    return EMAIL_TRANSPORTS[transport_name]
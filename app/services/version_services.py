@@ -0,0 +1,131 @@
+import json
+import time
+
+from fastapi import Request, Response
+from redis.asyncio import Redis
+
+from app.utils.config import settings
+
+def queue_version_key(user_id: str | int) -> str:
+    return f"email_queue:{user_id}:version"
+
+def templates_version_key(user_id: str | int) -> str:
+    return f"user:{user_id}:templates:version"
+
+def changes_key(version_key: str) -> str:
+    #every versioned resource has a capped stream of its changes next to its version counter
+    return version_key.removesuffix(":version") + ":changes"
+
+#increment the version once per change and append each change to the stream under the id "<version>-0", in one atomic
+#step so that versions and stream entries can never drift apart. A missing counter is seeded with the current time,
+#so a lost key can never hand out a version a client already holds, and the old stream of that epoch is dropped.
+RECORD_CHANGES_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+    redis.call('set', KEYS[1], ARGV[1])
+    redis.call('del', KEYS[2])
+end
+local version = tonumber(redis.call('get', KEYS[1]))
+for i = 4, #ARGV, 3 do
+    version = redis.call('incr', KEYS[1])
+    redis.call('xadd', KEYS[2], 'MAXLEN', '~', ARGV[2], tostring(version) .. '-0', 'op', ARGV[i], 'id', ARGV[i + 1], 'data', ARGV[i + 2])
+end
+redis.call('expire', KEYS[2], ARGV[3])
+return version
+"""
+
+async def record_changes(redis_connection: Redis, version_key: str, changes: list[dict]) -> int:
+    """
+    Record data changes of a per-user resource. Must be called by every code path that changes the versioned data.
+    Each change is {"op": "add" | "update" | "delete" | "reset", "id": item id, "data": serialized item or None}
+    and gets its own version, the function returns the latest one.
+    """
+    script_args = [int(time.time() * 1000), settings.CHANGELOG_MAX_LENGTH, settings.CHANGELOG_TTL_SECONDS]
+
+    for change in changes:
+        script_args.extend([change["op"], str(change.get("id") or ""), change.get("data") or ""])
+
+    return await redis_connection.eval(RECORD_CHANGES_SCRIPT, 2, version_key, changes_key(version_key), *script_args)
+
+async def bump_version(redis_connection: Redis, version_key: str) -> int:
+    """
+    Record a change that cannot be described item by item (e.g. a cache refill that found different data in the db).
+    Delta sync clients that see it fall back to a full reload.
+    """
+    return await record_changes(redis_connection, version_key, [{"op": "reset"}])
+
+async def get_version(redis_connection: Redis, version_key: str) -> int:
+    version = await redis_connection.get(version_key)
+
+    if version is not None:
+        return int(version)
+
+    seed_version = int(time.time() * 1000)
+
+    if await redis_connection.set(version_key, seed_version, nx=True):
+        await redis_connection.delete(changes_key(version_key))
+        return seed_version
+
+    return int(await redis_connection.get(version_key))
+
+async def read_changes_since(redis_connection: Redis, version_key: str, since_version: int) -> tuple[int, list[dict] | None]:
+    """
+    Read the changes a client missed since the version it last saw.
+
+    :return: the current version and the ordered changes, or None for the changes when the client has to do a full
+             reload (the log was trimmed or expired, the gap is too large, or a change cannot be replayed).
+    """
+    current_version = await get_version(redis_connection, version_key)
+
+    if since_version == current_version:
+        return current_version, []
+
+    missed_changes = current_version - since_version
+
+    if missed_changes < 0 or missed_changes > settings.CHANGELOG_MAX_DELTA:
+        return current_version, None
+
+    stream_entries = await redis_connection.xrange(changes_key(version_key), min=f"{since_version + 1}-0", max=f"{current_version}-0")
+
+    changes = []
+    for expected_version, (entry_id, entry) in enumerate(stream_entries, start=since_version + 1):
+        #a missing version means the entry was trimmed from the capped stream
+        if int(entry_id.split("-")[0]) != expected_version or entry["op"] == "reset":
+            return current_version, None
+
+        changes.append({
+            "version": expected_version,
+            "op": entry["op"],
+            "id": entry["id"] or None,
+            "data": json.loads(entry["data"]) if entry["data"] else None
+        })
+
+    if len(changes) != missed_changes:
+        return current_version, None
+
+    return current_version, changes
+
+def build_etag(version_key: str, version: int) -> str:
+    return f'"{version_key}:{version}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Check the If-None-Match header of the request against the current strong etag.
+    """
+    if_none_match = request.headers.get("if-none-match")
+
+    if not if_none_match:
+        return False
+
+    if if_none_match.strip() == "*":
+        return True
+
+    return etag in [candidate.strip() for candidate in if_none_match.split(",")]
+
+def set_etag_headers(response: Response, etag: str) -> Response:
+    #no-cache lets the browser keep the body but forces it to revalidate with If-None-Match on every read
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+def not_modified_response(etag: str) -> Response:
+    return set_etag_headers(Response(status_code=304), etag)
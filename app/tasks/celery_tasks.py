@@ -1,221 +1,511 @@
+import asyncio
 import json
-import os.path
 from datetime import datetime
 from typing import List
 
-from redis.asyncio.client import Pipeline
+from celery import group
+from fastapi import HTTPException
+from redis.exceptions import WatchError
 from sqlalchemy import text
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, Session
 
 from app.celery_worker import celery_app
 from app.db.dbConnection import get_db_session
 from app.db.redisConnection import get_redis_connection
-from app.models import User, UserToken, Email
+from app.models import User
 from app.pydantic_schemas.email_pydantic import EmailSchema
-from app.routes.service_routes import gmail_send_message
-from app.services.storage_service import get_file_from_storage
+from app.routes.service_routes import send_gmail_service
+from app.services.attachment_services import remove_stale_direct_uploads
+from app.services.campaign_services import create_campaign, set_campaign_status, queue_campaign_counters, \
+    should_stop_campaign, complete_campaign, claim_campaign_chunks, finish_campaign_chunk, campaign_chunk_key, \
+    campaign_chunk_results_key, start_chunk_email, queue_chunk_email_done, stop_chunk_email, requeue_stopped_chunk
+from app.services.event_services import publish_user_event
+from app.services.interactive_services import store_send_result
+from app.services.retry_services import queue_retry, queue_dead_letter, lease_due_retries, requeue_expired_retry_batches, \
+    read_retry_batch, parse_retry, owns_retry_batch, queue_retry_ack, defer_retry_batch, release_retry_batch, \
+    retry_batch_key, drain_legacy_retry_queues
+from app.services.scheduling_services import enqueue_fair_chunks, pick_fair_chunk, defer_fair_chunk, release_deferred_chunks, \
+    queue_chunk_lease_renewal, release_chunk_lease, requeue_expired_chunks, chunk_lease_key, owns_chunk_lease
+from app.services.send_pipeline_services import SendPipeline, SendResult, save_sent_email
+from app.services.token_services import refresh_expiring_google_tokens
+from app.services.version_services import queue_version_key, record_changes
+from app.utils.config import settings
+
+
+def _mark_emails_sent(db_connection: Session, sent_records: dict[int, dict]) -> None:
+    """
+    Update the status, send time and google message id of all sent emails with a single UPDATE statement.
+    """
+    if not sent_records:
+        return
+
+    eids = list(sent_records.keys())
+
+    send_at_case = "CASE\n"
+    google_message_id_case = "CASE\n"
+
+    for eid in eids:
+        send_at = sent_records[eid]["send_at"]
+        google_message_id = sent_records[eid]["google_message_id"]
+        send_at_case += f"  WHEN eid = {eid} THEN '{send_at}'::timestamp\n"
+        google_message_id_case += f"  WHEN eid = {eid} THEN '{google_message_id}'\n"
+
+    send_at_case += "END"
+    google_message_id_case += "END"
+
+    sql_query = f"""
+            UPDATE emails
+            SET 
+                is_sent = TRUE,
+                send_at = {send_at_case},
+                google_message_id = {google_message_id_case}
+            WHERE eid IN ({','.join(map(str, eids))});
+        """
+
+    db_connection.execute(text(sql_query))
+
+
+@celery_app.task(name="send_email_now")
+async def send_email_now(user_id: str, email_data: dict, request_id: str):
+    """
+    Interactive lane: sends one manual email on the dedicated interactive queue, so it never waits behind bulk campaign
+    chunks, and hands the response back to the api request waiting on request_id.
+    """
+
+    db_gen = get_db_session()
+    db_connection = next(db_gen)
+
+    redis_connection = await get_redis_connection()
+
+    try:
+        email_object = EmailSchema.model_validate(email_data)
+
+        try:
+            result = (await send_gmail_service(email_object=email_object, user_id=user_id, db_connection=db_connection, redis_connection=redis_connection)).model_dump()
+
+        except HTTPException as e:
+            result = {"success": False, "status_code": e.status_code, "message": e.detail, "data": {}}
+
+        except Exception as e:
+            #the api request is still waiting on this request id, it has to get an answer even when the send crashed
+            print(f"Error sending email now: {e}")
+            result = {"success": False, "status_code": 500, "message": "Failed to send email.", "data": {}}
+
+        await store_send_result(redis_connection, request_id, result)
+
+    finally:
+        db_gen.close()
 
 
 @celery_app.task(name="send_emails_from_user_queue")
-async def send_emails_from_user_queue(user_id: str, email_ids: List[int]):
+async def send_emails_from_user_queue(user_id: str, email_ids: List[int], campaign_id: str = None, run: int = None):
     """
     Celery task to send emails from the user's queue.
     This function will be called by the Celery worker.
+    It is the coordinator of a campaign run: it claims the selected emails out of the user's queue in one transaction,
+    splits them into chunks of SEND_CHUNK_SIZE, queues the chunks in the user's sub-queue of the fair scheduler and fans
+    out one send_next_fair_chunk task per chunk, so a large campaign is spread over all workers while other users'
+    chunks are still served in turn. The chunk that finishes last triggers finalize_campaign_run.
     """
 
+    redis_connection = await get_redis_connection()
+
+    if campaign_id is None:
+        campaign_id = await create_campaign(redis_connection, user_id, email_ids)
+        run = 1
+
+    #the campaign may have been paused or cancelled while this task was waiting in the broker
+    if await set_campaign_status(redis_connection, campaign_id, "running") != "running":
+        return
+
+    claimed_eids = await claim_campaign_chunks(redis_connection=redis_connection,
+                                               queue_key=f"email_queue:{user_id}",
+                                               campaign_id=campaign_id,
+                                               run=run,
+                                               email_ids=email_ids,
+                                               chunk_size=settings.SEND_CHUNK_SIZE)
+
+    if claimed_eids:
+        #the claimed emails left the queue, either to be sent or to end up in the failed queue
+        await record_changes(redis_connection, queue_version_key(user_id), [{"op": "delete", "id": eid} for eid in claimed_eids])
+
+    if not claimed_eids:
+        #chunks of an earlier run may still be open, the last of them completes the campaign then
+        await complete_campaign(redis_connection, campaign_id)
+        return
+
+    #refresh the user's gmail token before the chunks start, instead of the first chunks all waiting on the refresh
+    await asyncio.to_thread(_refresh_user_google_tokens, user_id)
+
+    chunk_sizes = [min(settings.SEND_CHUNK_SIZE, len(claimed_eids) - start) for start in range(0, len(claimed_eids), settings.SEND_CHUNK_SIZE)]
+
+    await enqueue_fair_chunks(redis_connection, user_id, campaign_id, run, chunk_sizes)
+
+    #the tasks are only worker slots, which chunk a slot sends is decided by the scheduler when it starts
+    group(send_next_fair_chunk.s() for _ in chunk_sizes).apply_async()
+
+
+def _refresh_user_google_tokens(user_id: str | None = None) -> int:
     db_gen = get_db_session()
     db_connection = next(db_gen)
 
-    redis_connection = await get_redis_connection()
+    try:
+        return refresh_expiring_google_tokens(db_connection, user_id)
+    finally:
+        db_gen.close()
 
-    redis_queue_key = f"email_queue:{user_id}"
-    redis_failed_queue_key = f"failed_email_queue:{user_id}"
 
-    updated_send_at_records = {}
-    updated_google_message_id_records = {}
-    new_db_records = []
+@celery_app.task(name="refresh_google_tokens")
+async def refresh_google_tokens():
+    """
+    Periodic task (celery beat, every GOOGLE_TOKEN_SWEEP_SECONDS): refreshes the gmail tokens that expire within
+    GOOGLE_TOKEN_REFRESH_AHEAD_SECONDS ahead of time, so sends find a valid token in the cache.
+    """
+    await asyncio.to_thread(_refresh_user_google_tokens)
 
-    try:
 
-        user = db_connection.query(User).options(joinedload(User.user_tokens)).filter(User.uid == user_id).first()
+@celery_app.task(name="remove_stale_uploads")
+async def remove_stale_uploads():
+    """
+    Periodic task (celery beat, every DIRECT_UPLOAD_SWEEP_SECONDS): deletes the objects of direct uploads that were
+    started but never completed.
+    """
+    await asyncio.to_thread(remove_stale_direct_uploads)
 
-        email_queue = await redis_connection.lrange(redis_queue_key, 0, -1)
 
-        redis_pipeline: Pipeline = redis_connection.pipeline()
+@celery_app.task(name="send_next_fair_chunk")
+async def send_next_fair_chunk():
+    """
+    Celery task that sends the chunk the fair scheduler picks next across all users (deficit round robin weighted by
+    plan), instead of the chunk that happened to be queued first in the broker.
+    """
+    redis_connection = await get_redis_connection()
 
-        redis_pipeline.delete(redis_queue_key)
+    chunk = await pick_fair_chunk(redis_connection)
 
-        resume_path_on_disk = None
+    if chunk is None:
+        return
 
-        for email_json in email_queue:
+    await _send_email_chunk(chunk["user_id"], chunk["campaign_id"], chunk["run"], chunk["chunk_index"], chunk["lease_token"])
 
-            email_data = json.loads(email_json)
 
-            if email_data.get("eid") not in email_ids:
-                #If the email ID is not in the provided list, skip processing this email
-                redis_pipeline.rpush(redis_queue_key, email_json)
-                continue
+@celery_app.task(name="send_deferred_chunks")
+async def send_deferred_chunks():
+    """
+    Periodic task (celery beat, every DEFERRED_SWEEP_SECONDS): puts the chunks that were deferred and are due again,
+    and the chunks whose worker died, back into the fair scheduler and starts a send slot for each of them.
+    """
+    redis_connection = await get_redis_connection()
 
-            email_object = EmailSchema.model_validate(email_data)
+    released_chunks = await release_deferred_chunks(redis_connection) + await requeue_expired_chunks(redis_connection)
 
-            if email_object.include_resume:
+    if released_chunks:
+        group(send_next_fair_chunk.s() for _ in range(released_chunks)).apply_async()
 
-                # checking if the user has a resume on file
-                if not user.resume:
-                    #if the user does not have a resume uploaded, we cannot proceed so skip this email
-                    redis_pipeline.rpush(redis_failed_queue_key, email_json)
-                    continue
 
-                resume_path_on_disk = get_file_from_storage(object_url=user.resume) if resume_path_on_disk is None or resume_path_on_disk=="download_failed" else resume_path_on_disk
+async def _send_email_chunk(user_id: str, campaign_id: str, run: int, chunk_index: int, lease_token: str):
+    """
+    Send one chunk of a campaign run through the send pipeline. It only reads its own chunk list and checkpoints after
+    every email: the email leaves the chunk list in the same transaction as its outcome is recorded. The sent results
+    of the chunk are written to the db when the chunk ends, so a worker that dies mid-chunk loses nothing, and the chunk
+    is resumed after its last checkpoint once its lease runs out. A worker that lost its lease (lease_token of its pick)
+    stops without touching the chunk again, it belongs to the worker that picked it next.
+    """
 
-                if resume_path_on_disk == "download_failed":
-                    #if the resume download failed, we cannot proceed so skip this email
-                    redis_pipeline.rpush(redis_failed_queue_key, email_json)
-                    continue
+    db_gen = get_db_session()
+    db_connection = next(db_gen)
+
+    redis_connection = await get_redis_connection()
+
+    redis_queue_key = f"email_queue:{user_id}"
+    redis_chunk_key = campaign_chunk_key(campaign_id, run, chunk_index)
+    redis_chunk_results_key = campaign_chunk_results_key(campaign_id, run, chunk_index)
+
+    requeued_emails = []
+    deferred_emails = []
+    defer_ms = 0
+    defer_reason = None
+
+    redis_lease_key = chunk_lease_key(campaign_id, run, chunk_index)
+
+    async def checkpoint(result: SendResult, owned: bool = True) -> bool:
+        """
+        Record the outcome of one email and take it off the chunk list, in one transaction that only applies while the
+        chunk's lease is still this worker's.
+
+        :return: whether the lease was still this worker's.
+        """
+        email_data = result.email_data
+        eid = result.email_object.eid
+
+        async with redis_connection.pipeline(transaction=True) as redis_pipeline:
+            #the sweep deletes the lease key when it takes the chunk back, which aborts this transaction
+            await redis_pipeline.watch(redis_lease_key)
+            owned = owned and await owns_chunk_lease(redis_connection, campaign_id, run, chunk_index, lease_token)
+
+            redis_pipeline.multi()
+            #the claim is this worker's even when the chunk was taken back, so the next worker finds the eid sent
+            result.queue_claim_outcome(redis_pipeline)
+
+            if owned:
+                if result.outcome == "sent":
+                    #the db status is updated from the chunk results when the chunk ends
+                    redis_pipeline.hset(redis_chunk_results_key, eid, json.dumps({"send_at": datetime.utcnow().isoformat(), "google_message_id": result.google_message_id}))
+                    redis_pipeline.expire(redis_chunk_results_key, settings.CAMPAIGN_TTL_SECONDS)
+                    queue_chunk_email_done(redis_pipeline, campaign_id, run, chunk_index, "sent")
+
+                elif result.outcome == "in_flight":
+                    #not a failed attempt, so the retry count stays
+                    email_data["error"] = result.error
+                    queue_retry(redis_pipeline, user_id, email_data, delay_seconds=result.retry_in_ms / 1000)
+                    queue_chunk_email_done(redis_pipeline, campaign_id, run, chunk_index, "failed")
+
+                elif result.outcome == "dead":
+                    email_data["error"] = result.error
+                    queue_dead_letter(redis_pipeline, user_id, email_data)
+                    queue_chunk_email_done(redis_pipeline, campaign_id, run, chunk_index, "dead")
+
+                else:
+                    email_data["retry_count"] = email_data.get("retry_count", 0) + 1
+                    if result.error is not None:
+                        email_data["error"] = result.error
+                    queue_retry(redis_pipeline, user_id, email_data)
+                    queue_chunk_email_done(redis_pipeline, campaign_id, run, chunk_index, "failed")
+
+                redis_pipeline.lpop(redis_chunk_key)
+                queue_chunk_lease_renewal(redis_pipeline, user_id, campaign_id, run, chunk_index, lease_token)
 
             try:
-                service_response = gmail_send_message(email_object=email_object,
-                                                      google_access_token=user.user_tokens[0].access_token,
-                                                      from_email=user.email,
-                                                      user_token=user.user_tokens[0],
-                                                      db_connection=db_connection,
-                                                      file_attachment_location=resume_path_on_disk if email_object.include_resume else None)
-            except Exception as e:
-                print(f"Error sending email: {e}")
-                email_data["retry_count"] = email_data.get("retry_count", 0) + 1
-                email_data["error"] = str(e)
-                redis_pipeline.rpush(redis_failed_queue_key, json.dumps(email_data))
+                await redis_pipeline.execute()
+            except WatchError:
+                return await checkpoint(result, owned=False)
+
+        return owned
 
-            if service_response:
-                if email_object.eid:
-                    #update the status of the email in db
-                    updated_send_at_records[email_object.eid] = datetime.utcnow()
-                    updated_google_message_id_records[email_object.eid] = service_response.get('id')
+    async def persist(result: SendResult) -> None:
+        if result.outcome in ("deferred", "stopped"):
+            #the rest of the chunk is handled once the run ended
+            return
 
-                    print("All updated records: ", updated_send_at_records)
-                    print("-"*50)
-                    print("All updated google message id records: ", updated_google_message_id_records)
+        if not await checkpoint(result):
+            #the outcome is recorded by the worker that has the chunk now
+            return
 
-                else:
-                    #this is a new email directly from redis
-                    new_email = Email(
-                        uid=user_id,
-                        google_message_id=service_response.get('id') ,
-                        subject=email_object.subject,
-                        body=email_object.body,
-                        is_sent=True,
-                        to_email=email_object.to_email,
-                        cc_email=email_object.cc_email,
-                        bcc_email=email_object.bcc_email,
-                        send_at=datetime.utcnow()
-                    )
-                    new_db_records.append(new_email)
-
-            else:
-                email_data["retry_count"] = email_data.get("retry_count", 0) + 1
-                redis_pipeline.rpush(redis_failed_queue_key, json.dumps(email_data))
+        eid = result.email_object.eid
+        email_data = result.email_data
 
-        redis_pipeline.expire(redis_queue_key, 90 * 60)
-        redis_pipeline.expire(redis_failed_queue_key, 90 * 60)
-        await redis_pipeline.execute()
+        if result.outcome == "sent":
+            await publish_user_event(redis_connection, user_id, "sent", eid=eid, campaign_id=campaign_id, google_message_id=result.google_message_id, duplicate=result.duplicate)
+        elif result.outcome in ("dead", "failed"):
+            await publish_user_event(redis_connection, user_id, result.outcome, eid=eid, campaign_id=campaign_id, error=result.error, retry_count=email_data.get("retry_count", 0))
 
-        if resume_path_on_disk and resume_path_on_disk != "download_failed" and os.path.exists(resume_path_on_disk):
-            os.remove(resume_path_on_disk)
+    async def should_stop() -> bool:
+        return not await owns_chunk_lease(redis_connection, campaign_id, run, chunk_index, lease_token) or await should_stop_campaign(redis_connection, campaign_id)
 
-        if new_db_records:
-            db_connection.bulk_save_objects(new_db_records)
+    try:
+
+        user = db_connection.query(User).options(joinedload(User.user_tokens)).filter(User.uid == user_id).first()
 
-        if updated_send_at_records and updated_google_message_id_records:
+        #the eids are claimed in the name of this lease. The email a dead worker was sending stays claimed by its lease,
+        #a resumed chunk retries it once that claim expired instead of maybe sending it a second time
+        send_pipeline = SendPipeline(redis_connection, db_connection, user, claim_owner=f"chunk:{lease_token}")
 
-            eids = list(updated_send_at_records.keys())
+        while True:
+            email_queue = await redis_connection.lrange(redis_chunk_key, 0, -1)
 
-            send_at_case = "CASE\n"
-            google_message_id_case = "CASE\n"
+            emails = [json.loads(email_json) for email_json in email_queue]
+            for email_data in emails:
+                #failed emails remember their campaign, so the retry task can keep its counters right
+                email_data["campaign_id"] = campaign_id
 
-            for eid in eids:
-                send_at = updated_send_at_records[eid]
-                google_message_id = updated_google_message_id_records[eid]
-                send_at_case += f"  WHEN eid = {eid} THEN '{send_at.isoformat()}'::timestamp\n"
-                google_message_id_case += f"  WHEN eid = {eid} THEN '{google_message_id}'\n"
+            send_results = await send_pipeline.run(emails, persist,
+                                                   should_stop=should_stop,
+                                                   on_email_start=lambda email_data: start_chunk_email(redis_connection, campaign_id, run, chunk_index))
 
-            send_at_case += "END"
-            google_message_id_case += "END"
+            last_result = send_results[-1] if send_results else None
 
-            sql_query = f"""
-                    UPDATE emails
-                    SET 
-                        is_sent = TRUE,
-                        send_at = {send_at_case},
-                        google_message_id = {google_message_id_case}
-                    WHERE eid IN ({','.join(map(str, eids))});
-                """
+            if not await owns_chunk_lease(redis_connection, campaign_id, run, chunk_index, lease_token):
+                #the chunk was taken back while this worker was stuck, the worker that has it now finishes it
+                return
 
-            db_connection.execute(text(sql_query))
+            if last_result is not None and last_result.outcome == "stopped":
+                #the campaign was paused or cancelled, put the remaining emails back into the queue
+                requeued_emails = await requeue_stopped_chunk(redis_connection, redis_queue_key, campaign_id, run, chunk_index)
 
+                if requeued_emails is None:
+                    #the campaign was resumed in between, the emails are still this chunk's to send
+                    continue
+
+            elif last_result is not None and last_result.outcome == "deferred":
+                #out of gmail quota, or gmail, google oauth or storage is down. Keep the rest of the chunk for later
+                await stop_chunk_email(redis_connection, campaign_id, run, chunk_index)
+                deferred_emails, defer_ms, defer_reason = email_queue[last_result.index:], last_result.retry_in_ms, last_result.reason
+
+            break
+
+        #commit the chunk: a crash before the results key is deleted only writes the same statuses again
+        sent_records = await redis_connection.hgetall(redis_chunk_results_key)
+        _mark_emails_sent(db_connection, {int(eid): json.loads(record) for eid, record in sent_records.items()})
         db_connection.commit()
+        await redis_connection.delete(redis_chunk_results_key)
+
+        if requeued_emails:
+            await record_changes(redis_connection, queue_version_key(user_id),
+                                 [{"op": "add", "id": json.loads(email_json).get("eid"), "data": email_json} for email_json in requeued_emails])
+
+        if deferred_emails:
+            #the chunk is not done, its unsent emails are sent once the quota window has room again or the breaker closes.
+            #they are exactly the emails still in the chunk list
+            if await defer_fair_chunk(redis_connection, user_id, campaign_id, run, chunk_index, lease_token, len(deferred_emails), defer_ms):
+                await publish_user_event(redis_connection, user_id, "deferred", campaign_id=campaign_id, count=len(deferred_emails), retry_in_ms=defer_ms, reason=defer_reason)
+            return
+
+        #a chunk that raises never reaches this point, it is resumed from its last checkpoint when its lease runs out
+        if await finish_campaign_chunk(redis_connection, campaign_id, run, chunk_index):
+            finalize_campaign_run.delay(user_id, campaign_id, run)
+
+        await release_chunk_lease(redis_connection, user_id, campaign_id, run, chunk_index, lease_token)
 
     finally:
         db_gen.close()
 
 
-@celery_app.task(name="retry_failed_emails")
-async def retry_failed_emails(user_id: str):
+@celery_app.task(name="finalize_campaign_run")
+async def finalize_campaign_run(user_id: str, campaign_id: str, run: int):
+    """
+    Final callback of a campaign, called by the chunk that closed the last open chunk of any of its runs. Every chunk
+    already committed its own results, so only the campaign status is left to update.
+    """
+
+    redis_connection = await get_redis_connection()
+
+    await complete_campaign(redis_connection, campaign_id)
+
+
+@celery_app.task(name="release_due_retries")
+async def release_due_retries():
+    """
+    Periodic task (celery beat, every RETRY_SWEEP_SECONDS): puts the retries of batches whose worker died back into the
+    schedule, together with the failed emails left in the lists of the old retry task, then leases the failed emails whose backoff has passed as batches of up to RETRY_BATCH_SIZE per user and
+    sends them in parallel across the workers.
+    """
+    redis_connection = await get_redis_connection()
+
+    await requeue_expired_retry_batches(redis_connection)
+    await drain_legacy_retry_queues(redis_connection)
+
+    retry_batches = await lease_due_retries(redis_connection, settings.RETRY_BATCH_SIZE * settings.RETRY_MAX_BATCHES_PER_SWEEP)
+
+    if retry_batches:
+        group(send_retry_batch.s(user_id, batch_id) for user_id, batch_id in retry_batches).apply_async()
+
+
+@celery_app.task(name="send_retry_batch")
+async def send_retry_batch(user_id: str, batch_id: str):
+    """
+    Retry one leased batch of failed emails of a user through the send pipeline. A failure is scheduled again with a
+    longer backoff, after RETRY_MAX_ATTEMPTS failures the email moves to the dead letter queue. Every email is acked in
+    the same transaction as its outcome is recorded and committed to the db right after, so a worker that dies mid-batch
+    loses nothing: the rest of the batch is put back into the schedule once its lease runs out. A worker that lost its
+    lease stops, the rest of the batch belongs to the worker that got it next.
+    """
     db_gen = get_db_session()
     db = next(db_gen)
-    redis_gen = await get_redis_connection()
-    redis = redis_gen
+    redis = await get_redis_connection()
+
+    async def checkpoint(result: SendResult, dead: bool, owned: bool = True) -> tuple[bool, float | None]:
+        """
+        Record the outcome of one retry and ack it, in one transaction that only applies while the batch is still ours.
+
+        :return: (whether the batch was still ours, the delay of the rescheduled retry)
+        """
+        email_data = result.email_data
+        retry_delay = None
+
+        async with redis.pipeline(transaction=True) as redis_pipeline:
+            #the sweep deletes the batch list when it takes the batch back, which aborts this transaction
+            await redis_pipeline.watch(retry_batch_key(batch_id))
+            owned = owned and await owns_retry_batch(redis, batch_id)
+
+            redis_pipeline.multi()
+            #the claim is this attempt's even when the batch was taken back, so the next attempt finds the eid sent
+            result.queue_claim_outcome(redis_pipeline)
+
+            if owned:
+                queue_retry_ack(redis_pipeline, batch_id)
+
+                if result.outcome == "sent":
+                    queue_campaign_counters(redis_pipeline, email_data.get("campaign_id"), failed=-1, sent=1)
+                elif result.outcome == "in_flight":
+                    #another attempt is sending this eid right now, look again once its claim expired without counting a retry
+                    retry_delay = queue_retry(redis_pipeline, user_id, email_data, delay_seconds=result.retry_in_ms / 1000)
+                elif dead:
+                    queue_dead_letter(redis_pipeline, user_id, email_data)
+                    queue_campaign_counters(redis_pipeline, email_data.get("campaign_id"), failed=-1, dead=1)
+                else:
+                    retry_delay = queue_retry(redis_pipeline, user_id, email_data)
 
-    failed_key = f"failed_email_queue:{user_id}"
-    dead_key = f"dead_email_queue:{user_id}"
+            try:
+                await redis_pipeline.execute()
+            except WatchError:
+                return await checkpoint(result, dead, owned=False)
 
-    try:
-        user = db.query(User).options(joinedload(User.user_tokens)).filter(User.uid == user_id).first()
-        if not user or not user.user_tokens:
+        return owned, retry_delay
+
+    async def persist(result: SendResult) -> None:
+        if result.outcome in ("deferred", "stopped"):
             return
 
-        while True:
-            email_json = await redis.lpop(failed_key)
-            if email_json is None:
-                break
+        email_data = result.email_data
+        campaign_id = email_data.get("campaign_id")
+        eid = result.email_object.eid
 
-            email_data = json.loads(email_json)
-            retry_count = email_data.get("retry_count", 0)
+        if result.outcome in ("failed", "dead"):
+            if result.error is not None:
+                email_data["error"] = result.error
 
-            email_obj = EmailSchema.model_validate(email_data)
+            if result.outcome == "failed":
+                email_data["retry_count"] = email_data.get("retry_count", 0) + 1
 
-            response = gmail_send_message(email_object=email_obj, google_access_token=user.user_tokens[0].access_token, from_email=user.email, user_token=user.user_tokens[0], db_connection=db)
+        dead = result.outcome == "dead" or (result.outcome == "failed" and email_data["retry_count"] > settings.RETRY_MAX_ATTEMPTS)
 
-            if response:
-                # Mark as sent in DB
-                if email_obj.eid:
-                    db.query(Email).filter(Email.eid == email_obj.eid).update({
-                        Email.is_sent: True,
-                        Email.google_message_id: response.get("id"),
-                        Email.send_at: datetime.utcnow()
-                    })
-                else:
-                    db.add(Email(
-                        uid=user_id,
-                        google_message_id=response.get("id"),
-                        subject=email_obj.subject,
-                        body=email_obj.body,
-                        is_sent=True,
-                        to_email=email_obj.to_email,
-                        cc_email=email_obj.cc_email,
-                        bcc_email=email_obj.bcc_email,
-                        send_at=datetime.utcnow()
-                    ))
-            else:
-                retry_count += 1
-                email_data["retry_count"] = retry_count
-
-                if retry_count > 3:
-                    await redis.rpush(dead_key, json.dumps(email_data))
-                else:
-                    await redis.rpush(failed_key, json.dumps(email_data))
+        owned, retry_delay = await checkpoint(result, dead)
+
+        if not owned:
+            #the retry was put back into the schedule, its outcome is recorded by the attempt that takes it next
+            return
+
+        if result.outcome == "sent":
+            #the claim already says sent, a crash before the commit can not send the email twice
+            save_sent_email(db, user_id, result.email_object, result.google_message_id)
+            db.commit()
+            await publish_user_event(redis, user_id, "sent", eid=eid, campaign_id=campaign_id, google_message_id=result.google_message_id)
+        elif dead:
+            await publish_user_event(redis, user_id, "dead", eid=eid, campaign_id=campaign_id, retry_count=email_data.get("retry_count", 0), error=result.error)
+        elif result.outcome == "failed":
+            await publish_user_event(redis, user_id, "failed", eid=eid, campaign_id=campaign_id, retry_count=email_data["retry_count"], retry_in_ms=int(retry_delay * 1000))
+
+    async def lease_lost() -> bool:
+        return not await owns_retry_batch(redis, batch_id)
+
+    try:
+        emails = [parse_retry(retry)["email"] for retry in await read_retry_batch(redis, batch_id)]
+
+        user = db.query(User).options(joinedload(User.user_tokens)).filter(User.uid == user_id).first()
+
+        #the eids of this batch are claimed in the name of this lease of the batch
+        send_pipeline = SendPipeline(redis, db, user, claim_owner=f"retry_batch:{batch_id}")
+
+        send_results = await send_pipeline.run(emails, persist, should_stop=lease_lost)
+
+        if send_results and send_results[-1].outcome == "deferred":
+            #out of gmail quota or gmail is down: this and the rest of the batch were not attempted, this does not
+            #count as a retry
+            await defer_retry_batch(redis, batch_id, send_results[-1].retry_in_ms / 1000)
 
-        db.commit()
+        elif not send_results or send_results[-1].outcome != "stopped":
+            #every retry of the batch was acked
+            await release_retry_batch(redis, batch_id)
 
     finally:
         db_gen.close()
-        await redis_gen.close()
\ No newline at end of file
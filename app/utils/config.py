@@ -9,6 +9,7 @@ class Settings(BaseSettings):
     NEON_DB_CONNECTION_URL: str
     SUPABASE_ACCESS_KEY_ID: str
     SUPABASE_SERVICE_ROLE: str
+    SUPABASE_S3_STORAGE_ENDPOINT: str = ""
     ALLOWED_ORIGINS: list[str] = []
     OAUTHLIB_INSECURE_TRANSPORT: int
     DEBUG: bool = False
@@ -35,6 +36,96 @@ class Settings(BaseSettings):
     RATE_HEAVY_PATHS: str = ""
     RATE_SKIP_PATHS: str = ""
 
+    CACHE_HARD_TTL_SECONDS: int = 90 * 60
+    CACHE_SOFT_TTL_SECONDS: int = 60 * 60
+    CACHE_FILL_LOCK_MS: int = 5000
+    CACHE_FILL_WAIT_MS: int = 2000
+    CACHE_FILL_POLL_MS: int = 50
+
+    CHANGELOG_MAX_LENGTH: int = 1000
+    CHANGELOG_MAX_DELTA: int = 500
+    CHANGELOG_TTL_SECONDS: int = 7 * 24 * 60 * 60
+
+    EVENTS_MAX_QUEUED_PER_CLIENT: int = 100
+    EVENTS_HEARTBEAT_SECONDS: int = 15
+    EVENTS_TOKEN_EXPIRATION_SECONDS: int = 60
+
+    CAMPAIGN_TTL_SECONDS: int = 7 * 24 * 60 * 60
+    CELERY_STORE_RESULTS: bool = False
+    SEND_CHUNK_SIZE: int = 100
+    USER_TASK_QUEUES: str = "user-0,user-1,user-2,user-3"
+    FAIR_PLAN_WEIGHTS: str = "default:1,free:1,pro:2,business:4"
+    FAIR_QUANTUM: int = 100
+    FAIR_MAX_PICK_STEPS: int = 1000
+    INTERACTIVE_TASK_QUEUE: str = "interactive"
+    SEND_NOW_WAIT_SECONDS: int = 10
+    SEND_RESULT_TTL_SECONDS: int = 60 * 60
+    GMAIL_DAILY_SEND_LIMIT: int = 500
+    GMAIL_SENDS_PER_SECOND: int = 2
+    QUOTA_MAX_INLINE_WAIT_MS: int = 2000
+    DEFERRED_SWEEP_SECONDS: int = 30
+    AIMD_INITIAL_LIMIT_GLOBAL: float = 8
+    AIMD_INITIAL_LIMIT_ACCOUNT: float = 2
+    AIMD_MAX_LIMIT_GLOBAL: float = 64
+    AIMD_MAX_LIMIT_ACCOUNT: float = 8
+    AIMD_DECREASE_FACTOR: float = 0.5
+    AIMD_DECREASE_COOLDOWN_MS: int = 1000
+    AIMD_SLOT_LEASE_MS: int = 60 * 1000
+    AIMD_POLL_MS: int = 50
+    GMAIL_THROTTLE_RETRIES: int = 3
+    BREAKER_FAILURE_RATE: float = 0.5
+    BREAKER_MIN_CALLS: int = 10
+    BREAKER_WINDOW_SECONDS: int = 60
+    BREAKER_OPEN_SECONDS: int = 30
+    BREAKER_PROBE_TIMEOUT_SECONDS: int = 30
+    RETRY_BASE_DELAY_SECONDS: int = 60
+    RETRY_MAX_DELAY_SECONDS: int = 60 * 60
+    RETRY_MAX_ATTEMPTS: int = 3
+    RETRY_BATCH_SIZE: int = 50
+    RETRY_MAX_BATCHES_PER_SWEEP: int = 20
+    RETRY_SWEEP_SECONDS: int = 30
+    RETRY_LEASE_SECONDS: int = 5 * 60
+    CHUNK_LEASE_SECONDS: int = 5 * 60
+    SEND_CLAIM_TTL_SECONDS: int = 10 * 60
+    SEND_DEDUPE_TTL_SECONDS: int = 7 * 24 * 60 * 60
+    IDEMPOTENCY_KEY_TTL_SECONDS: int = 24 * 60 * 60
+    GOOGLE_TOKEN_MIN_VALIDITY_SECONDS: int = 60
+    GOOGLE_TOKEN_REFRESH_AHEAD_SECONDS: int = 10 * 60
+    GOOGLE_TOKEN_SWEEP_SECONDS: int = 5 * 60
+    GOOGLE_TOKEN_REFRESH_LOCK_MS: int = 10 * 1000
+    GOOGLE_TOKEN_REFRESH_WAIT_MS: int = 5 * 1000
+    GOOGLE_TOKEN_POLL_MS: int = 50
+    GOOGLE_TOKEN_REVOKED_TTL_SECONDS: int = 6 * 60 * 60
+    OAUTH_HTTP_MAX_CONNECTIONS: int = 20
+    OAUTH_HTTP_TIMEOUT_SECONDS: int = 10
+    SENDER_STICKY_TTL_SECONDS: int = 30 * 24 * 60 * 60
+    GMAIL_CONNECT_TTL_SECONDS: int = 10 * 60
+    EMAIL_TRANSPORT: str = "gmail_api"
+    GMAIL_MEDIA_UPLOAD_THRESHOLD_BYTES: int = 1024 * 1024
+    GMAIL_UPLOAD_CHUNK_BYTES: int = 1024 * 1024
+    ATTACHMENT_MAX_BYTES: int = 5 * 1024 * 1024
+    ATTACHMENT_CONTENT_TYPES: list[str] = ["application/pdf", "application/msword",
+                                           "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                                           "text/plain", "image/png", "image/jpeg"]
+    ATTACHMENT_CACHE_DIR: str = "attachment_cache"
+    ATTACHMENT_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    DIRECT_UPLOAD_TTL_SECONDS: int = 15 * 60
+    DIRECT_UPLOAD_STALE_SECONDS: int = 3 * 60 * 60     #longer than the 2 hours a supabase signed upload url is valid
+    DIRECT_UPLOAD_SWEEP_SECONDS: int = 15 * 60
+    STORAGE_RESUMABLE_UPLOAD_THRESHOLD_BYTES: int = 2 * 1024 * 1024
+    STORAGE_UPLOAD_CHUNK_BYTES: int = 512 * 1024     #well below ATTACHMENT_MAX_BYTES, a resumable upload has several chunks to resume from
+    STORAGE_UPLOAD_PARALLELISM: int = 4
+    STORAGE_UPLOAD_PART_RETRIES: int = 5
+    STORAGE_UPLOAD_RETRY_BASE_DELAY_SECONDS: float = 0.5
+    STORAGE_UPLOAD_TIMEOUT_SECONDS: int = 60
+    STORAGE_UPLOAD_RESUME_TTL_SECONDS: int = 24 * 60 * 60
+    SMTP_HOST: str = "smtp.gmail.com"
+    SMTP_PORT: int = 587
+    SMTP_POOL_SIZE: int = 4
+    SMTP_TIMEOUT_SECONDS: int = 30
+    EMAIL_SINK_DIR: str | None = None
+    EMAIL_SINK_MAX_MESSAGES: int = 10000
+
     class Config:
         env_file = ".env"
 
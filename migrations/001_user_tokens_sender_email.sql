@@ -0,0 +1,3 @@
+-- a user can connect several gmail accounts, every token remembers the address it sends as.
+-- tokens from before keep NULL and send as the user's email
+ALTER TABLE user_tokens ADD COLUMN IF NOT EXISTS sender_email VARCHAR;
@@ -0,0 +1,2 @@
+-- the transport an account sends with: gmail_api, smtp or sink. NULL uses EMAIL_TRANSPORT
+ALTER TABLE user_tokens ADD COLUMN IF NOT EXISTS transport VARCHAR;
@@ -0,0 +1,20 @@
+-- attachments of a user, one row per file content. The objects are content addressed and shared between users
+CREATE TABLE IF NOT EXISTS attachments (
+    attachment_id SERIAL NOT NULL,
+    uid INTEGER NOT NULL,
+    sha256 VARCHAR(64) NOT NULL,
+    filename VARCHAR NOT NULL,
+    content_type VARCHAR NOT NULL,
+    size INTEGER NOT NULL,
+    object_url VARCHAR NOT NULL,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (attachment_id),
+    UNIQUE (uid, sha256),
+    FOREIGN KEY (uid) REFERENCES users (uid)
+);
+
+CREATE INDEX IF NOT EXISTS ix_attachments_sha256 ON attachments (sha256);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_attachments_attachment_id ON attachments (attachment_id);
+
+-- the attachments sent with an email
+ALTER TABLE emails ADD COLUMN IF NOT EXISTS attachment_ids JSON;
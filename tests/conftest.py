@@ -0,0 +1,53 @@
+import os
+
+import fakeredis
+import pytest
+
+#settings are read from the environment on import, the tests only need values that parse. Redis is replaced by fakeredis
+#(with lua) in every test, nothing here connects to a real server
+for setting, value in {
+    "DB_CONNECTION_URL": "sqlite://",
+    "NEON_DB_CONNECTION_URL": "sqlite://",
+    "SUPABASE_ACCESS_KEY_ID": "test",
+    "SUPABASE_SERVICE_ROLE": "test",
+    "OAUTHLIB_INSECURE_TRANSPORT": "1",
+    "JWT_AUTH_ALGORITHM": "HS256",
+    "JWT_SIGNATURE_SECRET_KEY": "test",
+    "JWT_TOKEN_EXPIRATION_MINUTES": "5",
+    "JWT_REFRESH_TOKEN_EXPIRATION_DAYS": "1",
+    "GOOGLE_CLIENT_ID": "test",
+    "GOOGLE_CLIENT_SECRET": "test",
+    "GOOGLE_PROJECT_ID": "test",
+    "REDIS_CLOUD_URL": "redis://localhost:6379/0",
+    "REDIS_CLOUD_HOST": "localhost",
+    "REDIS_CLOUD_PORT": "6379",
+    "REDIS_CLOUD_USERNAME": "test",
+    "REDIS_CLOUD_PASSWORD": "test",
+    "RATE_LIMIT_PER_SECOND": "10",
+    "RATE_LIMIT_CAPACITY": "10",
+    "RATE_LIMIT_IDLE_TTL": "10",
+    "RATE_DEFAULT_COST": "1",
+    "RATE_HEAVY_COST": "2",
+}.items():
+    os.environ.setdefault(setting, value)
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def redis_connection(redis_server):
+    return fakeredis.FakeAsyncRedis(server=redis_server, decode_responses=True)
+
+
+@pytest.fixture
+def sync_redis_connection(redis_server):
+    #the same server as redis_connection, like the async and the sync client of the app share one redis
+    return fakeredis.FakeRedis(server=redis_server, decode_responses=True)
@@ -0,0 +1,216 @@
+import hashlib
+import secrets
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.models import User, Attachment
+from app.models.base_model import Base
+from app.services import attachment_services, storage_service
+from app.services.attachment_services import create_direct_upload, complete_direct_upload, remove_stale_direct_uploads, \
+    cached_attachment_path, direct_upload_key, store_attachment, get_user_attachments, PENDING_DIRECT_UPLOADS_KEY
+from app.services.storage_service import storage_breaker, STORAGE_BUCKET
+from app.utils.config import settings
+
+CONTENT = b"%PDF-1.7 resume" * 100
+CONTENT_SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+class _Storage:
+    """
+    In memory stand-in for the S3 compatible supabase storage api: signed upload urls, PUT to a signed url, and
+    POST, GET, HEAD and DELETE of objects.
+    """
+    def __init__(self):
+        self.objects: dict[str, tuple[bytes, str]] = {}
+        self.upload_tokens: dict[str, str] = {}
+        self.requests: list[tuple[str, str]] = []
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append((request.method, request.url.path))
+        path = request.url.path
+
+        if path.startswith("/object/upload/sign/"):
+            object_name = path[len(f"/object/upload/sign/{STORAGE_BUCKET}/"):]
+            return self._sign(object_name) if request.method == "POST" else self._signed_put(request, object_name)
+
+        object_name = path[len(f"/object/{STORAGE_BUCKET}/"):]
+        return getattr(self, f"_{request.method.lower()}")(request, object_name)
+
+    def _sign(self, object_name):
+        token = secrets.token_hex(8)
+        self.upload_tokens[token] = object_name
+        return httpx.Response(200, json={"url": f"/object/upload/sign/{STORAGE_BUCKET}/{object_name}?token={token}"})
+
+    def _signed_put(self, request, object_name):
+        if self.upload_tokens.get(request.url.params.get("token")) != object_name:
+            return httpx.Response(403)
+        self.objects[object_name] = (request.content, request.headers["content-type"])
+        return httpx.Response(200)
+
+    def _post(self, request, object_name):
+        self.objects[object_name] = (request.content, request.headers["content-type"])
+        return httpx.Response(200)
+
+    def _get(self, request, object_name):
+        if object_name not in self.objects:
+            return httpx.Response(404)
+        return httpx.Response(200, content=self.objects[object_name][0])
+
+    def _head(self, request, object_name):
+        if object_name not in self.objects:
+            return httpx.Response(404)
+        content, content_type = self.objects[object_name]
+        return httpx.Response(200, headers={"content-length": str(len(content)), "content-type": content_type})
+
+    def _delete(self, request, object_name):
+        return httpx.Response(200 if self.objects.pop(object_name, None) is not None else 404)
+
+    def count(self, method: str) -> int:
+        return sum(1 for request_method, _ in self.requests if request_method == method)
+
+
+@pytest.fixture
+def storage(monkeypatch, sync_redis_connection, tmp_path):
+    server = _Storage()
+    client = httpx.Client(transport=httpx.MockTransport(server.handle))
+
+    monkeypatch.setattr(storage_service, "httpx", SimpleNamespace(post=client.post, put=client.put, get=client.get,
+                                                                  head=client.head, delete=client.delete,
+                                                                  RequestError=httpx.RequestError))
+    monkeypatch.setattr(attachment_services, "sync_redis_client", sync_redis_connection)
+    monkeypatch.setattr(storage_breaker, "_redis", sync_redis_connection)
+    monkeypatch.setattr(settings, "SUPABASE_S3_STORAGE_ENDPOINT", "http://storage")
+    monkeypatch.setattr(settings, "ATTACHMENT_CACHE_DIR", str(tmp_path / "attachments"))
+
+    server.client = client
+    return server
+
+
+@pytest.fixture
+def db_connection():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine, tables=[User.__table__, Attachment.__table__])
+
+    session = sessionmaker(bind=engine)()
+    session.add_all([User(uid=1, name="a", email="a@x.com", password="x"), User(uid=2, name="b", email="b@x.com", password="x")])
+    session.commit()
+
+    yield session
+
+    session.close()
+
+
+def _start_upload(db_connection, user_id=1, sha256=CONTENT_SHA256, size=len(CONTENT)):
+    return create_direct_upload(db_connection, user_id, "resume.pdf", "application/pdf", size, sha256, "resume")
+
+
+def test_signed_url_round_trip(storage, db_connection, sync_redis_connection):
+    upload = _start_upload(db_connection)
+
+    #the client uploads straight to storage
+    assert storage.client.put(upload["upload_url"], content=CONTENT, headers={"Content-Type": "application/pdf"}).status_code == 200
+
+    attachment, purpose, error = complete_direct_upload(db_connection, 1, upload["upload_id"])
+
+    assert error is None and purpose == "resume"
+    assert attachment.object_url == f"http://storage/object/{STORAGE_BUCKET}/uploads/1/{upload['upload_id']}"
+    assert attachment.size == len(CONTENT) and attachment.sha256 == CONTENT_SHA256
+    #completing only looked at the object, it was never downloaded by the api
+    assert storage.count("GET") == 0 and storage.count("HEAD") == 1
+    assert not sync_redis_connection.exists(direct_upload_key(upload["upload_id"]))
+    assert sync_redis_connection.zcard(PENDING_DIRECT_UPLOADS_KEY) == 0
+
+    with open(cached_attachment_path(attachment), "rb") as cached_file:
+        assert cached_file.read() == CONTENT
+
+
+def test_known_file_is_not_uploaded_again(storage, db_connection):
+    upload = _start_upload(db_connection)
+    storage.client.put(upload["upload_url"], content=CONTENT, headers={"Content-Type": "application/pdf"})
+    attachment, _, _ = complete_direct_upload(db_connection, 1, upload["upload_id"])
+
+    assert _start_upload(db_connection) == {"attachment": attachment}
+
+
+def test_mismatching_upload_is_deleted(storage, db_connection, sync_redis_connection):
+    upload = _start_upload(db_connection)
+    storage.client.put(upload["upload_url"], content=CONTENT, headers={"Content-Type": "text/html"})
+
+    assert complete_direct_upload(db_connection, 1, upload["upload_id"]) == (None, None, "upload_mismatch")
+    assert storage.objects == {}
+    assert not sync_redis_connection.exists(direct_upload_key(upload["upload_id"]))
+    assert db_connection.query(Attachment).count() == 0
+
+
+def test_missing_and_foreign_uploads(storage, db_connection):
+    upload = _start_upload(db_connection)
+
+    assert complete_direct_upload(db_connection, 1, upload["upload_id"]) == (None, None, "upload_missing")
+    assert complete_direct_upload(db_connection, 2, upload["upload_id"]) == (None, None, "upload_not_found")
+    assert complete_direct_upload(db_connection, 1, "unknown") == (None, None, "upload_not_found")
+
+
+def test_worker_rejects_a_wrong_declared_hash(storage, db_connection):
+    upload = _start_upload(db_connection, sha256="0" * 64)
+    storage.client.put(upload["upload_url"], content=CONTENT, headers={"Content-Type": "application/pdf"})
+
+    #size and type match, so the upload completes, but the file is never sent
+    attachment, _, error = complete_direct_upload(db_connection, 1, upload["upload_id"])
+
+    assert error is None
+    assert cached_attachment_path(attachment) == "download_failed"
+
+
+def test_stale_uploads_are_removed(storage, db_connection, sync_redis_connection, monkeypatch):
+    monkeypatch.setattr(settings, "DIRECT_UPLOAD_STALE_SECONDS", -1)
+
+    abandoned_upload = _start_upload(db_connection)
+    storage.client.put(abandoned_upload["upload_url"], content=CONTENT, headers={"Content-Type": "application/pdf"})
+    _start_upload(db_connection, sha256="1" * 64)
+
+    assert remove_stale_direct_uploads() == 2
+    assert storage.objects == {}
+    assert sync_redis_connection.zcard(PENDING_DIRECT_UPLOADS_KEY) == 0
+
+
+def test_same_content_is_stored_once(storage, db_connection):
+    attachment, known = store_attachment(db_connection, 1, CONTENT, "resume.pdf", "application/pdf")
+
+    assert not known
+    assert attachment.object_url == f"http://storage/object/{STORAGE_BUCKET}/attachments/{CONTENT_SHA256}"
+    #a file the user already has is not transferred again, whatever its name
+    assert store_attachment(db_connection, 1, CONTENT, "cv.pdf", "application/pdf") == (attachment, True)
+    assert storage.count("POST") == 1
+
+
+def test_same_content_of_another_user_is_uploaded_to_the_same_object(storage, db_connection):
+    attachment, _ = store_attachment(db_connection, 1, CONTENT, "resume.pdf", "application/pdf")
+    other_attachment, known = store_attachment(db_connection, 2, CONTENT, "resume.pdf", "application/pdf")
+
+    #the upload is not skipped, that would tell user 2 that somebody has the file
+    assert not known and storage.count("POST") == 2
+    assert other_attachment.attachment_id != attachment.attachment_id
+    assert other_attachment.object_url == attachment.object_url
+    assert list(storage.objects) == [f"attachments/{CONTENT_SHA256}"]
+
+
+def test_attachments_are_only_found_for_their_user(storage, db_connection):
+    attachment, _ = store_attachment(db_connection, 1, CONTENT, "resume.pdf", "application/pdf")
+    other_attachment, _ = store_attachment(db_connection, 2, b"other", "notes.txt", "text/plain")
+
+    assert get_user_attachments(db_connection, 1, [attachment.attachment_id, other_attachment.attachment_id]) == {attachment.attachment_id: attachment}
+    assert get_user_attachments(db_connection, 1, []) == {}
+
+
+def test_cached_attachment_is_downloaded_once(storage, db_connection):
+    attachment, _ = store_attachment(db_connection, 1, CONTENT, "resume.pdf", "application/pdf")
+    other_attachment, _ = store_attachment(db_connection, 2, CONTENT, "cv.pdf", "application/pdf")
+
+    #the cache is keyed by content, the attachment of the other user is a hit as well
+    assert cached_attachment_path(attachment) == cached_attachment_path(other_attachment) == cached_attachment_path(attachment)
+    assert storage.count("GET") == 1
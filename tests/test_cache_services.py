@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import pytest
+
+from app.services import cache_services
+from app.services.cache_services import get_or_fill_cache, write_cache, fresh_marker_key, fill_lock_key
+from app.services.version_services import get_version, queue_version_key
+from app.utils.config import settings
+
+pytestmark = pytest.mark.anyio
+
+
+class _Loader:
+    """
+    Stands in for the db query of a cache, counts how often it runs.
+    """
+    def __init__(self, payload: list[str], seconds: float = 0):
+        self.payload = payload
+        self.seconds = seconds
+        self.calls = 0
+
+    def __call__(self, db_connection) -> list[str]:
+        self.calls += 1
+        time.sleep(self.seconds)
+        return self.payload
+
+
+async def _background_refreshes_done() -> None:
+    await asyncio.gather(*cache_services._background_refreshes)
+
+
+async def test_concurrent_misses_fill_the_cache_once(redis_connection):
+    loader = _Loader(["a", "b"], seconds=0.2)
+
+    results = await asyncio.gather(*(get_or_fill_cache(redis_connection, "cache:1", "list", loader, None) for _ in range(5)))
+
+    assert loader.calls == 1
+    assert all(payload == ["a", "b"] for payload, _ in results)
+    assert sorted(source for _, source in results) == ["db", "redis", "redis", "redis", "redis"]
+    assert not await redis_connection.exists(fill_lock_key("cache:1"))
+
+
+async def test_fill_wait_gives_up_on_a_dead_filler(redis_connection, monkeypatch):
+    monkeypatch.setattr(settings, "CACHE_FILL_WAIT_MS", 50)
+    #the filler took the lock and died
+    await redis_connection.set(fill_lock_key("cache:1"), "dead", px=10_000)
+    loader = _Loader(["a"])
+
+    assert await get_or_fill_cache(redis_connection, "cache:1", "list", loader, None) == (["a"], "db")
+    #it does not write, the lock holder may still do so
+    assert not await redis_connection.exists("cache:1")
+
+
+async def test_stale_entry_is_served_and_refreshed_once(redis_connection):
+    await write_cache(redis_connection, "cache:1", "list", ["old"])
+    await redis_connection.delete(fresh_marker_key("cache:1"))
+    loader = _Loader(["new"], seconds=0.1)
+
+    results = await asyncio.gather(*(get_or_fill_cache(redis_connection, "cache:1", "list", loader, None) for _ in range(3)))
+    await _background_refreshes_done()
+
+    assert results == [(["old"], "redis_stale")] * 3
+    assert loader.calls == 1
+    assert await get_or_fill_cache(redis_connection, "cache:1", "list", loader, None) == (["new"], "redis")
+
+
+async def test_only_a_refresh_that_finds_other_data_changes_the_version(redis_connection):
+    version_key = queue_version_key(1)
+    version = await get_version(redis_connection, version_key)
+
+    #a cold fill does not mean the data changed
+    await get_or_fill_cache(redis_connection, "cache:1", "list", _Loader(["a"]), None, version_key)
+    assert await get_version(redis_connection, version_key) == version
+
+    await redis_connection.delete(fresh_marker_key("cache:1"))
+    await get_or_fill_cache(redis_connection, "cache:1", "list", _Loader(["a"]), None, version_key)
+    await _background_refreshes_done()
+    assert await get_version(redis_connection, version_key) == version
+
+    await redis_connection.delete(fresh_marker_key("cache:1"))
+    await get_or_fill_cache(redis_connection, "cache:1", "list", _Loader(["b"]), None, version_key)
+    await _background_refreshes_done()
+    assert await get_version(redis_connection, version_key) == version + 1
@@ -0,0 +1,177 @@
+import json
+
+import fakeredis
+import pytest
+
+from app.services.campaign_services import create_campaign, get_campaign, set_campaign_status, complete_campaign, \
+    start_chunk_email, stop_chunk_email, queue_chunk_email_done, finish_campaign_chunk, requeue_stopped_chunk, \
+    claim_campaign_chunks, campaign_key, campaign_chunk_key
+
+pytestmark = pytest.mark.anyio
+
+QUEUE_KEY = "email_queue:1"
+
+
+async def _queue_emails(redis_connection, eids):
+    await redis_connection.rpush(QUEUE_KEY, *[json.dumps({"eid": eid, "subject": "s"}) for eid in eids])
+
+
+async def test_status_transitions(redis_connection):
+    campaign_id = await create_campaign(redis_connection, 1, [1, 2])
+
+    assert await set_campaign_status(redis_connection, campaign_id, "paused") == "paused"
+    #running is only reachable from queued, a paused campaign has to be resumed first
+    assert await set_campaign_status(redis_connection, campaign_id, "running") == "paused"
+    assert await set_campaign_status(redis_connection, campaign_id, "queued") == "queued"
+    assert await set_campaign_status(redis_connection, campaign_id, "running") == "running"
+    assert await set_campaign_status(redis_connection, campaign_id, "cancelled") == "cancelled"
+
+    #a cancelled campaign stays cancelled
+    for new_status in ("paused", "queued", "running"):
+        assert await set_campaign_status(redis_connection, campaign_id, new_status) == "cancelled"
+
+
+async def test_status_of_unknown_campaign(redis_connection):
+    assert await set_campaign_status(redis_connection, "missing", "paused") is None
+
+
+async def test_completed_campaign_can_not_be_paused(redis_connection):
+    campaign_id = await create_campaign(redis_connection, 1, [1])
+    await set_campaign_status(redis_connection, campaign_id, "running")
+    await complete_campaign(redis_connection, campaign_id)
+
+    assert await set_campaign_status(redis_connection, campaign_id, "paused") == "completed"
+    assert await set_campaign_status(redis_connection, campaign_id, "cancelled") == "completed"
+
+
+async def test_complete_waits_for_open_chunks_and_skips_the_rest(redis_connection):
+    campaign_id = await create_campaign(redis_connection, 1, [1, 2, 3])
+    await redis_connection.hset(campaign_key(campaign_id), "open_chunks", 1)
+
+    #only a running campaign completes
+    await complete_campaign(redis_connection, campaign_id)
+    assert (await get_campaign(redis_connection, campaign_id))["status"] == "queued"
+
+    await set_campaign_status(redis_connection, campaign_id, "running")
+    await complete_campaign(redis_connection, campaign_id)
+    assert (await get_campaign(redis_connection, campaign_id))["status"] == "running"
+
+    await redis_connection.hset(campaign_key(campaign_id), "open_chunks", 0)
+    await complete_campaign(redis_connection, campaign_id)
+
+    campaign = await get_campaign(redis_connection, campaign_id)
+    assert campaign["status"] == "completed"
+    assert campaign["queued"] == 0
+    assert campaign["skipped"] == 3
+
+
+async def test_chunk_email_is_counted_in_flight_once(redis_connection):
+    campaign_id = await create_campaign(redis_connection, 1, [1, 2])
+
+    await start_chunk_email(redis_connection, campaign_id, 1, 0)
+    #a resumed chunk starts the same email again
+    await start_chunk_email(redis_connection, campaign_id, 1, 0)
+
+    campaign = await get_campaign(redis_connection, campaign_id)
+    assert (campaign["queued"], campaign["in_flight"]) == (1, 1)
+
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    queue_chunk_email_done(redis_pipeline, campaign_id, 1, 0, "sent")
+    await redis_pipeline.execute()
+
+    await start_chunk_email(redis_connection, campaign_id, 1, 0)
+    await stop_chunk_email(redis_connection, campaign_id, 1, 0)
+
+    campaign = await get_campaign(redis_connection, campaign_id)
+    assert (campaign["queued"], campaign["in_flight"], campaign["sent"]) == (1, 0, 1)
+
+
+async def test_finish_chunk_closes_each_chunk_once(redis_connection):
+    campaign_id = await create_campaign(redis_connection, 1, [1, 2])
+    await redis_connection.hset(campaign_key(campaign_id), "open_chunks", 2)
+
+    assert await finish_campaign_chunk(redis_connection, campaign_id, 1, 0) is False
+    assert await finish_campaign_chunk(redis_connection, campaign_id, 1, 0) is False
+    assert await finish_campaign_chunk(redis_connection, campaign_id, 1, 1) is True
+    assert (await get_campaign(redis_connection, campaign_id))["open_chunks"] == 0
+
+
+async def test_claim_moves_selected_emails_into_chunks(redis_connection):
+    campaign_id = await create_campaign(redis_connection, 1, [1, 2, 4])
+    await _queue_emails(redis_connection, [1, 2, 3, 4])
+
+    assert await claim_campaign_chunks(redis_connection, QUEUE_KEY, campaign_id, 1, [4, 1, 2], 2) == [1, 2, 4]
+
+    assert [json.loads(email)["eid"] for email in await redis_connection.lrange(QUEUE_KEY, 0, -1)] == [3]
+    assert [json.loads(email)["eid"] for email in await redis_connection.lrange(campaign_chunk_key(campaign_id, 1, 0), 0, -1)] == [1, 2]
+    assert [json.loads(email)["eid"] for email in await redis_connection.lrange(campaign_chunk_key(campaign_id, 1, 1), 0, -1)] == [4]
+    assert (await get_campaign(redis_connection, campaign_id))["open_chunks"] == 2
+
+
+async def test_stopped_chunk_is_requeued_only_while_stopped(redis_connection):
+    campaign_id = await create_campaign(redis_connection, 1, [1, 2])
+    await _queue_emails(redis_connection, [1, 2])
+    await claim_campaign_chunks(redis_connection, QUEUE_KEY, campaign_id, 1, [1, 2], 2)
+    await set_campaign_status(redis_connection, campaign_id, "running")
+
+    #still running, the chunk keeps its emails
+    assert await requeue_stopped_chunk(redis_connection, QUEUE_KEY, campaign_id, 1, 0) is None
+    assert await redis_connection.llen(campaign_chunk_key(campaign_id, 1, 0)) == 2
+
+    await set_campaign_status(redis_connection, campaign_id, "paused")
+
+    requeued_emails = await requeue_stopped_chunk(redis_connection, QUEUE_KEY, campaign_id, 1, 0)
+    assert [json.loads(email)["eid"] for email in requeued_emails] == [1, 2]
+    assert await redis_connection.llen(QUEUE_KEY) == 2
+    assert not await redis_connection.exists(campaign_chunk_key(campaign_id, 1, 0))
+
+
+async def test_claim_takes_a_duplicate_email_once(redis_connection):
+    campaign_id = await create_campaign(redis_connection, 1, [1, 2])
+    await _queue_emails(redis_connection, [1, 2, 1])
+
+    assert await claim_campaign_chunks(redis_connection, QUEUE_KEY, campaign_id, 1, [1, 2], 10) == [1, 2]
+    assert [json.loads(email)["eid"] for email in await redis_connection.lrange(QUEUE_KEY, 0, -1)] == [1]
+
+
+async def test_claim_starts_over_when_the_queue_changes_meanwhile(redis_connection, redis_server, monkeypatch):
+    campaign_id = await create_campaign(redis_connection, 1, [1, 2])
+    await _queue_emails(redis_connection, [1, 2])
+    other_connection = fakeredis.FakeAsyncRedis(server=redis_server, decode_responses=True)
+
+    original_pipeline = redis_connection.pipeline
+    reads = []
+
+    def pipeline(*args, **kwargs):
+        redis_pipeline = original_pipeline(*args, **kwargs)
+        original_lrange = redis_pipeline.lrange
+
+        async def lrange(*lrange_args):
+            email_queue = await original_lrange(*lrange_args)
+            reads.append(email_queue)
+            if len(reads) == 1:
+                #another request queues an email between the read and the write of the claim
+                await other_connection.rpush(QUEUE_KEY, json.dumps({"eid": 3, "subject": "s"}))
+            return email_queue
+
+        redis_pipeline.lrange = lrange
+        return redis_pipeline
+
+    monkeypatch.setattr(redis_connection, "pipeline", pipeline)
+
+    assert await claim_campaign_chunks(redis_connection, QUEUE_KEY, campaign_id, 1, [1, 2], 1) == [1, 2]
+    assert len(reads) == 2
+    assert [json.loads(email)["eid"] for email in await redis_connection.lrange(QUEUE_KEY, 0, -1)] == [3]
+    assert (await get_campaign(redis_connection, campaign_id))["open_chunks"] == 2
+
+
+async def test_last_chunk_over_all_runs_finishes_the_campaign(redis_connection):
+    campaign_id = await create_campaign(redis_connection, 1, [1, 2, 3])
+    await _queue_emails(redis_connection, [1, 2, 3])
+    await claim_campaign_chunks(redis_connection, QUEUE_KEY, campaign_id, 1, [1, 2], 1)
+    #a resumed campaign claims its remaining email in a second run while the first one is still sending
+    await claim_campaign_chunks(redis_connection, QUEUE_KEY, campaign_id, 2, [3], 1)
+
+    assert await finish_campaign_chunk(redis_connection, campaign_id, 1, 0) is False
+    assert await finish_campaign_chunk(redis_connection, campaign_id, 2, 0) is False
+    assert await finish_campaign_chunk(redis_connection, campaign_id, 1, 1) is True
@@ -0,0 +1,105 @@
+import pytest
+
+from app.services.circuit_breaker_services import CircuitBreaker, CircuitOpenError, breaker_key, breaker_window_key
+from app.utils.config import settings
+
+
+class _DependencyError(Exception):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def small_window(monkeypatch):
+    monkeypatch.setattr(settings, "BREAKER_MIN_CALLS", 4)
+    monkeypatch.setattr(settings, "BREAKER_FAILURE_RATE", 0.5)
+
+
+@pytest.fixture
+def breaker(sync_redis_connection):
+    return CircuitBreaker("test", sync_redis_connection, is_failure=lambda error: isinstance(error, _DependencyError))
+
+
+def _call(breaker: CircuitBreaker, fail: bool = False, error: Exception | None = None) -> None:
+    with breaker.guard() as breaker_call:
+        if error is not None:
+            raise error
+        if fail:
+            breaker_call.record_failure()
+
+
+def _fail(breaker: CircuitBreaker, times: int) -> None:
+    for _ in range(times):
+        with pytest.raises(_DependencyError):
+            _call(breaker, error=_DependencyError())
+
+
+def _expire_open_state(sync_redis_connection) -> None:
+    sync_redis_connection.hset(breaker_key("test"), "open_until", 0)
+
+
+def test_opens_when_enough_calls_fail(breaker, sync_redis_connection):
+    _call(breaker)
+    _call(breaker)
+    _fail(breaker, 1)
+    assert sync_redis_connection.hget(breaker_key("test"), "state") is None
+
+    _call(breaker, fail=True)
+    assert sync_redis_connection.hget(breaker_key("test"), "state") == "open"
+
+    ran = []
+    with pytest.raises(CircuitOpenError) as open_error:
+        with breaker.guard():
+            ran.append(True)
+
+    assert not ran
+    assert 0 < open_error.value.retry_after_ms <= settings.BREAKER_OPEN_SECONDS * 1000
+
+
+def test_needs_the_minimum_number_of_calls(breaker, sync_redis_connection):
+    _fail(breaker, 3)
+
+    assert sync_redis_connection.hget(breaker_key("test"), "state") is None
+
+
+def test_errors_that_are_not_failures_do_not_count(breaker, sync_redis_connection):
+    for _ in range(4):
+        with pytest.raises(ValueError):
+            _call(breaker, error=ValueError())
+
+    assert sync_redis_connection.hget(breaker_key("test"), "state") is None
+
+
+def test_successful_probe_closes(breaker, sync_redis_connection):
+    _fail(breaker, 4)
+    _expire_open_state(sync_redis_connection)
+
+    with breaker.guard():
+        #only one probe at a time, the other callers keep failing fast
+        with pytest.raises(CircuitOpenError):
+            _call(breaker)
+
+    assert sync_redis_connection.hget(breaker_key("test"), "state") == "closed"
+    _call(breaker)
+
+
+def test_failed_probe_opens_again(breaker, sync_redis_connection):
+    _fail(breaker, 4)
+    _expire_open_state(sync_redis_connection)
+
+    _fail(breaker, 1)
+
+    assert sync_redis_connection.hget(breaker_key("test"), "state") == "open"
+    with pytest.raises(CircuitOpenError):
+        _call(breaker)
+
+
+def test_calls_started_before_opening_do_not_count(breaker, sync_redis_connection):
+    with pytest.raises(_DependencyError):
+        with breaker.guard():
+            _fail(breaker, 4)
+            open_until = sync_redis_connection.hget(breaker_key("test"), "open_until")
+            raise _DependencyError()
+
+    #the late failure neither restarted the open period nor went into the window of the next closed period
+    assert sync_redis_connection.hget(breaker_key("test"), "open_until") == open_until
+    assert not sync_redis_connection.exists(breaker_window_key("test"))
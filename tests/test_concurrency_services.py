@@ -0,0 +1,131 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import concurrency_services
+from app.services.concurrency_services import acquire_send_slot, release_send_slot, account_scope, in_flight_key, \
+    AIMD_LIMITS_KEY, AIMD_BLOCKED_UNTIL_KEY, GLOBAL_SCOPE
+from app.utils.config import settings
+
+pytestmark = pytest.mark.anyio
+
+
+class _Waited(Exception):
+    def __init__(self, seconds: float):
+        super().__init__(seconds)
+        self.seconds = seconds
+
+
+@pytest.fixture
+def no_waiting(monkeypatch):
+    #acquire_send_slot polls until a slot is free, the tests want to see the first wait instead
+    async def sleep(seconds: float) -> None:
+        raise _Waited(seconds)
+
+    monkeypatch.setattr(concurrency_services, "asyncio", SimpleNamespace(sleep=sleep))
+
+
+async def _limit(redis_connection, scope: str) -> float:
+    return float(await redis_connection.hget(AIMD_LIMITS_KEY, scope))
+
+
+async def test_account_limit_caps_the_sends_in_flight(redis_connection, no_waiting):
+    #AIMD_INITIAL_LIMIT_ACCOUNT is 2
+    first_lease = await acquire_send_slot(redis_connection, "a@x.com")
+    await acquire_send_slot(redis_connection, "a@x.com")
+
+    with pytest.raises(_Waited) as waited:
+        await acquire_send_slot(redis_connection, "a@x.com")
+    assert waited.value.seconds == settings.AIMD_POLL_MS / 1000
+
+    #other accounts have their own limit
+    await acquire_send_slot(redis_connection, "b@x.com")
+
+    await release_send_slot(redis_connection, "a@x.com", first_lease, "neutral")
+    await acquire_send_slot(redis_connection, "a@x.com")
+    assert await redis_connection.zcard(in_flight_key(GLOBAL_SCOPE)) == 3
+
+
+async def test_slot_of_a_dead_worker_expires(redis_connection, no_waiting, monkeypatch):
+    monkeypatch.setattr(settings, "AIMD_SLOT_LEASE_MS", 1)
+    await acquire_send_slot(redis_connection, "a@x.com")
+    await acquire_send_slot(redis_connection, "a@x.com")
+    await asyncio.sleep(0.01)
+
+    await acquire_send_slot(redis_connection, "a@x.com")
+
+
+async def test_success_increases_additively(redis_connection):
+    lease_id = await acquire_send_slot(redis_connection, "a@x.com")
+    await release_send_slot(redis_connection, "a@x.com", lease_id, "success")
+
+    assert await _limit(redis_connection, account_scope("a@x.com")) == pytest.approx(2.5)
+    assert await _limit(redis_connection, GLOBAL_SCOPE) == pytest.approx(8.125)
+    assert await redis_connection.zcard(in_flight_key(account_scope("a@x.com"))) == 0
+
+
+async def test_success_is_capped_at_the_max_limit(redis_connection, monkeypatch):
+    monkeypatch.setattr(settings, "AIMD_MAX_LIMIT_ACCOUNT", 2.2)
+
+    for _ in range(3):
+        lease_id = await acquire_send_slot(redis_connection, "a@x.com")
+        await release_send_slot(redis_connection, "a@x.com", lease_id, "success")
+
+    assert await _limit(redis_connection, account_scope("a@x.com")) == pytest.approx(2.2)
+
+
+async def test_throttle_decreases_once_per_cooldown(redis_connection):
+    first_lease = await acquire_send_slot(redis_connection, "a@x.com")
+    second_lease = await acquire_send_slot(redis_connection, "a@x.com")
+
+    #both in flight sends are throttled, the limit is only halved once
+    await release_send_slot(redis_connection, "a@x.com", first_lease, "throttled")
+    await release_send_slot(redis_connection, "a@x.com", second_lease, "throttled")
+
+    assert await _limit(redis_connection, account_scope("a@x.com")) == pytest.approx(1)
+    #a throttle concerns the account only
+    assert await _limit(redis_connection, GLOBAL_SCOPE) == pytest.approx(8)
+
+
+async def test_limit_never_drops_below_one(redis_connection, monkeypatch):
+    monkeypatch.setattr(settings, "AIMD_DECREASE_COOLDOWN_MS", 0)
+
+    for _ in range(3):
+        lease_id = await acquire_send_slot(redis_connection, "a@x.com")
+        await release_send_slot(redis_connection, "a@x.com", lease_id, "throttled")
+
+    assert await _limit(redis_connection, account_scope("a@x.com")) == pytest.approx(1)
+
+
+async def test_neutral_outcome_keeps_the_limit(redis_connection):
+    lease_id = await acquire_send_slot(redis_connection, "a@x.com")
+    await release_send_slot(redis_connection, "a@x.com", lease_id, "neutral")
+
+    assert await _limit(redis_connection, account_scope("a@x.com")) == pytest.approx(2)
+
+
+async def test_retry_after_blocks_the_account(redis_connection, no_waiting):
+    lease_id = await acquire_send_slot(redis_connection, "a@x.com")
+    await release_send_slot(redis_connection, "a@x.com", lease_id, "throttled", retry_after_ms=30 * 1000)
+
+    with pytest.raises(_Waited) as waited:
+        await acquire_send_slot(redis_connection, "a@x.com")
+    assert 29 < waited.value.seconds <= 30
+
+
+async def test_throttle_of_one_account_does_not_block_another(redis_connection, no_waiting):
+    lease_id = await acquire_send_slot(redis_connection, "a@x.com")
+    await release_send_slot(redis_connection, "a@x.com", lease_id, "throttled", retry_after_ms=30 * 1000)
+
+    await acquire_send_slot(redis_connection, "b@x.com")
+    assert await redis_connection.hget(AIMD_BLOCKED_UNTIL_KEY, GLOBAL_SCOPE) is None
+
+
+async def test_server_error_blocks_all_accounts(redis_connection, no_waiting):
+    lease_id = await acquire_send_slot(redis_connection, "a@x.com")
+    await release_send_slot(redis_connection, "a@x.com", lease_id, "server_error", retry_after_ms=30 * 1000)
+
+    assert await _limit(redis_connection, GLOBAL_SCOPE) == pytest.approx(4)
+    with pytest.raises(_Waited):
+        await acquire_send_slot(redis_connection, "b@x.com")
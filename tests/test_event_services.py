@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+from app.auth.dependency_auth import authenticate_request, authenticate_events_request, create_events_token, create_jwt_token
+from app.services.event_services import EventBroadcaster, publish_user_event, user_events_channel
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def broadcaster(redis_connection):
+    event_broadcaster = EventBroadcaster(redis_connection, max_queued_events=2)
+    yield event_broadcaster
+    await event_broadcaster.close()
+
+
+async def _next_event(event_queue: asyncio.Queue) -> str:
+    return await asyncio.wait_for(event_queue.get(), timeout=1)
+
+
+async def test_events_reach_only_the_clients_of_the_user(broadcaster, redis_connection):
+    async with broadcaster.subscribe(1) as first_client, broadcaster.subscribe(1) as second_client, broadcaster.subscribe(2) as other_user:
+        await publish_user_event(redis_connection, 1, "sent", eid=10)
+
+        assert await _next_event(first_client) == '{"type": "sent", "eid": 10}'
+        assert await _next_event(second_client) == '{"type": "sent", "eid": 10}'
+        await asyncio.sleep(0.05)
+        assert other_user.empty()
+
+
+async def test_process_subscribes_to_the_channels_of_connected_users_only(broadcaster, redis_connection):
+    async with broadcaster.subscribe(1) as event_queue:
+        async with broadcaster.subscribe(1):
+            assert await redis_connection.pubsub_channels() == [user_events_channel(1)]
+
+        #the first client of the user is still connected
+        assert await redis_connection.pubsub_channels() == [user_events_channel(1)]
+
+        await publish_user_event(redis_connection, 1, "sent", eid=10)
+        assert await _next_event(event_queue) == '{"type": "sent", "eid": 10}'
+
+    assert await redis_connection.pubsub_channels() == []
+
+
+async def test_slow_client_loses_its_oldest_events(broadcaster, redis_connection):
+    async with broadcaster.subscribe(1) as event_queue:
+        for eid in range(3):
+            await publish_user_event(redis_connection, 1, "sent", eid=eid)
+        await asyncio.sleep(0.05)
+
+        assert [await _next_event(event_queue) for _ in range(2)] == ['{"type": "sent", "eid": 1}', '{"type": "sent", "eid": 2}']
+
+
+def test_events_token_opens_only_the_events_stream():
+    events_token = create_events_token("1")
+
+    assert authenticate_events_request(token=events_token, http_credentials=None)["sub"] == "1"
+
+    with pytest.raises(HTTPException):
+        authenticate_request(HTTPAuthorizationCredentials(scheme="Bearer", credentials=events_token))
+
+    #an access token does not belong in a url
+    with pytest.raises(HTTPException):
+        authenticate_events_request(token=create_jwt_token("1"), http_credentials=None)
+
+    assert authenticate_events_request(token=None, http_credentials=HTTPAuthorizationCredentials(scheme="Bearer", credentials=create_jwt_token("1")))["sub"] == "1"
@@ -0,0 +1,80 @@
+import pytest
+
+from app.services.idempotency_services import claim_email_send, record_email_sent, release_email_send, queue_email_sent, \
+    claim_idempotency_key, store_idempotent_response, release_idempotency_key, send_claim_key, IDEMPOTENCY_METRICS_GROUP
+from app.services.metrics_services import metrics_key
+from app.utils.config import settings
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_second_attempt_is_short_circuited_while_in_flight(redis_connection):
+    assert await claim_email_send(redis_connection, 1, "chunk:a") == ("claimed", None)
+
+    outcome, expires_in_ms = await claim_email_send(redis_connection, 1, "chunk:b")
+    assert outcome == "in_flight"
+    assert 0 < expires_in_ms <= settings.SEND_CLAIM_TTL_SECONDS * 1000
+
+    #the claim names the attempt, the same owner asking again is a second attempt as well
+    assert (await claim_email_send(redis_connection, 1, "chunk:a"))[0] == "in_flight"
+    assert await redis_connection.hget(metrics_key(IDEMPOTENCY_METRICS_GROUP), "send:duplicate_in_flight") == "2"
+
+
+async def test_sent_email_returns_its_message_id(redis_connection):
+    await claim_email_send(redis_connection, 1, "chunk:a")
+    await record_email_sent(redis_connection, 1, "gmail-1")
+
+    assert await claim_email_send(redis_connection, 1, "retry_batch:b") == ("sent", "gmail-1")
+    #a late release of the attempt does not forget the send
+    await release_email_send(redis_connection, 1, "chunk:a")
+    assert await claim_email_send(redis_connection, 1, "retry_batch:b") == ("sent", "gmail-1")
+
+
+async def test_sent_is_recorded_on_the_outcome_pipeline(redis_connection):
+    await claim_email_send(redis_connection, 1, "chunk:a")
+
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    queue_email_sent(redis_pipeline, 1, "gmail-1")
+    await redis_pipeline.execute()
+
+    assert await redis_connection.get(send_claim_key(1)) == "sent:gmail-1"
+    assert await redis_connection.ttl(send_claim_key(1)) > settings.SEND_CLAIM_TTL_SECONDS
+
+
+async def test_only_the_owner_releases_the_claim(redis_connection):
+    await claim_email_send(redis_connection, 1, "chunk:a")
+
+    await release_email_send(redis_connection, 1, "chunk:old")
+    assert (await claim_email_send(redis_connection, 1, "chunk:b"))[0] == "in_flight"
+
+    await release_email_send(redis_connection, 1, "chunk:a")
+    assert await claim_email_send(redis_connection, 1, "chunk:b") == ("claimed", None)
+
+
+async def test_expired_claim_can_be_taken_over(redis_connection):
+    await claim_email_send(redis_connection, 1, "chunk:dead")
+    await redis_connection.delete(send_claim_key(1))
+
+    assert await claim_email_send(redis_connection, 1, "chunk:next") == ("claimed", None)
+    #the attempt that outlived its claim can not drop the claim of the next one
+    await release_email_send(redis_connection, 1, "chunk:dead")
+    assert await redis_connection.get(send_claim_key(1)) == "pending:chunk:next"
+
+
+async def test_idempotency_key_replays_the_first_response(redis_connection):
+    assert await claim_idempotency_key(redis_connection, 1, "send", "key-1", {"status": "pending"}) is None
+    assert await claim_idempotency_key(redis_connection, 1, "send", "key-1", {"status": "pending"}) == {"status": "pending"}
+
+    await store_idempotent_response(redis_connection, 1, "send", "key-1", {"success": True})
+    assert await claim_idempotency_key(redis_connection, 1, "send", "key-1", {}) == {"response": {"success": True}}
+
+    #keys are per user and scope
+    assert await claim_idempotency_key(redis_connection, 2, "send", "key-1", {}) is None
+    assert await claim_idempotency_key(redis_connection, 1, "campaign", "key-1", {}) is None
+
+
+async def test_released_idempotency_key_can_be_claimed_again(redis_connection):
+    await claim_idempotency_key(redis_connection, 1, "send", "key-1", {"status": "pending"})
+    await release_idempotency_key(redis_connection, 1, "send", "key-1")
+
+    assert await claim_idempotency_key(redis_connection, 1, "send", "key-1", {"status": "pending"}) is None
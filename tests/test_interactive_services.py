@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+
+from app.services.interactive_services import create_send_request, store_send_result, get_send_request, wait_for_send_result
+from app.services.routing_services import route_user_task
+from app.utils.config import settings
+
+pytestmark = pytest.mark.anyio
+
+
+def test_send_now_goes_to_the_interactive_lane():
+    assert route_user_task("send_email_now", ("7",), {}, {}) == {"queue": settings.INTERACTIVE_TASK_QUEUE}
+
+
+async def test_waiting_request_is_woken_by_the_result(redis_connection):
+    await create_send_request(redis_connection, "r1", 7)
+    assert await get_send_request(redis_connection, "r1") == {"user_id": "7", "status": "pending"}
+
+    waiting_request = asyncio.create_task(wait_for_send_result(redis_connection, "r1", timeout_seconds=5))
+    await asyncio.sleep(0.05)
+    await store_send_result(redis_connection, "r1", {"outcome": "sent", "message_id": "gmail-1"})
+
+    assert await asyncio.wait_for(waiting_request, timeout=2) == {"outcome": "sent", "message_id": "gmail-1"}
+    assert (await get_send_request(redis_connection, "r1"))["status"] == "done"
+
+
+async def test_result_stored_before_the_wait_is_not_missed(redis_connection):
+    await create_send_request(redis_connection, "r1", 7)
+    await store_send_result(redis_connection, "r1", {"outcome": "sent"})
+
+    assert await wait_for_send_result(redis_connection, "r1", timeout_seconds=1) == {"outcome": "sent"}
+
+
+async def test_wait_times_out_without_a_result(redis_connection):
+    await create_send_request(redis_connection, "r1", 7)
+
+    assert await wait_for_send_result(redis_connection, "r1", timeout_seconds=1) is None
+    assert await get_send_request(redis_connection, "unknown") is None
@@ -0,0 +1,104 @@
+import json
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+
+import httpx
+import pytest
+
+from app.services import oauth_services
+from app.services.oauth_services import build_authorization_url, exchange_authorization_code, fetch_google_userinfo, \
+    load_google_client_config, get_oauth_http_client, OAuthExchangeError, GOOGLE_USERINFO_URL
+
+pytestmark = pytest.mark.anyio
+
+CLIENT_CONFIG = {
+    "client_id": "client-1",
+    "client_secret": "secret-1",
+    "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+    "token_uri": "https://oauth2.googleapis.com/token"
+}
+
+
+@pytest.fixture
+def google(monkeypatch):
+    #answers of the token and userinfo endpoints, by url
+    responses: dict[str, httpx.Response] = {}
+    requests: list[httpx.Request] = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return responses[str(request.url)]
+
+    monkeypatch.setattr(oauth_services, "_google_client_config", CLIENT_CONFIG)
+    monkeypatch.setattr(oauth_services, "_oauth_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handle)))
+
+    return responses, requests
+
+
+def test_client_config_is_read_once(monkeypatch, tmp_path):
+    client_secrets_path = tmp_path / "client_secret.json"
+    client_secrets_path.write_text(json.dumps({"web": CLIENT_CONFIG}))
+    monkeypatch.setattr(oauth_services, "GOOGLE_CLIENT_SECRETS_FILE", str(client_secrets_path))
+    monkeypatch.setattr(oauth_services, "_google_client_config", None)
+
+    assert load_google_client_config() == CLIENT_CONFIG
+
+    client_secrets_path.unlink()
+    assert load_google_client_config() == CLIENT_CONFIG
+
+
+def test_authorization_url(google):
+    authorization_url = urlparse(build_authorization_url("https://app/callback", "state-1", "consent"))
+    query = parse_qs(authorization_url.query)
+
+    assert authorization_url.netloc == "accounts.google.com"
+    assert query["client_id"] == ["client-1"] and query["state"] == ["state-1"] and query["prompt"] == ["consent"]
+    assert query["access_type"] == ["offline"] and query["redirect_uri"] == ["https://app/callback"]
+
+
+async def test_code_is_exchanged_for_credentials(google):
+    responses, requests = google
+    responses[CLIENT_CONFIG["token_uri"]] = httpx.Response(200, json={
+        "access_token": "access-1", "refresh_token": "refresh-1", "expires_in": 3600, "scope": "email profile"
+    })
+
+    credentials = await exchange_authorization_code("code-1", "https://app/callback")
+
+    assert parse_qs(requests[0].content.decode())["code"] == ["code-1"]
+    assert credentials["token"] == "access-1" and credentials["refresh_token"] == "refresh-1"
+    assert credentials["granted_scopes"] == ["email", "profile"]
+    assert datetime.fromisoformat(credentials["expiry"]) > datetime.utcnow()
+
+
+async def test_refused_code_raises(google):
+    responses, _ = google
+    responses[CLIENT_CONFIG["token_uri"]] = httpx.Response(400, json={"error": "invalid_grant"})
+
+    with pytest.raises(OAuthExchangeError):
+        await exchange_authorization_code("code-1", "https://app/callback")
+
+
+async def test_unreachable_google_raises(monkeypatch):
+    def handle(request: httpx.Request) -> httpx.Response:
+        raise httpx.ConnectError("unreachable", request=request)
+
+    monkeypatch.setattr(oauth_services, "_google_client_config", CLIENT_CONFIG)
+    monkeypatch.setattr(oauth_services, "_oauth_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handle)))
+
+    with pytest.raises(OAuthExchangeError):
+        await fetch_google_userinfo("access-1")
+
+
+async def test_userinfo_is_fetched_with_the_access_token(google):
+    responses, requests = google
+    responses[GOOGLE_USERINFO_URL] = httpx.Response(200, json={"email": "a@x.com"})
+
+    assert await fetch_google_userinfo("access-1") == {"email": "a@x.com"}
+    assert requests[0].headers["authorization"] == "Bearer access-1"
+
+
+async def test_http_client_is_shared(monkeypatch):
+    monkeypatch.setattr(oauth_services, "_oauth_http_client", None)
+
+    assert get_oauth_http_client() is get_oauth_http_client()
+    await oauth_services.close_oauth_http_client()
@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+from app.services import quota_services
+from app.services.metrics_services import metrics_key
+from app.services.quota_services import reserve_send_quota, wait_for_send_quota, daily_sends_key, second_sends_key, \
+    DAY_WINDOW_MS, QUOTA_METRICS_GROUP
+from app.utils.config import settings
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    def set_limits(daily: int, per_second: int):
+        monkeypatch.setattr(settings, "GMAIL_DAILY_SEND_LIMIT", daily)
+        monkeypatch.setattr(settings, "GMAIL_SENDS_PER_SECOND", per_second)
+
+    return set_limits
+
+
+async def test_per_second_limit(redis_connection, limits):
+    limits(daily=100, per_second=2)
+
+    assert await reserve_send_quota(redis_connection, "a@x.com") == 0
+    assert await reserve_send_quota(redis_connection, "a@x.com") == 0
+    assert 0 < await reserve_send_quota(redis_connection, "a@x.com") <= 1001
+
+    #a rejected send is not recorded in any window
+    assert await redis_connection.zcard(daily_sends_key("a@x.com")) == 2
+    assert await redis_connection.zcard(second_sends_key("a@x.com")) == 2
+
+
+async def test_daily_limit(redis_connection, limits):
+    limits(daily=2, per_second=100)
+
+    await reserve_send_quota(redis_connection, "a@x.com")
+    await reserve_send_quota(redis_connection, "a@x.com")
+
+    assert await reserve_send_quota(redis_connection, "a@x.com") > DAY_WINDOW_MS - 60 * 1000
+    #the quota is per sending account
+    assert await reserve_send_quota(redis_connection, "b@x.com") == 0
+
+
+async def test_daily_window_slides(redis_connection, limits):
+    limits(daily=1, per_second=100)
+    await redis_connection.zadd(daily_sends_key("a@x.com"), {"yesterday": time.time() * 1000 - DAY_WINDOW_MS - 1000})
+
+    assert await reserve_send_quota(redis_connection, "a@x.com") == 0
+    assert "yesterday" not in await redis_connection.zrange(daily_sends_key("a@x.com"), 0, -1)
+
+
+async def test_short_waits_are_slept_through(redis_connection, limits, monkeypatch):
+    limits(daily=100, per_second=1)
+    monkeypatch.setattr(quota_services, "SECOND_WINDOW_MS", 50)
+
+    assert await wait_for_send_quota(redis_connection, "a@x.com") == 0
+    assert await wait_for_send_quota(redis_connection, "a@x.com") == 0
+
+    assert await redis_connection.hget(metrics_key(QUOTA_METRICS_GROUP), "throttled") == "1"
+
+
+async def test_long_waits_are_deferred(redis_connection, limits):
+    limits(daily=1, per_second=100)
+
+    assert await wait_for_send_quota(redis_connection, "a@x.com") == 0
+    assert await wait_for_send_quota(redis_connection, "a@x.com") > settings.QUOTA_MAX_INLINE_WAIT_MS
+
+    assert await redis_connection.hget(metrics_key(QUOTA_METRICS_GROUP), "deferred") == "1"
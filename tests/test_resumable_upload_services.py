@@ -0,0 +1,186 @@
+import base64
+import json
+import threading
+
+import httpx
+import pytest
+
+from app.services import resumable_upload_services
+from app.services.resumable_upload_services import upload_to_storage_resumable, resumable_upload_key
+from app.services.storage_service import storage_breaker
+from app.utils.config import settings
+
+CONTENT = bytes(range(100)) * 10
+
+
+class _TusServer:
+    """
+    In memory tus server with the creation and concatenation extensions, enough of supabase's /upload/resumable for
+    the client.
+    """
+    def __init__(self):
+        self.uploads: dict[str, dict] = {}
+        self.objects: dict[str, bytes] = {}
+        self.options_status = 200
+        self.failing_patches = 0
+        self.stop_after_patches: int | None = None
+        self.requests: list[tuple[str, str]] = []
+        self.received_bytes = 0
+        self._lock = threading.Lock()
+
+    def forget_uploads(self) -> None:
+        self.uploads.clear()
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        with self._lock:
+            self.requests.append((request.method, str(request.url)))
+            return getattr(self, f"_{request.method.lower()}")(request)
+
+    def _options(self, request):
+        return httpx.Response(self.options_status, headers={"tus-extension": "creation,concatenation"} if self.options_status == 204 else {})
+
+    def _post(self, request):
+        concat = request.headers.get("upload-concat", "")
+
+        if concat.startswith("final;"):
+            part_urls = concat[len("final;"):].split()
+            if any(url not in self.uploads for url in part_urls):
+                return httpx.Response(404)
+            self._store(request, b"".join(bytes(self.uploads[url]["data"]) for url in part_urls))
+            return httpx.Response(201, headers={"location": "http://tus/final"})
+
+        upload_url = f"http://tus/upload/{len(self.requests)}"
+        self.uploads[upload_url] = {"length": int(request.headers["upload-length"]), "data": bytearray(),
+                                    "metadata": request.headers.get("upload-metadata"), "partial": concat == "partial"}
+        return httpx.Response(201, headers={"location": upload_url})
+
+    def _head(self, request):
+        upload = self.uploads.get(str(request.url))
+        if upload is None:
+            return httpx.Response(404)
+        return httpx.Response(200, headers={"upload-offset": str(len(upload["data"]))})
+
+    def _patch(self, request):
+        upload = self.uploads.get(str(request.url))
+        if upload is None:
+            return httpx.Response(410)
+
+        if self.stop_after_patches is not None:
+            if self.stop_after_patches == 0:
+                return httpx.Response(503)
+            self.stop_after_patches -= 1
+
+        if self.failing_patches:
+            self.failing_patches -= 1
+            return httpx.Response(500)
+
+        if int(request.headers["upload-offset"]) != len(upload["data"]):
+            return httpx.Response(409)
+
+        upload["data"] += request.content
+        self.received_bytes += len(request.content)
+        if len(upload["data"]) == upload["length"] and not upload["partial"]:
+            self._store_metadata(upload["metadata"], bytes(upload["data"]))
+        return httpx.Response(204, headers={"upload-offset": str(len(upload["data"]))})
+
+    def _store(self, request, content: bytes) -> None:
+        self._store_metadata(request.headers["upload-metadata"], content)
+
+    def _store_metadata(self, metadata: str, content: bytes) -> None:
+        fields = dict(entry.split(" ") for entry in metadata.split(","))
+        self.objects[base64.b64decode(fields["objectName"]).decode()] = content
+
+    def count(self, method: str) -> int:
+        return sum(1 for request_method, _ in self.requests if request_method == method)
+
+
+@pytest.fixture
+def tus_server(monkeypatch, sync_redis_connection):
+    server = _TusServer()
+
+    monkeypatch.setattr(resumable_upload_services, "_upload_client", httpx.Client(transport=httpx.MockTransport(server.handle)))
+    monkeypatch.setattr(resumable_upload_services, "sync_redis_client", sync_redis_connection)
+    monkeypatch.setattr(resumable_upload_services, "_tus_extensions", None)
+    monkeypatch.setattr(storage_breaker, "_redis", sync_redis_connection)
+    monkeypatch.setattr(settings, "SUPABASE_S3_STORAGE_ENDPOINT", "http://tus")
+    monkeypatch.setattr(settings, "STORAGE_UPLOAD_CHUNK_BYTES", 100)
+    monkeypatch.setattr(settings, "STORAGE_UPLOAD_PARALLELISM", 3)
+    monkeypatch.setattr(settings, "STORAGE_UPLOAD_PART_RETRIES", 2)
+    monkeypatch.setattr(settings, "STORAGE_UPLOAD_RETRY_BASE_DELAY_SECONDS", 0)
+
+    return server
+
+
+def test_parts_are_uploaded_in_parallel_and_joined(tus_server, sync_redis_connection):
+    tus_server.options_status = 204
+
+    assert upload_to_storage_resumable(CONTENT, "attachments/a", "application/pdf").endswith("/attachments/a")
+
+    assert tus_server.objects["attachments/a"] == CONTENT
+    #three partial uploads of at least a chunk each, in chunks of STORAGE_UPLOAD_CHUNK_BYTES
+    assert [upload["length"] for upload in tus_server.uploads.values()] == [334, 334, 332]
+    assert tus_server.count("PATCH") == 12
+    assert not sync_redis_connection.exists(resumable_upload_key("attachments/a"))
+
+
+def test_without_concatenation_one_upload_is_sent(tus_server):
+    tus_server.options_status = 200
+
+    upload_to_storage_resumable(CONTENT, "attachments/a", "application/pdf")
+
+    assert tus_server.objects["attachments/a"] == CONTENT
+    assert len(tus_server.uploads) == 1
+
+
+def test_failed_probe_is_not_cached(tus_server):
+    tus_server.options_status = 503
+    upload_to_storage_resumable(CONTENT, "attachments/a", "application/pdf")
+    assert len(tus_server.uploads) == 1
+
+    tus_server.options_status = 204
+    upload_to_storage_resumable(CONTENT, "attachments/b", "application/pdf")
+    assert tus_server.count("OPTIONS") == 2
+    assert tus_server.objects["attachments/b"] == CONTENT
+
+
+def test_failed_chunk_is_retried_from_the_confirmed_offset(tus_server):
+    tus_server.failing_patches = 2
+
+    upload_to_storage_resumable(CONTENT, "attachments/a", "application/pdf")
+
+    assert tus_server.objects["attachments/a"] == CONTENT
+    assert tus_server.count("PATCH") == 12
+
+
+def test_interrupted_upload_resumes_where_the_server_stopped(tus_server, sync_redis_connection):
+    tus_server.options_status = 204
+    tus_server.stop_after_patches = 5
+
+    assert upload_to_storage_resumable(CONTENT, "attachments/a", "application/pdf") == "upload_failed"
+    stored_upload = json.loads(sync_redis_connection.get(resumable_upload_key("attachments/a")))
+    #five chunks made it, which ones depends on how the part threads interleave
+    assert 0 < tus_server.received_bytes < len(CONTENT)
+
+    tus_server.stop_after_patches = None
+
+    assert upload_to_storage_resumable(CONTENT, "attachments/a", "application/pdf").endswith("/attachments/a")
+
+    assert tus_server.objects["attachments/a"] == CONTENT
+    #the parts were not created again and only the missing bytes were sent
+    assert list(tus_server.uploads) == [url for url, _, _ in stored_upload["parts"]]
+    assert tus_server.received_bytes == len(CONTENT)
+
+
+def test_expired_upload_starts_over(tus_server, sync_redis_connection):
+    tus_server.options_status = 204
+    tus_server.stop_after_patches = 2
+    upload_to_storage_resumable(CONTENT, "attachments/a", "application/pdf")
+
+    tus_server.forget_uploads()
+    tus_server.stop_after_patches = None
+
+    assert upload_to_storage_resumable(CONTENT, "attachments/a", "application/pdf") == "upload_failed"
+    assert not sync_redis_connection.exists(resumable_upload_key("attachments/a"))
+
+    assert upload_to_storage_resumable(CONTENT, "attachments/a", "application/pdf").endswith("/attachments/a")
+    assert tus_server.objects["attachments/a"] == CONTENT
@@ -0,0 +1,187 @@
+import time
+
+import pytest
+
+from app.services.retry_services import schedule_retry, lease_due_retries, requeue_expired_retry_batches, read_retry_batch, \
+    defer_retry_batch, parse_retry, owns_retry_batch, queue_retry_ack, release_retry_batch, retry_delay_seconds, \
+    drain_legacy_retry_queues, queue_dead_letter, list_dead_letters, count_dead_letters_by_error, requeue_dead_letters, \
+    purge_dead_letters, dead_email_queue_key, RETRY_SCHEDULE_KEY, RETRY_IN_FLIGHT_KEY
+from app.pydantic_schemas.dead_letter_pydantic import DeadLetterFilterSchema
+from app.utils.config import settings
+
+pytestmark = pytest.mark.anyio
+
+
+async def _schedule_due(redis_connection, user_id, *eids):
+    for eid in eids:
+        await schedule_retry(redis_connection, user_id, {"eid": eid, "retry_count": 1}, delay_seconds=-1)
+
+
+async def _batch_eids(redis_connection, batch_id):
+    return [parse_retry(retry)["email"]["eid"] for retry in await read_retry_batch(redis_connection, batch_id)]
+
+
+async def _expire_lease(redis_connection, batch_id):
+    await redis_connection.zadd(RETRY_IN_FLIGHT_KEY, {batch_id: time.time() - 1})
+
+
+def test_backoff_doubles_with_jitter_and_is_capped(monkeypatch):
+    monkeypatch.setattr(settings, "RETRY_BASE_DELAY_SECONDS", 10)
+    monkeypatch.setattr(settings, "RETRY_MAX_DELAY_SECONDS", 100)
+
+    for _ in range(50):
+        assert 5 <= retry_delay_seconds(1) <= 10
+        assert 20 <= retry_delay_seconds(3) <= 40
+        assert 50 <= retry_delay_seconds(10) <= 100
+
+
+async def test_due_retries_are_leased_in_batches_per_user(redis_connection, monkeypatch):
+    monkeypatch.setattr(settings, "RETRY_BATCH_SIZE", 2)
+    await _schedule_due(redis_connection, 1, 10, 11, 12)
+    await _schedule_due(redis_connection, 2, 20)
+    await schedule_retry(redis_connection, 1, {"eid": 13}, delay_seconds=60)
+
+    batches = await lease_due_retries(redis_connection, 100)
+
+    assert sorted(user_id for user_id, _ in batches) == ["1", "1", "2"]
+    assert sorted([await _batch_eids(redis_connection, batch_id) for _, batch_id in batches]) == [[10, 11], [12], [20]]
+    #the retry that is not due stays in the schedule, a second sweep leases nothing
+    assert await redis_connection.zcard(RETRY_SCHEDULE_KEY) == 1
+    assert await lease_due_retries(redis_connection, 100) == []
+
+
+async def test_ack_renews_the_lease(redis_connection):
+    await _schedule_due(redis_connection, 1, 10, 11)
+    [(_, batch_id)] = await lease_due_retries(redis_connection, 100)
+    await _expire_lease(redis_connection, batch_id)
+
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    queue_retry_ack(redis_pipeline, batch_id)
+    await redis_pipeline.execute()
+
+    assert await _batch_eids(redis_connection, batch_id) == [11]
+    assert await redis_connection.zscore(RETRY_IN_FLIGHT_KEY, batch_id) > time.time()
+    assert await requeue_expired_retry_batches(redis_connection) == 0
+
+
+async def test_expired_batch_puts_only_unacked_retries_back(redis_connection):
+    await _schedule_due(redis_connection, 1, 10, 11, 12)
+    [(_, batch_id)] = await lease_due_retries(redis_connection, 100)
+
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    queue_retry_ack(redis_pipeline, batch_id)
+    await redis_pipeline.execute()
+    await _expire_lease(redis_connection, batch_id)
+
+    assert await requeue_expired_retry_batches(redis_connection) == 2
+    assert not await owns_retry_batch(redis_connection, batch_id)
+    assert await read_retry_batch(redis_connection, batch_id) == []
+
+    #the worker that lost the lease can not ack any more, its renewal does not bring the lease back
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    queue_retry_ack(redis_pipeline, batch_id)
+    await redis_pipeline.execute()
+    assert not await owns_retry_batch(redis_connection, batch_id)
+
+    [(_, next_batch_id)] = await lease_due_retries(redis_connection, 100)
+    assert sorted(await _batch_eids(redis_connection, next_batch_id)) == [11, 12]
+
+
+async def test_only_the_owner_defers(redis_connection):
+    await _schedule_due(redis_connection, 1, 10, 11)
+    [(_, batch_id)] = await lease_due_retries(redis_connection, 100)
+
+    assert await defer_retry_batch(redis_connection, batch_id, 60) == 2
+    assert await redis_connection.zcard(RETRY_SCHEDULE_KEY) == 2
+    assert await redis_connection.zcount(RETRY_SCHEDULE_KEY, time.time() + 50, "+inf") == 2
+
+    #the lease ended with the defer, a second defer (or a late sweep) changes nothing
+    assert await defer_retry_batch(redis_connection, batch_id, 0) == 0
+    assert await requeue_expired_retry_batches(redis_connection) == 0
+    assert await redis_connection.zcard(RETRY_SCHEDULE_KEY) == 2
+
+
+async def test_release_ends_the_lease(redis_connection):
+    await _schedule_due(redis_connection, 1, 10)
+    [(_, batch_id)] = await lease_due_retries(redis_connection, 100)
+
+    await release_retry_batch(redis_connection, batch_id)
+
+    assert not await owns_retry_batch(redis_connection, batch_id)
+    assert await read_retry_batch(redis_connection, batch_id) == []
+
+
+async def test_legacy_retry_queues_are_drained_into_the_schedule(redis_connection):
+    await redis_connection.rpush("failed_email_queue:1", '{"eid": 1, "retry_count": 2, "attachment_ids": []}', '{"eid": 1, "retry_count": 2, "attachment_ids": []}')
+    await redis_connection.rpush("failed_email_queue:2", '{"eid": 3, "retry_count": 1}')
+
+    assert await drain_legacy_retry_queues(redis_connection) == 3
+    assert not await redis_connection.exists("failed_email_queue:1", "failed_email_queue:2")
+
+    #due now, identical emails stay two retries, and the email json is kept as it was
+    batches = await lease_due_retries(redis_connection, 10)
+    assert sorted(user_id for user_id, _ in batches) == ["1", "2"]
+    retries = [parse_retry(retry) for _, batch_id in batches for retry in await read_retry_batch(redis_connection, batch_id)]
+    assert sorted(retry["email"]["eid"] for retry in retries) == [1, 1, 3]
+    assert {"eid": 1, "retry_count": 2, "attachment_ids": []} in [retry["email"] for retry in retries]
+
+
+async def test_legacy_retry_queues_are_scanned_until_none_are_left(redis_connection):
+    await redis_connection.rpush("failed_email_queue:1", '{"eid": 1, "retry_count": 1}')
+
+    assert await drain_legacy_retry_queues(redis_connection) == 1
+    assert await drain_legacy_retry_queues(redis_connection) == 0
+
+    #no old worker writes them any more, a list showing up later is not looked for
+    await redis_connection.rpush("failed_email_queue:1", '{"eid": 2, "retry_count": 1}')
+    assert await drain_legacy_retry_queues(redis_connection) == 0
+
+
+async def _dead_letters(redis_connection, user_id, *emails):
+    redis_pipeline = redis_connection.pipeline(transaction=True)
+    for email_data in emails:
+        queue_dead_letter(redis_pipeline, user_id, email_data)
+    await redis_pipeline.execute()
+
+
+async def _dead_eids(redis_connection, user_id):
+    return [email_data["eid"] for email_data in (await list_dead_letters(redis_connection, user_id, 0, 100))[1]]
+
+
+async def test_dead_letters_are_paged_and_grouped_by_error(redis_connection):
+    await _dead_letters(redis_connection, 1, {"eid": 1, "error": "quota"}, {"eid": 2, "error": "auth"}, {"eid": 3, "error": "quota"}, {"eid": 4})
+
+    assert await list_dead_letters(redis_connection, 1, 1, 2) == (4, [{"eid": 2, "error": "auth"}, {"eid": 3, "error": "quota"}])
+    assert await list_dead_letters(redis_connection, 1, 1, 5, error="quota") == (2, [{"eid": 3, "error": "quota"}])
+    assert await count_dead_letters_by_error(redis_connection, 1) == {"quota": 2, "auth": 1, "unknown": 1}
+
+
+async def test_requeued_dead_letters_are_due_with_fresh_attempts(redis_connection):
+    await _dead_letters(redis_connection, 1, {"eid": 1, "error": "quota", "retry_count": 5, "campaign_id": "c1"},
+                        {"eid": 2, "error": "auth", "retry_count": 5, "campaign_id": "c1"},
+                        {"eid": 3, "error": "quota", "retry_count": 5, "campaign_id": "c2"})
+
+    requeued = await requeue_dead_letters(redis_connection, 1, DeadLetterFilterSchema(error="quota", campaign_id="c1"))
+
+    assert [email_data["eid"] for email_data in requeued] == [1]
+    assert await _dead_eids(redis_connection, 1) == [2, 3]
+
+    [(user_id, batch_id)] = await lease_due_retries(redis_connection, 10)
+    [retry] = await read_retry_batch(redis_connection, batch_id)
+    assert user_id == "1" and parse_retry(retry)["email"]["retry_count"] == 0
+
+
+async def test_purge_deletes_only_the_selected_dead_letters(redis_connection):
+    await _dead_letters(redis_connection, 1, {"eid": 1}, {"eid": 2}, {"eid": 3})
+    await _dead_letters(redis_connection, 2, {"eid": 1})
+
+    assert [email_data["eid"] for email_data in await purge_dead_letters(redis_connection, 1, DeadLetterFilterSchema(eids=[1, 3]))] == [1, 3]
+
+    assert await _dead_eids(redis_connection, 1) == [2]
+    assert await _dead_eids(redis_connection, 2) == [1]
+    assert await redis_connection.zcard(RETRY_SCHEDULE_KEY) == 0
+
+    #an empty filter selects every dead letter
+    await purge_dead_letters(redis_connection, 1, DeadLetterFilterSchema())
+    assert not await redis_connection.exists(dead_email_queue_key(1))
+    assert await purge_dead_letters(redis_connection, 1, DeadLetterFilterSchema()) == []
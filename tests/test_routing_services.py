@@ -0,0 +1,46 @@
+from collections import Counter
+
+from app.services.routing_services import ConsistentHashRing, route_user_task, queue_for_user, USER_TASK_QUEUES
+
+QUEUES = ["user-0", "user-1", "user-2", "user-3"]
+
+
+def test_ring_is_the_same_in_every_process():
+    #md5 instead of the per process salted hash()
+    assert [ConsistentHashRing(QUEUES).get_node(str(user_id)) for user_id in range(50)] == \
+           [ConsistentHashRing(list(reversed(QUEUES))).get_node(str(user_id)) for user_id in range(50)]
+
+
+def test_users_spread_over_all_queues():
+    ring = ConsistentHashRing(QUEUES)
+    users_per_queue = Counter(ring.get_node(str(user_id)) for user_id in range(4000))
+
+    assert set(users_per_queue) == set(QUEUES)
+    assert min(users_per_queue.values()) > 700
+
+
+def test_adding_a_queue_moves_only_its_share_of_users():
+    ring, grown_ring = ConsistentHashRing(QUEUES), ConsistentHashRing(QUEUES + ["user-4"])
+
+    moved_users = [user_id for user_id in range(4000) if ring.get_node(str(user_id)) != grown_ring.get_node(str(user_id))]
+
+    #every moved user moved to the new queue, roughly a fifth of them
+    assert all(grown_ring.get_node(str(user_id)) == "user-4" for user_id in moved_users)
+    assert 500 < len(moved_users) < 1200
+
+
+def test_empty_ring_has_no_node():
+    assert ConsistentHashRing([]).get_node("1") is None
+
+
+def test_per_user_tasks_go_to_the_queue_of_their_user():
+    assert USER_TASK_QUEUES == QUEUES
+
+    assert route_user_task("send_emails_from_user_queue", ("7",), {}, {}) == {"queue": queue_for_user("7")}
+    assert route_user_task("send_emails_from_user_queue", (), {"user_id": 7}, {}) == {"queue": queue_for_user("7")}
+    #without a user the task can not be placed, the default queue takes it
+    assert route_user_task("send_emails_from_user_queue", (), {}, {}) is None
+
+
+def test_other_tasks_use_the_default_queue():
+    assert route_user_task("release_due_retries", (), {}, {}) is None
@@ -0,0 +1,176 @@
+import time
+
+import pytest
+from redis.exceptions import WatchError
+
+from app.services.scheduling_services import enqueue_fair_chunks, pick_fair_chunk, defer_fair_chunk, release_deferred_chunks, \
+    owns_chunk_lease, release_chunk_lease, requeue_expired_chunks, chunk_lease_member, chunk_lease_key, queue_chunk_lease_renewal, \
+    FAIR_ACTIVE_USERS_KEY, FAIR_DEFICITS_KEY, \
+    FAIR_DEFERRED_CHUNKS_KEY, FAIR_IN_PROGRESS_KEY, USER_PLAN_KEY, SCHEDULER_METRICS_GROUP
+from app.services.campaign_services import campaign_chunk_key
+from app.services.metrics_services import metrics_key
+from app.utils.config import settings
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def quantum(monkeypatch):
+    #one chunk of size 10 per quantum of a default user
+    monkeypatch.setattr(settings, "FAIR_QUANTUM", 10)
+
+
+async def _pick_order(redis_connection, picks):
+    picked_chunks = [await pick_fair_chunk(redis_connection) for _ in range(picks)]
+    return [(chunk["user_id"], chunk["chunk_index"]) if chunk else None for chunk in picked_chunks]
+
+
+async def test_users_take_turns(redis_connection):
+    await enqueue_fair_chunks(redis_connection, "a", "big", 1, [10, 10, 10])
+    await enqueue_fair_chunks(redis_connection, "b", "small", 1, [10])
+
+    #user b is not starved by the three chunks of user a
+    assert await _pick_order(redis_connection, 5) == [("a", 0), ("b", 0), ("a", 1), ("a", 2), None]
+
+    #users without chunks leave the ring and lose their deficit
+    assert await redis_connection.llen(FAIR_ACTIVE_USERS_KEY) == 0
+    assert await redis_connection.hlen(FAIR_DEFICITS_KEY) == 0
+
+
+async def test_plan_weight_scales_the_quantum(redis_connection):
+    await redis_connection.hset(USER_PLAN_KEY, "a", "pro")
+    await enqueue_fair_chunks(redis_connection, "a", "big", 1, [10, 10, 10])
+    await enqueue_fair_chunks(redis_connection, "b", "other", 1, [10, 10])
+
+    assert await _pick_order(redis_connection, 5) == [("a", 0), ("a", 1), ("b", 0), ("a", 2), ("b", 1)]
+
+
+async def test_a_chunk_larger_than_the_quantum_is_picked_eventually(redis_connection):
+    await enqueue_fair_chunks(redis_connection, "a", "huge", 1, [35])
+
+    assert await _pick_order(redis_connection, 1) == [("a", 0)]
+
+
+async def test_pick_leases_the_chunk(redis_connection):
+    await enqueue_fair_chunks(redis_connection, "a", "c1", 1, [10])
+    chunk = await pick_fair_chunk(redis_connection)
+
+    assert await owns_chunk_lease(redis_connection, "c1", 1, 0, chunk["lease_token"])
+    assert await redis_connection.zscore(FAIR_IN_PROGRESS_KEY, chunk_lease_member("a", "c1", 1, 0, chunk["lease_token"])) is not None
+
+    #only the token of the pick ends the lease
+    assert await release_chunk_lease(redis_connection, "a", "c1", 1, 0, "other") is False
+    assert await release_chunk_lease(redis_connection, "a", "c1", 1, 0, chunk["lease_token"]) is True
+    assert not await owns_chunk_lease(redis_connection, "c1", 1, 0, chunk["lease_token"])
+    assert await redis_connection.zcard(FAIR_IN_PROGRESS_KEY) == 0
+
+
+async def test_deferred_chunk_comes_back_when_due(redis_connection):
+    await enqueue_fair_chunks(redis_connection, "a", "c1", 1, [10])
+    chunk = await pick_fair_chunk(redis_connection)
+
+    assert await defer_fair_chunk(redis_connection, "a", "c1", 1, 0, "lost", 10, 0) is False
+    assert await defer_fair_chunk(redis_connection, "a", "c1", 1, 0, chunk["lease_token"], 10, 60 * 1000) is True
+    assert await redis_connection.zcard(FAIR_IN_PROGRESS_KEY) == 0
+
+    #not due yet
+    assert await release_deferred_chunks(redis_connection) == 0
+
+    deferred_chunk = (await redis_connection.zrange(FAIR_DEFERRED_CHUNKS_KEY, 0, -1))[0]
+    await redis_connection.zadd(FAIR_DEFERRED_CHUNKS_KEY, {deferred_chunk: time.time() - 1})
+
+    assert await release_deferred_chunks(redis_connection) == 1
+    assert await _pick_order(redis_connection, 1) == [("a", 0)]
+
+
+async def test_expired_lease_is_requeued_with_the_remaining_emails(redis_connection):
+    await redis_connection.rpush(campaign_chunk_key("c1", 1, 0), "email-3", "email-4")
+    await enqueue_fair_chunks(redis_connection, "a", "c1", 1, [4])
+    chunk = await pick_fair_chunk(redis_connection)
+
+    assert await requeue_expired_chunks(redis_connection) == 0
+
+    lease_member = chunk_lease_member("a", "c1", 1, 0, chunk["lease_token"])
+    await redis_connection.zadd(FAIR_IN_PROGRESS_KEY, {lease_member: time.time() - 1})
+
+    assert await requeue_expired_chunks(redis_connection) == 1
+    #the worker that held the lease lost it
+    assert not await owns_chunk_lease(redis_connection, "c1", 1, 0, chunk["lease_token"])
+
+    requeued_chunk = await pick_fair_chunk(redis_connection)
+    assert (requeued_chunk["chunk_index"], requeued_chunk["size"]) == (0, 2)
+    assert requeued_chunk["lease_token"] != chunk["lease_token"]
+    assert await redis_connection.hget(metrics_key(SCHEDULER_METRICS_GROUP), "user:a:chunks") == "2"
+
+
+async def _checkpoint(redis_connection, chunk, before_execute=None) -> bool:
+    #the checkpoint of the chunk worker: take the email off the chunk list and renew the lease, only while it is ours
+    async with redis_connection.pipeline(transaction=True) as redis_pipeline:
+        await redis_pipeline.watch(chunk_lease_key(chunk["campaign_id"], chunk["run"], chunk["chunk_index"]))
+        owned = await owns_chunk_lease(redis_connection, chunk["campaign_id"], chunk["run"], chunk["chunk_index"], chunk["lease_token"])
+
+        redis_pipeline.multi()
+        if owned:
+            redis_pipeline.lpop(campaign_chunk_key(chunk["campaign_id"], chunk["run"], chunk["chunk_index"]))
+            queue_chunk_lease_renewal(redis_pipeline, chunk["user_id"], chunk["campaign_id"], chunk["run"], chunk["chunk_index"], chunk["lease_token"])
+
+        if before_execute is not None:
+            await before_execute()
+
+        await redis_pipeline.execute()
+
+    return owned
+
+
+async def _expire(redis_connection, chunk):
+    lease_member = chunk_lease_member(chunk["user_id"], chunk["campaign_id"], chunk["run"], chunk["chunk_index"], chunk["lease_token"])
+    await redis_connection.zadd(FAIR_IN_PROGRESS_KEY, {lease_member: time.time() - 1})
+
+
+async def test_checkpoint_takes_the_email_and_renews_the_lease(redis_connection, monkeypatch):
+    await redis_connection.rpush(campaign_chunk_key("c1", 1, 0), "email-1", "email-2")
+    await enqueue_fair_chunks(redis_connection, "a", "c1", 1, [2])
+    chunk = await pick_fair_chunk(redis_connection)
+    monkeypatch.setattr(settings, "CHUNK_LEASE_SECONDS", 10_000)
+
+    assert await _checkpoint(redis_connection, chunk)
+
+    assert await redis_connection.lrange(campaign_chunk_key("c1", 1, 0), 0, -1) == ["email-2"]
+    lease_member = chunk_lease_member("a", "c1", 1, 0, chunk["lease_token"])
+    assert await redis_connection.zscore(FAIR_IN_PROGRESS_KEY, lease_member) > time.time() + 9_000
+
+
+async def test_resumed_chunk_continues_after_the_last_checkpoint(redis_connection):
+    await redis_connection.rpush(campaign_chunk_key("c1", 1, 0), "email-1", "email-2", "email-3")
+    await enqueue_fair_chunks(redis_connection, "a", "c1", 1, [3])
+    first_chunk = await pick_fair_chunk(redis_connection)
+    await _checkpoint(redis_connection, first_chunk)
+
+    #the first worker hangs, the sweep hands the chunk to the next one
+    await _expire(redis_connection, first_chunk)
+    assert await requeue_expired_chunks(redis_connection) == 1
+    resumed_chunk = await pick_fair_chunk(redis_connection)
+    assert resumed_chunk["size"] == 2
+
+    #the first worker wakes up, its checkpoints and its release do not apply any more
+    assert not await _checkpoint(redis_connection, first_chunk)
+    assert not await release_chunk_lease(redis_connection, "a", "c1", 1, 0, first_chunk["lease_token"])
+
+    assert await _checkpoint(redis_connection, resumed_chunk)
+    assert await redis_connection.lrange(campaign_chunk_key("c1", 1, 0), 0, -1) == ["email-3"]
+    assert await release_chunk_lease(redis_connection, "a", "c1", 1, 0, resumed_chunk["lease_token"])
+
+
+async def test_sweep_during_a_checkpoint_aborts_it(redis_connection):
+    await redis_connection.rpush(campaign_chunk_key("c1", 1, 0), "email-1", "email-2")
+    await enqueue_fair_chunks(redis_connection, "a", "c1", 1, [2])
+    chunk = await pick_fair_chunk(redis_connection)
+
+    async def sweep():
+        await _expire(redis_connection, chunk)
+        await requeue_expired_chunks(redis_connection)
+
+    with pytest.raises(WatchError):
+        await _checkpoint(redis_connection, chunk, before_execute=sweep)
+
+    assert await redis_connection.llen(campaign_chunk_key("c1", 1, 0)) == 2
@@ -0,0 +1,167 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import send_pipeline_services
+from app.services.circuit_breaker_services import CircuitOpenError
+from app.services.concurrency_services import GmailThrottledError, CONCURRENCY_METRICS_GROUP
+from app.services.idempotency_services import claim_email_send, record_email_sent, send_claim_key
+from app.services.metrics_services import metrics_key
+from app.services.send_pipeline_services import SendPipeline
+from app.services.transport_services import EmailTransport
+from app.utils.config import settings
+
+pytestmark = pytest.mark.anyio
+
+
+class _ScriptedTransport(EmailTransport):
+    """
+    Answers the sends with the given outcomes in order: a dict is the gmail response, an exception is raised.
+    """
+    name = "scripted"
+    requires_google_token = False
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.sent = []
+
+    def send(self, message, google_access_token, from_email):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+
+        self.sent.append(message["To"])
+        return outcome
+
+
+@pytest.fixture
+def user():
+    user_token = SimpleNamespace(uid=1, token_id=7, sender_email="sender@x.com", transport="scripted")
+    return SimpleNamespace(uid=1, email="user@x.com", resume=None, user_tokens=[user_token])
+
+
+@pytest.fixture
+def use_transport(monkeypatch):
+    def use(transport: _ScriptedTransport) -> _ScriptedTransport:
+        monkeypatch.setattr(send_pipeline_services, "get_email_transport", lambda name=None: transport)
+        return transport
+
+    return use
+
+
+def _email(eid: int) -> dict:
+    return {"eid": eid, "subject": "s", "body": "b", "to_email": f"to{eid}@x.com"}
+
+
+async def _run(redis_connection, user, emails, claim_owner="chunk:a", should_stop=None):
+    results = []
+
+    async def persist(result):
+        #the callers record the claim outcome in the transaction that records the rest of the result
+        redis_pipeline = redis_connection.pipeline(transaction=True)
+        result.queue_claim_outcome(redis_pipeline)
+        await redis_pipeline.execute()
+        results.append(result)
+
+    await SendPipeline(redis_connection, None, user, claim_owner).run(emails, persist, should_stop=should_stop)
+    return results
+
+
+async def test_sent_email_is_recorded_under_its_claim(redis_connection, user, use_transport):
+    transport = use_transport(_ScriptedTransport({"id": "gmail-1"}, {"id": "gmail-2"}))
+
+    results = await _run(redis_connection, user, [_email(1), _email(2)])
+
+    assert [(result.outcome, result.google_message_id) for result in results] == [("sent", "gmail-1"), ("sent", "gmail-2")]
+    assert transport.sent == ["to1@x.com", "to2@x.com"]
+    assert await redis_connection.get(send_claim_key(1)) == "sent:gmail-1"
+
+
+async def test_already_sent_email_is_not_sent_again(redis_connection, user, use_transport):
+    transport = use_transport(_ScriptedTransport())
+    await record_email_sent(redis_connection, 1, "gmail-1")
+
+    [result] = await _run(redis_connection, user, [_email(1)], claim_owner="retry_batch:b")
+
+    assert (result.outcome, result.google_message_id, result.duplicate) == ("sent", "gmail-1", True)
+    assert transport.sent == []
+
+
+async def test_email_in_flight_elsewhere_is_not_sent(redis_connection, user, use_transport):
+    transport = use_transport(_ScriptedTransport({"id": "gmail-2"}))
+    await claim_email_send(redis_connection, 1, "chunk:other")
+
+    results = await _run(redis_connection, user, [_email(1), _email(2)])
+
+    assert [result.outcome for result in results] == ["in_flight", "sent"]
+    assert results[0].retry_in_ms > 0
+    assert transport.sent == ["to2@x.com"]
+    #the claim of the other attempt is left alone
+    assert await redis_connection.get(send_claim_key(1)) == "pending:chunk:other"
+
+
+async def test_failed_send_releases_the_claim_for_the_retry(redis_connection, user, use_transport):
+    use_transport(_ScriptedTransport(None, RuntimeError("connection reset")))
+
+    results = await _run(redis_connection, user, [_email(1), _email(2)])
+
+    assert [result.outcome for result in results] == ["failed", "failed"]
+    assert results[1].error == "connection reset"
+    assert await claim_email_send(redis_connection, 1, "retry_batch:b") == ("claimed", None)
+    assert await claim_email_send(redis_connection, 2, "retry_batch:b") == ("claimed", None)
+
+
+async def test_throttled_send_is_retried(redis_connection, user, use_transport):
+    transport = use_transport(_ScriptedTransport(GmailThrottledError(429), {"id": "gmail-1"}))
+
+    [result] = await _run(redis_connection, user, [_email(1)])
+
+    assert (result.outcome, result.google_message_id) == ("sent", "gmail-1")
+    assert transport.sent == ["to1@x.com"]
+    #the throttle went into the account's concurrency limit
+    assert await redis_connection.hget(metrics_key(CONCURRENCY_METRICS_GROUP), "throttled:account:1:7") == "1"
+
+
+async def test_out_of_quota_defers_the_rest_of_the_batch(redis_connection, user, use_transport, monkeypatch):
+    transport = use_transport(_ScriptedTransport({"id": "gmail-1"}))
+    monkeypatch.setattr(settings, "GMAIL_DAILY_SEND_LIMIT", 1)
+
+    results = await _run(redis_connection, user, [_email(1), _email(2), _email(3)])
+
+    assert [result.outcome for result in results] == ["sent", "deferred"]
+    assert (results[1].reason, results[1].retry_in_ms > settings.QUOTA_MAX_INLINE_WAIT_MS) == ("gmail_quota", True)
+    assert transport.sent == ["to1@x.com"]
+    #the deferred email was not attempted, the next attempt may claim it
+    assert not await redis_connection.exists(send_claim_key(2))
+
+
+async def test_open_breaker_defers_and_releases_the_claim(redis_connection, user, use_transport):
+    use_transport(_ScriptedTransport(CircuitOpenError("gmail_send", 5000)))
+
+    results = await _run(redis_connection, user, [_email(1), _email(2)])
+
+    assert [(result.outcome, result.reason, result.retry_in_ms) for result in results] == [("deferred", "gmail_send", 5000)]
+    assert not await redis_connection.exists(send_claim_key(1))
+
+
+async def test_stop_ends_the_run_before_the_next_email(redis_connection, user, use_transport):
+    transport = use_transport(_ScriptedTransport({"id": "gmail-1"}))
+    stops = iter([False, True])
+
+    async def should_stop():
+        return next(stops)
+
+    results = await _run(redis_connection, user, [_email(1), _email(2), _email(3)], should_stop=should_stop)
+
+    assert [result.outcome for result in results] == ["sent", "stopped"]
+    assert transport.sent == ["to1@x.com"]
+
+
+async def test_user_without_gmail_access_is_dead(redis_connection, user, use_transport):
+    use_transport(_ScriptedTransport())
+    user.user_tokens = []
+
+    [result] = await _run(redis_connection, user, [_email(1)])
+
+    assert (result.outcome, result.error) == ("dead", "gmail_not_authorized")
+    assert not await redis_connection.exists(send_claim_key(1))
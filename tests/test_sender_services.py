@@ -0,0 +1,66 @@
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+
+from app.services.quota_services import daily_sends_key
+from app.services.sender_services import pick_sender_account, sender_account_id, sticky_senders_key
+from app.services.token_services import google_token_revoked_key
+from app.utils.config import settings
+
+pytestmark = pytest.mark.anyio
+
+USER_TOKENS = [SimpleNamespace(uid=1, token_id=token_id) for token_id in (1, 2, 3)]
+
+
+async def _use_quota(redis_connection, user_token, sends: int) -> None:
+    now_ms = time.time() * 1000
+    await redis_connection.zadd(daily_sends_key(sender_account_id(user_token)), {f"send-{i}": now_ms for i in range(sends)})
+
+
+async def test_recipient_keeps_its_sender(redis_connection):
+    sender = await pick_sender_account(redis_connection, 1, USER_TOKENS, "bob@example.com")
+
+    assert await redis_connection.hget(sticky_senders_key(1), "bob@example.com") == str(sender.token_id)
+    assert 0 < await redis_connection.ttl(sticky_senders_key(1)) <= settings.SENDER_STICKY_TTL_SECONDS
+    for _ in range(10):
+        assert await pick_sender_account(redis_connection, 1, USER_TOKENS, "bob@example.com") is sender
+
+
+async def test_sticky_sender_out_of_quota_is_replaced(redis_connection, monkeypatch):
+    monkeypatch.setattr(settings, "GMAIL_DAILY_SEND_LIMIT", 2)
+    await redis_connection.hset(sticky_senders_key(1), "bob@example.com", 1)
+    await _use_quota(redis_connection, USER_TOKENS[0], 2)
+
+    sender = await pick_sender_account(redis_connection, 1, USER_TOKENS, "bob@example.com")
+
+    assert sender.token_id != 1
+    assert await redis_connection.hget(sticky_senders_key(1), "bob@example.com") == str(sender.token_id)
+
+
+async def test_recipients_are_spread_by_remaining_quota(redis_connection, monkeypatch):
+    monkeypatch.setattr(settings, "GMAIL_DAILY_SEND_LIMIT", 100)
+    await _use_quota(redis_connection, USER_TOKENS[1], 80)
+    await _use_quota(redis_connection, USER_TOKENS[2], 100)
+
+    senders = Counter([(await pick_sender_account(redis_connection, 1, USER_TOKENS, f"r{i}@example.com")).token_id for i in range(600)])
+
+    #remaining quota 100 : 20 : 0
+    assert 3 not in senders
+    assert 420 < senders[1] < 580
+    assert 20 < senders[2] < 180
+
+
+async def test_revoked_and_excluded_accounts_are_the_last_resort(redis_connection):
+    await redis_connection.set(google_token_revoked_key(1), 1)
+
+    for i in range(20):
+        assert (await pick_sender_account(redis_connection, 1, USER_TOKENS, f"r{i}@example.com", exclude_token_ids={2})).token_id == 3
+
+    #a recipient that was written from the now excluded account moves on
+    await redis_connection.hset(sticky_senders_key(1), "bob@example.com", 2)
+    assert (await pick_sender_account(redis_connection, 1, USER_TOKENS, "bob@example.com", exclude_token_ids={2})).token_id == 3
+
+    #with nothing else left any account is used, the send path deals with it
+    assert await pick_sender_account(redis_connection, 1, USER_TOKENS, "eve@example.com", exclude_token_ids={2, 3}) in USER_TOKENS
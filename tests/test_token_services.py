@@ -0,0 +1,112 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from google.auth.exceptions import RefreshError
+
+from app.services import token_services
+from app.services.token_services import get_google_access_token, get_google_access_token_async, google_token_key, \
+    google_token_revoked_key, google_oauth_breaker, create_gmail_connect_request, pop_gmail_connect_request
+
+pytestmark = pytest.mark.anyio
+
+
+class _Google:
+    """
+    Stands in for google.oauth2.credentials.Credentials, every refresh hands out a new token valid for an hour.
+    """
+    def __init__(self):
+        self.refreshes = 0
+        self.refresh_seconds = 0
+        self.refused = False
+        self._lock = threading.Lock()
+
+    def credentials(self, **kwargs):
+        google = self
+
+        class _Credentials:
+            token = kwargs["token"]
+            expiry = None
+
+            def refresh(self, request):
+                time.sleep(google.refresh_seconds)
+                if google.refused:
+                    raise RefreshError("invalid_grant")
+                with google._lock:
+                    google.refreshes += 1
+                    self.token = f"access-{google.refreshes}"
+                self.expiry = datetime.utcnow() + timedelta(hours=1)
+
+        return _Credentials()
+
+
+@pytest.fixture
+def google(monkeypatch, sync_redis_connection):
+    google = _Google()
+    monkeypatch.setattr(token_services, "Credentials", google.credentials)
+    monkeypatch.setattr(token_services, "sync_redis_client", sync_redis_connection)
+    monkeypatch.setattr(google_oauth_breaker, "_redis", sync_redis_connection)
+    return google
+
+
+def _user_token(expires_in_seconds: int):
+    return SimpleNamespace(uid=1, token_id=7, access_token="access-db", refresh_token="refresh",
+                           expires_at=datetime.utcnow() + timedelta(seconds=expires_in_seconds))
+
+
+_db_connection = SimpleNamespace(commit=lambda: None)
+
+
+def test_expiring_token_is_refreshed_and_cached(google, sync_redis_connection):
+    user_token = _user_token(expires_in_seconds=10)
+
+    assert get_google_access_token(user_token, _db_connection) == "access-1"
+    assert get_google_access_token(user_token, _db_connection) == "access-1"
+
+    assert google.refreshes == 1
+    assert user_token.access_token == "access-1"
+    assert sync_redis_connection.ttl(google_token_key(7)) > 3000
+
+
+def test_valid_db_token_is_cached_without_a_refresh(google, sync_redis_connection):
+    assert get_google_access_token(_user_token(expires_in_seconds=3600), _db_connection) == "access-db"
+
+    assert google.refreshes == 0
+    assert sync_redis_connection.hget(google_token_key(7), "access_token") == "access-db"
+
+
+def test_concurrent_callers_refresh_once(google):
+    google.refresh_seconds = 0.2
+
+    with ThreadPoolExecutor(max_workers=5) as callers:
+        access_tokens = list(callers.map(lambda _: get_google_access_token(_user_token(expires_in_seconds=10), _db_connection), range(5)))
+
+    assert google.refreshes == 1
+    assert access_tokens == ["access-1"] * 5
+
+
+def test_refused_refresh_marks_the_account_revoked(google, sync_redis_connection):
+    google.refused = True
+
+    with pytest.raises(RefreshError):
+        get_google_access_token(_user_token(expires_in_seconds=10), _db_connection)
+
+    assert sync_redis_connection.exists(google_token_revoked_key(7))
+
+
+async def test_async_callers_read_the_cache_on_the_loop(google, redis_connection):
+    user_token = _user_token(expires_in_seconds=10)
+
+    assert await get_google_access_token_async(user_token, _db_connection, redis_connection) == "access-1"
+    assert await get_google_access_token_async(user_token, _db_connection, redis_connection) == "access-1"
+    assert google.refreshes == 1
+
+
+def test_gmail_connect_request_is_used_once(google):
+    connect_id = create_gmail_connect_request(1)
+
+    assert pop_gmail_connect_request(connect_id) == "1"
+    assert pop_gmail_connect_request(connect_id) is None
@@ -0,0 +1,215 @@
+import email
+import email.policy
+import io
+import json
+import smtplib
+from types import SimpleNamespace
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
+
+from app.pydantic_schemas.email_pydantic import EmailSchema
+from app.services import transport_services
+from app.services.concurrency_services import GmailThrottledError
+from app.services.transport_services import build_mime_message, write_mime_message, gmail_breaker, gmail_smtp_breaker, \
+    GmailApiTransport, SmtpTransport, SinkTransport, ATTACHMENT_STREAM_BLOCK_BYTES, _throttled_send_error, get_email_transport
+from app.utils.config import settings
+
+EMAIL = EmailSchema(subject="Application", body="<p>Hello</p>", to_email="hr@x.com", bcc_email="me@x.com")
+
+
+@pytest.fixture
+def resume(tmp_path):
+    #more than one stream block, with a partial block at the end
+    resume_path = tmp_path / "resume.pdf"
+    resume_path.write_bytes(bytes(range(256)) * (ATTACHMENT_STREAM_BLOCK_BYTES // 256 + 100))
+    return str(resume_path)
+
+
+@pytest.fixture(autouse=True)
+def breakers(monkeypatch, sync_redis_connection):
+    monkeypatch.setattr(gmail_breaker, "_redis", sync_redis_connection)
+    monkeypatch.setattr(gmail_smtp_breaker, "_redis", sync_redis_connection)
+
+
+def _parse(raw_message: bytes) -> email.message.EmailMessage:
+    return email.message_from_bytes(raw_message, policy=email.policy.default)
+
+
+def _written(message) -> bytes:
+    raw_message = io.BytesIO()
+    write_mime_message(message, raw_message)
+    return raw_message.getvalue()
+
+
+def test_attachments_are_streamed_from_their_files(resume):
+    message = build_mime_message(EMAIL, "me@x.com", [(resume, "CV.pdf", "application/pdf")])
+
+    #built, the message only holds a placeholder for the file
+    assert len(message.as_bytes()) < 2048
+
+    parsed_message = _parse(_written(message))
+    attachment = next(parsed_message.iter_attachments())
+
+    with open(resume, "rb") as resume_file:
+        assert attachment.get_content() == resume_file.read()
+    assert attachment.get_filename() == "CV.pdf"
+    assert "Hello" in parsed_message.get_body().get_content()
+
+
+def test_written_message_has_whole_base64_lines(resume):
+    raw_message = _written(build_mime_message(EMAIL, "me@x.com", [(resume, "CV.pdf", "application/pdf")]))
+
+    assert b"attachment-content" not in raw_message
+    #block boundaries do not show in the encoding
+    base64_lines = next(_parse(raw_message).iter_attachments()).get_payload().splitlines()
+    assert {len(line) for line in base64_lines[:-1]} == {76}
+
+
+def test_large_message_is_sent_as_media_upload(resume, monkeypatch):
+    sent = {}
+
+    def send(userId, **kwargs):
+        def execute():
+            #the upload reads the spooled message while the request runs
+            media_body = kwargs["media_body"]
+            sent.update(kwargs, raw_message=media_body.getbytes(0, media_body.size()))
+            return {"id": "gmail-1"}
+
+        return SimpleNamespace(execute=execute)
+
+    service = SimpleNamespace(users=lambda: SimpleNamespace(messages=lambda: SimpleNamespace(send=send)))
+    monkeypatch.setattr(transport_services, "build", lambda *args, **kwargs: service)
+    monkeypatch.setattr(settings, "GMAIL_MEDIA_UPLOAD_THRESHOLD_BYTES", 64 * 1024)
+
+    assert GmailApiTransport().send(build_mime_message(EMAIL, "me@x.com", [(resume, "CV.pdf", "application/pdf")]), "token", "me@x.com") == {"id": "gmail-1"}
+
+    assert isinstance(sent["media_body"], MediaIoBaseUpload) and "body" not in sent
+    with open(resume, "rb") as resume_file:
+        assert next(_parse(sent["raw_message"]).iter_attachments()).get_content() == resume_file.read()
+
+
+class _SmtpConnection:
+    def __init__(self, error: Exception | None = None):
+        self.sent = []
+        self.error = error
+        self.closed = False
+
+    def sendmail(self, from_address, recipients, raw_message):
+        if self.error is not None:
+            raise self.error
+        self.sent.append((from_address, recipients, raw_message))
+
+    def close(self):
+        self.closed = True
+
+    def quit(self):
+        self.closed = True
+
+
+class _SmtpServer:
+    """
+    Hands out a new _SmtpConnection per connect, the first ones fail with the given errors.
+    """
+    def __init__(self, *errors: Exception):
+        self.errors = list(errors)
+        self.connections = []
+
+    def connect(self, google_access_token, from_email):
+        self.connections.append(_SmtpConnection(self.errors.pop(0) if self.errors else None))
+        return self.connections[-1]
+
+
+def test_smtp_sends_to_bcc_without_the_header(monkeypatch):
+    connection = _SmtpConnection()
+    transport = SmtpTransport()
+    monkeypatch.setattr(transport, "_connect", lambda google_access_token, from_email: connection)
+
+    response = transport.send(build_mime_message(EMAIL, "me@x.com"), "token", "me@x.com")
+
+    from_address, recipients, raw_message = connection.sent[0]
+    assert from_address == "me@x.com" and recipients == ["hr@x.com", "me@x.com"]
+    assert _parse(raw_message)["Bcc"] is None
+    assert response == {"id": _parse(raw_message)["Message-ID"]}
+
+
+def test_sink_captures_the_whole_message(resume, monkeypatch):
+    monkeypatch.setattr(settings, "EMAIL_SINK_DIR", None)
+    transport = SinkTransport()
+
+    transport.send(build_mime_message(EMAIL, "me@x.com", [(resume, "CV.pdf", "application/pdf")]), None, "me@x.com")
+
+    with open(resume, "rb") as resume_file:
+        assert next(_parse(transport.messages[0]).iter_attachments()).get_content() == resume_file.read()
+
+
+def _http_error(status: int, reasons: list[str] | None = None, retry_after: str | None = None) -> HttpError:
+    headers = {"status": status, **({"retry-after": retry_after} if retry_after else {})}
+    content = {"error": {"code": status, "message": "refused", "errors": [{"reason": reason} for reason in reasons or []]}}
+    return HttpError(httplib2.Response(headers), json.dumps(content).encode())
+
+
+def test_rate_limits_and_server_errors_are_throttling():
+    throttled_error = _throttled_send_error(_http_error(429, retry_after="3"))
+    assert isinstance(throttled_error, GmailThrottledError)
+    assert throttled_error.retry_after_ms == 3000 and not throttled_error.provider_wide
+
+    assert _throttled_send_error(_http_error(403, ["userRateLimitExceeded"])).status_code == 403
+    assert _throttled_send_error(_http_error(503)).provider_wide
+    assert _throttled_send_error(_http_error(429, retry_after="Wed, 21 Oct 2026 07:28:00 GMT")).retry_after_ms is None
+
+
+def test_errors_of_the_email_itself_are_not_throttling():
+    assert _throttled_send_error(_http_error(400, ["invalidArgument"])) is None
+    assert _throttled_send_error(_http_error(403, ["insufficientPermissions"])) is None
+
+
+def test_smtp_connection_is_reused_by_the_next_send(monkeypatch):
+    smtp_server = _SmtpServer()
+    transport = SmtpTransport()
+    monkeypatch.setattr(transport, "_connect", smtp_server.connect)
+
+    for _ in range(3):
+        transport.send(build_mime_message(EMAIL, "me@x.com"), "token", "me@x.com")
+    transport.send(build_mime_message(EMAIL, "other@x.com"), "token", "other@x.com")
+
+    assert [len(connection.sent) for connection in smtp_server.connections] == [3, 1]
+
+
+def test_smtp_idle_connection_closed_by_gmail_is_replaced(monkeypatch):
+    smtp_server = _SmtpServer(smtplib.SMTPServerDisconnected("closed"))
+    transport = SmtpTransport()
+    monkeypatch.setattr(transport, "_connect", smtp_server.connect)
+
+    assert transport.send(build_mime_message(EMAIL, "me@x.com"), "token", "me@x.com") is not None
+
+    assert len(smtp_server.connections[1].sent) == 1
+    transport.send(build_mime_message(EMAIL, "me@x.com"), "token", "me@x.com")
+    assert len(smtp_server.connections) == 2
+
+
+def test_smtp_throttle_replies_raise_and_refusals_return_none(monkeypatch):
+    smtp_server = _SmtpServer(smtplib.SMTPDataError(421, b"try again later"), smtplib.SMTPDataError(550, b"rejected"))
+    transport = SmtpTransport()
+    monkeypatch.setattr(transport, "_connect", smtp_server.connect)
+
+    with pytest.raises(GmailThrottledError) as throttled_error:
+        transport.send(build_mime_message(EMAIL, "me@x.com"), "token", "me@x.com")
+    assert throttled_error.value.status_code == 421
+
+    assert transport.send(build_mime_message(EMAIL, "me@x.com"), "token", "me@x.com") is None
+    #a connection that failed a send is not put back
+    assert all(connection.closed for connection in smtp_server.connections)
+    transport.send(build_mime_message(EMAIL, "me@x.com"), "token", "me@x.com")
+    assert len(smtp_server.connections) == 3
+
+
+def test_transport_is_picked_by_name(monkeypatch):
+    monkeypatch.setattr(settings, "EMAIL_TRANSPORT", "sink")
+
+    assert isinstance(get_email_transport(), SinkTransport)
+    assert isinstance(get_email_transport("smtp"), SmtpTransport)
+    with pytest.raises(ValueError):
+        get_email_transport("carrier_pigeon")
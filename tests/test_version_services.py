@@ -0,0 +1,86 @@
+import pytest
+from fastapi import Request
+
+from app.services.version_services import build_etag, etag_matches, not_modified_response, get_version, record_changes, \
+    read_changes_since, bump_version, queue_version_key, changes_key
+from app.utils.config import settings
+
+pytestmark = pytest.mark.anyio
+
+
+def _request(if_none_match: str | None = None) -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match is not None else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+def test_etag_matches_if_none_match():
+    etag = build_etag(queue_version_key(1), 5)
+
+    assert etag == '"email_queue:1:version:5"'
+    assert etag_matches(_request(etag), etag)
+    assert etag_matches(_request(f'"other", {etag}'), etag)
+    assert etag_matches(_request("*"), etag)
+    assert not etag_matches(_request(build_etag(queue_version_key(1), 4)), etag)
+    assert not etag_matches(_request(), etag)
+
+
+def test_not_modified_response_revalidates():
+    response = not_modified_response('"email_queue:1:version:5"')
+
+    assert response.status_code == 304
+    assert response.headers["etag"] == '"email_queue:1:version:5"'
+    assert response.headers["cache-control"] == "private, no-cache"
+
+
+async def test_version_is_seeded_once_and_changes_with_the_data(redis_connection):
+    version = await get_version(redis_connection, queue_version_key(1))
+
+    #a lost counter is seeded from the clock, so it never hands out a version a client already holds
+    assert version > 1_000_000_000_000
+    assert await get_version(redis_connection, queue_version_key(1)) == version
+
+    assert await record_changes(redis_connection, queue_version_key(1), [{"op": "add", "id": "e1", "data": "{}"}]) == version + 1
+    assert await get_version(redis_connection, queue_version_key(1)) == version + 1
+
+
+async def test_changes_since_a_version_are_replayed_in_order(redis_connection):
+    version = await get_version(redis_connection, queue_version_key(1))
+    await record_changes(redis_connection, queue_version_key(1), [{"op": "add", "id": "e1", "data": '{"subject": "a"}'},
+                                                                  {"op": "update", "id": "e1", "data": '{"subject": "b"}'}])
+    await record_changes(redis_connection, queue_version_key(1), [{"op": "delete", "id": "e1"}])
+
+    assert await read_changes_since(redis_connection, queue_version_key(1), version + 1) == (version + 3, [
+        {"version": version + 2, "op": "update", "id": "e1", "data": {"subject": "b"}},
+        {"version": version + 3, "op": "delete", "id": "e1", "data": None}
+    ])
+    assert await read_changes_since(redis_connection, queue_version_key(1), version + 3) == (version + 3, [])
+
+
+async def test_unreplayable_gaps_need_a_full_reload(redis_connection, monkeypatch):
+    version = await get_version(redis_connection, queue_version_key(1))
+    await record_changes(redis_connection, queue_version_key(1), [{"op": "add", "id": f"e{i}", "data": "{}"} for i in range(3)])
+
+    #a version from the future, or one older than CHANGELOG_MAX_DELTA
+    assert await read_changes_since(redis_connection, queue_version_key(1), version + 10) == (version + 3, None)
+    monkeypatch.setattr(settings, "CHANGELOG_MAX_DELTA", 2)
+    assert await read_changes_since(redis_connection, queue_version_key(1), version) == (version + 3, None)
+    monkeypatch.undo()
+
+    #the oldest entry was trimmed from the stream
+    await redis_connection.xdel(changes_key(queue_version_key(1)), f"{version + 1}-0")
+    assert await read_changes_since(redis_connection, queue_version_key(1), version) == (version + 3, None)
+
+    #a change that can not be described item by item
+    await bump_version(redis_connection, queue_version_key(1))
+    assert await read_changes_since(redis_connection, queue_version_key(1), version + 3) == (version + 4, None)
+
+
+async def test_lost_counter_starts_a_new_epoch(redis_connection):
+    await get_version(redis_connection, queue_version_key(1))
+    await record_changes(redis_connection, queue_version_key(1), [{"op": "add", "id": "e1", "data": "{}"}])
+    await redis_connection.delete(queue_version_key(1))
+
+    #the changes of the old epoch are dropped with it
+    version = await record_changes(redis_connection, queue_version_key(1), [{"op": "add", "id": "e2", "data": "{}"}])
+    assert [entry["id"] for _, entry in await redis_connection.xrange(changes_key(queue_version_key(1)))] == ["e2"]
+    assert await read_changes_since(redis_connection, queue_version_key(1), version - 1) == (version, [{"version": version, "op": "add", "id": "e2", "data": {}}])